@@ -1,4 +1,39 @@
+"""
+inputs:
+    - message_id:
+        type: str
+        required: False
+        doc: |
+            The UUID of the message form the user was asked to fill in.
+            If unset, the flow will create a message form.
+    - flow_name:
+        type: str
+        required: False
+        doc: the name of the flow script to be started delayed
+    - delay:
+        type: number
+        required: False
+        doc: |
+            Start flow_name after this many seconds without asking for
+            details. The start is queued in the shared Scheduler flow.
+    - fire_at:
+        type: number
+        required: False
+        doc: Like delay, but the timestamp when flow_name should be started.
+    - inputs:
+        type: dict
+        required: False
+        doc: The inputs of the delayed execution of flow_name.
+
+Many delayed starts cost a single execution of the Scheduler flow, which
+holds them in a time-ordered queue and starts all executions due in the
+same second in one batch. Besides this flow, a webhook or another flow can
+queue them by starting the Scheduler with e.g.
+add=[{"flow_name": "my flow", "fire_at": 1700000000, "inputs": {...}}].
+"""
+
 import datetime
+import time
 
 import flow_api
 
@@ -6,6 +41,18 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     inputs = this.get('input_value') or {}
     message_id = inputs.get('message_id')
 
+    if message_id is None and ('delay' in inputs or 'fire_at' in inputs):
+        fire_at = inputs.get('fire_at') or time.time() + inputs['delay']
+        schedule_id = this.flow(
+            'Scheduler',
+            add={
+                'flow_name': inputs['flow_name'],
+                'fire_at': fire_at,
+                'inputs': inputs.get('inputs') or {},
+            },
+        ).get('output_value')['schedule_id']
+        return this.success(f'queued {inputs["flow_name"]} as schedule {schedule_id}')
+
     if message_id is None:
         defaults = {
             'delay': '60',
@@ -48,11 +95,18 @@ def handler(system: flow_api.System, this: flow_api.Execution):
                         'default': defaults['delay'],
                         'order': 4,
                     },
+                    'shared': {
+                        'label': 'Queue in the shared Scheduler flow instead of a separate execution',
+                        'element': 'toggle',
+                        'type': 'boolean',
+                        'default': True,
+                        'order': 5,
+                    },
                     'start': {
                         'label': 'Start delayed',
                         'element': 'submit',
                         'type': 'boolean',
-                        'order': 5,
+                        'order': 6,
                     },
                 },
                 'required': [
@@ -98,14 +152,27 @@ def handler(system: flow_api.System, this: flow_api.Execution):
         delta_sec = (scheduled - now).total_seconds()
         this.log(delta_sec=delta_sec)
         this.save(message=scheduled_ts)
-        this.sleep(delta_sec)
+        fire_at = scheduled.timestamp()
     elif delay is not None:
+        delta_sec = float(delay)
         this.save(message=f'sleeping for {delay} seconds')
         this.log(f'sleeping for {delay} seconds')
-        this.sleep(delay)
+        fire_at = time.time() + delta_sec
     else:
         return this.error('Missing response for "time" or "delay"')
 
+    if response.get('shared'):
+        schedule_id = this.flow(
+            'Scheduler',
+            add={
+                'flow_name': flow_name,
+                'fire_at': fire_at,
+                'inputs': inputs,
+            },
+        ).get('output_value')['schedule_id']
+        return this.success(f'queued {flow_name} as schedule {schedule_id}')
+
+    this.sleep(delta_sec)
     this.flow(
         flow_name,
         inputs=inputs,
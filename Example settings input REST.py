@@ -16,8 +16,127 @@
 # purposes only. Since this demo account also has usage limits, there is a
 # chance that the flow script will fail due to these limits.
 
+import time
+import urllib.parse
+
 import flow_api
 
+# REST responses of geonames are cached in the setting CACHE_SETTING, see
+# RestCache in loop_child, from which the class below is copied.
+CACHE_SETTING = 'geonames_cache'
+CACHE_TTL = 7 * 24 * 3600
+CACHE_MAX_ENTRIES = 5000
+# The REST calls share the rate limit of the geonames host with the other
+# flow scripts calling it, see RateLimiter in loop_child.
+RATE_LIMIT = 20
+RATE_BURST = 40
+
+
+class RestCache:
+    def __init__(self, system, setting_name=CACHE_SETTING, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.setting = system.setting(setting_name)
+        self.entries = (self.setting.get('value') if self.setting.exists() else None) or {}
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.updated = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url):
+        parts = urllib.parse.urlsplit(url.strip())
+        query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+        return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+
+    def lookup(self, url):
+        key = self.key(url)
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None or now - entry['stored_at'] >= self.ttl:
+            return None
+        self.hits += 1
+        entry['used_at'] = now
+        self.updated[key] = entry
+        return entry['json']
+
+    def store(self, url, json):
+        key = self.key(url)
+        now = time.time()
+        self.misses += 1
+        self.entries[key] = self.updated[key] = {
+            'stored_at': now,
+            'used_at': now,
+            'json': json,
+        }
+
+    def counters(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def save(self):
+        if not self.updated:
+            return
+        self.setting.acquire(timeout=None)
+        try:
+            entries = (self.setting.get('value') if self.setting.exists() else None) or {}
+            entries.update(self.updated)
+            if len(entries) > self.max_entries:
+                recent = sorted(entries, key=lambda key: entries[key]['used_at'], reverse=True)
+                entries = {key: entries[key] for key in recent[:self.max_entries]}
+            self.setting.save(value=entries)
+        finally:
+            self.setting.release()
+        self.updated = {}
+
+
+# RateLimiter is copied from loop_child, which documents it.
+class RateLimiter:
+    def __init__(self, system, name, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.setting = system.setting(f'rate_limit.{name}')
+        self.rate = rate
+        self.burst = burst
+
+    def take(self, this, tokens=1):
+        self.setting.acquire(timeout=None)
+        try:
+            now = time.time()
+            bucket = self.setting.get('value') if self.setting.exists() else None
+            if bucket is None:
+                bucket = {
+                    'rate': self.rate,
+                    'burst': self.burst,
+                    'tokens': self.burst,
+                    'updated_at': now,
+                }
+            refilled = bucket['tokens'] + (now - bucket['updated_at']) * bucket['rate']
+            bucket['tokens'] = min(bucket['burst'], refilled) - tokens
+            bucket['updated_at'] = now
+            self.setting.save(value=bucket)
+        finally:
+            self.setting.release()
+        if bucket['tokens'] < 0:
+            this.sleep(-bucket['tokens'] / bucket['rate'])
+
+
+# endpoint_host is copied from acs.apicall, which documents it.
+def endpoint_host(endpoint):
+    if '//' not in endpoint:
+        endpoint = f'//{endpoint}'
+    return urllib.parse.urlsplit(endpoint).hostname
+
+
+def get_json(system, this, cache, url):
+    """
+    The json of a GET of `url`, from `cache` or by a REST task, which takes
+    a token from the rate limit of the host first.
+    """
+    json = cache.lookup(url)
+    if json is None:
+        RateLimiter(system, endpoint_host(url)).take(this)
+        json = this.task('REST', url=url).get('output_value')['json']
+        cache.store(url, json)
+    return json
+
+
 # (1) define handler function for the Cloudomation class (c)
 def handler(system: flow_api.System, this: flow_api.Execution):
 
@@ -96,9 +215,18 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     # from a setting, and the country name from the user input. Note that you
     # can use standard python string formatting functionality for defining the
     # URL with parameters.
-    countrycode_request = this.task(
-        'REST',
-        url=(
+    # The answers of geonames hardly ever change, so we don't ask twice: the
+    # RestCache defined above keeps the responses in a setting, which is
+    # shared with other flow scripts calling geonames, e.g. loop_child. Only
+    # if the url is not in the cache (or the entry is too old), a REST task
+    # is executed, once the rate limit of geonames, which is shared with
+    # these flow scripts as well, allows for another call.
+    cache = RestCache(system)
+    countrycode_response = get_json(
+        system,
+        this,
+        cache,
+        (
             f'http://api.geonames.org/search?'
             f'name={countryname}&'
             f'featureCode=PCLI'
@@ -106,51 +234,54 @@ def handler(system: flow_api.System, this: flow_api.Execution):
             f'&username={username}'
         )
     )
-    # again, we execute the REST task right away and store the resulting
-    # execution object in a variable: countrycode_request
-
-    # now we get the response returned from the REST call
-    countrycode_response = countrycode_request.get('output_value')
 
     # First, we need to check if the REST call returned anything. If it didn't,
     # we will end the execution and inform the user. If it did, we continue.
 
     # because we want to learn about the REST task, we log the response
     # returned by the REST call. Take a look at the log to see what is returend
-    # by the REST call. It is again a JSON whose elements we can access.
+    # by the REST call. It is the JSON body of the response, whose elements we
+    # can access.
     this.log('Outputs of the country code REST task:', countrycode_response)
 
     # the geonames call returns the number of search results, which we access:
-    response_count = countrycode_response['json']['totalResultsCount']
+    response_count = countrycode_response['totalResultsCount']
 
     # check if the REST call returned 0 results
     if response_count < 1:
         # if it is 0, we will end the execution and tell the user that we
         # coudn't find the country. If the REST call did return a result,
-        # this line will be skipped and the script will continue.
+        # these lines will be skipped and the script will continue.
+        # The response is written to the cache anyway, so the next execution
+        # asking for the same name does not call geonames again.
+        cache.save()
         return this.error('We could not find the country you named.')
 
     # we access the country code. If you look at the response which we logged,
     # you will see that the JSON is nested so we need to go through a few
     # layers before we get to the country code.
-    countrycode = countrycode_response['json']['geonames'][0]['countryCode']
+    countrycode = countrycode_response['geonames'][0]['countryCode']
 
     # (5) another REST task
 
     # now that we have the country code, we want to get some information
     # about the country
-    countryinfo_request = this.task(
-        'REST',
-        url=(
+    countryinfo_result = get_json(
+        system,
+        this,
+        cache,
+        (
             f'http://api.geonames.org/countryInfo?'
             f'country={countrycode}'
             f'&type=JSON'
             f'&username={username}'
         )
-    )
+    )['geonames'][0]
 
-    # we get the ouput from the execution object
-    countryinfo_result = countryinfo_request.get('output_value')['json']['geonames'][0]
+    # we write the responses back to the cache setting, and note how many
+    # of them came from the cache
+    cache.save()
+    this.save(output_value={'cache': cache.counters()})
 
     # because we want to learn about the REST task, we log the response
     # returned by the REST call. Take a look at the log to see what is returend
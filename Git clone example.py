@@ -1,7 +1,40 @@
 import os
+import yaml
 import base64
 import flow_api
 
+# The files are decoded and saved by up to SAVE_WORKERS child executions of
+# this flow script at the same time, each with at least SAVE_BATCH files.
+# Settings are saved before the flows which read them.
+SAVE_WORKERS = 8
+SAVE_BATCH = 10
+SAVE_STAGES = ('setting', 'file', 'flow')
+# With a sparse checkout, only the files in the top-level directories
+# flows/, settings/ and files/ are fetched at the reference, without
+# history. The `sparse_paths` and `depth` inputs of the GIT task are only
+# known to be honoured by the GitBackend of flow_api_local, check that the
+# GIT task of your workspace supports them before using this option.
+SPARSE_PATHS = ('flows', 'settings', 'files')
+
+
+def save_object(system, kind, name, content):
+    if kind == 'flow':
+        # decode the base64 file content to text
+        text_content = base64.b64decode(content).decode()
+        # create or update Flow object
+        system.flow(name).save(script=text_content)
+    elif kind == 'setting':
+        # decode the base64 file content to text
+        text_content = base64.b64decode(content).decode()
+        # load the yaml string in the file content
+        value = yaml.safe_load(text_content)
+        # create or update Setting object
+        system.setting(name).save(value=value)
+    else:
+        # create or update File object
+        # pass the base64 encoded binary file content directly
+        system.file(name).save(content=content, convert_binary=False)
+
 
 def handler(system: flow_api.System, this: flow_api.Execution):
     """
@@ -15,6 +48,13 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     The inputs are not checked for validity!
     """
 
+    # A child execution started below to save some of the objects:
+    inputs = this.get('input_value') or {}
+    if 'objects' in inputs:
+        for kind, name, content in inputs['objects']:
+            save_object(system, kind, name, content)
+        return this.success(f'saved {len(inputs["objects"])} objects')
+
     # This is a pop-up message form, it will ask for some information 
     # The last element is an OK-button, after clicking it the 
     # values are passed further and the pop-up message closes.
@@ -52,11 +92,19 @@ def handler(system: flow_api.System, this: flow_api.Execution):
                     'default': 'develop',
                     'order': 4,
                 },
+                # A toggle to fetch only the directories which are saved:
+                'sparse checkout': {
+                    'element': 'toggle',
+                    'type': 'boolean',
+                    'label': 'Only fetch the flows, settings and files directories:',
+                    'default': False,
+                    'order': 5,
+                },
                 'Ok': {
                     'element': 'submit',
                     'label': 'OK',
                     'type': 'boolean',
-                    'order': 5,
+                    'order': 6,
                 },
             },
             'required': [
@@ -71,6 +119,10 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     git_password = git_login_form_response['password']
     git_repo_url = git_login_form_response['repository url']
     git_reference = git_login_form_response['reference']
+    if git_login_form_response.get('sparse checkout'):
+        sparse = {'sparse_paths': list(SPARSE_PATHS), 'depth': 1}
+    else:
+        sparse = {}
 
     # Now we use a "GIT" task.                                      
     # The git 'get' command fetches the content of the repository.
@@ -86,33 +138,53 @@ def handler(system: flow_api.System, this: flow_api.Execution):
             ref=git_reference,
             username=git_username,
             password=git_password,
+            **sparse,
         ).get('output_value')['files']
     except flow_api.exceptions.DependencyFailedError as err:
         # send the error message to the output of this execution:
         return this.error(repr(err))
 
-    # iterate over all files and save them on Cloudomation:
+    # iterate over all files and sort out which object to save for each:
+    objects = []
     for file_ in files:
         # split the path and filename
         path, filename = os.path.split(file_['name'])
+        # the top-level directory decides the kind of object, the same
+        # directories are fetched with a sparse checkout
+        directory = path.split('/')[0]
         # split the filename and file extension
         name, ext = os.path.splitext(filename)
-        if 'flows' in path and ext == '.py':
-            # decode the base64 file content to text
-            text_content = base64.b64decode(file_['content']).decode()
-            # create or update Flow object
-            system.flow(name).save(script=text_content)
-        elif 'settings' in path and ext == '.yaml':
-            # decode the base64 file content to text
-            text_content = base64.b64decode(file_['content']).decode()
-            # load the yaml string in the file content
-            value = yaml.safe_load(text_content)
-            # create or update Setting object
-            system.setting(name).save(value=value)
-        elif 'files' in path:
-            # create or update File object
+        if directory == 'flows' and ext == '.py':
+            objects.append(['flow', name, file_['content']])
+        elif directory == 'settings' and ext == '.yaml':
+            objects.append(['setting', name, file_['content']])
+        elif directory == 'files':
             # we use the name with the extension
-            # pass the base64 encoded binary file content directly
-            system.file(filename).save(content=file_['content'], convert_binary=False)
+            objects.append(['file', filename, file_['content']])
+
+    # save the objects on Cloudomation, several at the same time. All
+    # objects of one kind are saved before the next kind is started.
+    for stage in SAVE_STAGES:
+        batch = [object_ for object_ in objects if object_[0] == stage]
+        workers = min(SAVE_WORKERS, -(-len(batch) // SAVE_BATCH))
+        if workers <= 1:
+            # a few objects are saved right here
+            for kind, name, content in batch:
+                save_object(system, kind, name, content)
+            continue
+        # every child execution saves every workers-th object of the batch
+        children = [
+            this.flow(
+                'Git clone example',
+                name=f'save {stage}s {worker + 1}/{workers}',
+                inputs={'objects': batch[worker::workers]},
+                run=False,
+            ).run_async()
+            for worker in range(workers)
+        ]
+        try:
+            this.wait_for(*children, return_when=system.return_when.ALL_SUCCEEDED)
+        except flow_api.exceptions.DependencyFailedError as err:
+            return this.error(repr(err))
 
     return this.success('all done')
@@ -1,8 +1,40 @@
+import collections
+import hashlib
 import time
 from datetime import datetime, timezone
 
 import flow_api
 
+CATCH_UP_POLICIES = ('skip', 'coalesce', 'burst')
+# number of recent iterations the lateness statistics are computed over
+LATENESS_WINDOW = 100
+OVERFLOW_POLICIES = ('skip', 'queue', 'cancel_oldest')
+ENDED_STATUSES = ('ENDED_SUCCESS', 'ENDED_ERROR', 'ENDED_CANCELLED')
+
+
+# spread_offset is copied from the Scheduled flow, see there.
+def spread_offset(flow_name, spread):
+    if not spread:
+        return 0
+    digest = hashlib.sha256(flow_name.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % int(spread)
+
+
+def running(children):
+    return [child for child in children if child.load('status') not in ENDED_STATUSES]
+
+
+def start_iteration(this, flow_name, iteration, inputs):
+    child = this.flow(
+        flow_name,
+        inputs=inputs,
+        name=f'{flow_name} iteration #{iteration}',
+        run=False
+    )
+    child.run_async()
+    return child
+
+
 def handler(system: flow_api.System, this: flow_api.Execution):
     inputs = this.get('input_value') or {}
     message_id = inputs.get('message_id')
@@ -10,7 +42,12 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     if message_id is None:
         defaults = {
             'interval': 60,
+            'spread': 0,
             'wait': True,
+            'fixed_rate': False,
+            'catch_up': 'burst',
+            'overflow': 'skip',
+            'max_queue': 10,
         }
         if 'flow_name' in inputs:
             defaults['flow_name'] = inputs['flow_name']
@@ -38,24 +75,81 @@ def handler(system: flow_api.System, this: flow_api.Execution):
                         'default': defaults['interval'],
                         'order': 2,
                     },
+                    'spread': {
+                        'label': 'Start at a fixed offset within the interval of up to this many seconds, chosen per flow name, to spread flows started at the same time',
+                        'element': 'number',
+                        'type': 'number',
+                        'default': defaults['spread'],
+                        'order': 3,
+                    },
                     'wait': {
                         'label': 'Wait for child executions to finish',
                         'element': 'toggle',
                         'type': 'boolean',
                         'default': defaults['wait'],
-                        'order': 3,
+                        'order': 4,
+                    },
+                    'max_in_flight': {
+                        'label': 'Maximum number of child executions running at the same time if not waiting (unlimited if omitted)',
+                        'element': 'number',
+                        'type': 'number',
+                        'order': 5,
+                    },
+                    'overflow': {
+                        'label': 'Iterations beyond the maximum: skip, queue or cancel_oldest',
+                        'element': 'string',
+                        'type': 'string',
+                        'example': defaults['overflow'],
+                        'default': defaults['overflow'],
+                        'order': 6,
+                    },
+                    'max_queue': {
+                        'label': 'Maximum number of queued iterations',
+                        'element': 'number',
+                        'type': 'number',
+                        'example': defaults['max_queue'],
+                        'default': defaults['max_queue'],
+                        'order': 7,
+                    },
+                    'fixed_rate': {
+                        'label': 'Start at a fixed rate, also when child executions take longer than the interval',
+                        'element': 'toggle',
+                        'type': 'boolean',
+                        'default': defaults['fixed_rate'],
+                        'order': 8,
+                    },
+                    'catch_up': {
+                        'label': 'Missed iterations at a fixed rate: skip, coalesce (start once) or burst (start all)',
+                        'element': 'string',
+                        'type': 'string',
+                        'example': defaults['catch_up'],
+                        'default': defaults['catch_up'],
+                        'order': 9,
+                    },
+                    'burst_limit': {
+                        'label': 'Maximum number of missed iterations started in a burst (unlimited if omitted)',
+                        'element': 'number',
+                        'type': 'number',
+                        'order': 10,
                     },
                     'max_iterations': {
                         'label': 'Maximum number of iterations (unlimited if omitted)',
                         'element': 'number',
                         'type': 'number',
-                        'order': 4,
+                        'order': 11,
+                    },
+                    'shared': {
+                        'label': 'Run in the shared Scheduler flow instead of a separate execution',
+                        'element': 'toggle',
+                        'type': 'boolean',
+                        'default': False,
+                        'order': 12,
                     },
                     'start': {
                         'label': 'Start recurring',
                         'element': 'submit',
                         'type': 'boolean',
-                        'order': 5,
+                        'order': 13,
                     },
                 },
                 'required': [
@@ -83,48 +177,178 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     interval = response['interval']
     wait = response['wait']
     max_iterations = response.get('max_iterations')
+
+    if response.get('shared'):
+        # the Scheduler flow starts the children, it does not wait for them
+        schedule_id = this.flow(
+            'Scheduler',
+            add={
+                'flow_name': flow_name,
+                'interval': interval,
+                'spread': response.get('spread') or 0,
+                'max_iterations': max_iterations,
+            },
+        ).get('output_value')['schedule_id']
+        return this.success(f'added schedule {schedule_id} to Scheduler')
+
+    # without waiting for the children the iterations always follow the
+    # fixed rate, like before the option existed
+    fixed_rate = response.get('fixed_rate') or not wait
+    catch_up = response.get('catch_up') or 'burst'
+    burst_limit = response.get('burst_limit')
+    if catch_up not in CATCH_UP_POLICIES:
+        return this.error(f'Unknown catch_up policy {catch_up!r}, use one of {", ".join(CATCH_UP_POLICIES)}')
+    # backpressure for children which are not waited for
+    max_in_flight = None if wait else response.get('max_in_flight')
+    overflow = response.get('overflow') or 'skip'
+    max_queue = response.get('max_queue') or 0
+    if overflow not in OVERFLOW_POLICIES:
+        return this.error(f'Unknown overflow policy {overflow!r}, use one of {", ".join(OVERFLOW_POLICIES)}')
+
     this.save(name=f'Recurring {flow_name}')
 
     # Loop
     iterations = 0
     start = time.time()
+    if response.get('spread'):
+        # the first iteration starts at the offset of the flow within the interval
+        phase = spread_offset(flow_name, min(response['spread'], interval))
+        start += (phase - start) % interval
+        this.sleep_until(start)
+    # at a fixed rate, iteration n is due at start + n * interval; with a
+    # fixed delay it is due one interval after the previous child ended
+    tick = 0
+    due = start
+    burst = 0
+    missed = 0
+    skipped_ticks = 0
+    coalesced_ticks = 0
+    lateness = collections.deque(maxlen=LATENESS_WINDOW)
+    max_lateness = 0.0
+    in_flight = []
+    queue = collections.deque()
+    dropped_ticks = 0
+    cancelled_children = 0
     while max_iterations is None or iterations < max_iterations:
         iterations += 1
+        late = max(0.0, time.time() - due)
+        lateness.append(late)
+        max_lateness = max(max_lateness, late)
+        window = sorted(lateness)
+        output_value = {
+            'lateness': {
+                'last': round(late, 3),
+                'mean': round(sum(window) / len(window), 3),
+                'p95': round(window[int(0.95 * (len(window) - 1))], 3),
+                'max': round(max_lateness, 3),
+            },
+            'skipped_ticks': skipped_ticks,
+            'coalesced_ticks': coalesced_ticks,
+        }
+        if max_in_flight:
+            output_value.update({
+                'in_flight': len(in_flight),
+                'queue_depth': len(queue),
+                'dropped_ticks': dropped_ticks,
+                'cancelled_children': cancelled_children,
+            })
         if max_iterations:
-            this.save(message=f'iteration {iterations}/{max_iterations}')
+            this.save(message=f'iteration {iterations}/{max_iterations}', output_value=output_value)
         else:
-            this.save(message=f'iteration {iterations}')
+            this.save(message=f'iteration {iterations}', output_value=output_value)
         # Start child execution
         inputs = {
             'start': start,
             'iterations': iterations,
             'max_iterations': max_iterations,
         }
-        child = this.flow(
-            flow_name,
-            inputs=inputs,
-            name=f'{flow_name} iteration #{iterations}',
-            run=False
-        )
+        if missed:
+            inputs['coalesced_ticks'] = missed
         if wait:
+            child = this.flow(
+                flow_name,
+                inputs=inputs,
+                name=f'{flow_name} iteration #{iterations}',
+                run=False
+            )
             try:
                 child.run()
             except Exception:
                 this.log(f'iteration #{iterations} failed')
+        elif not max_in_flight:
+            start_iteration(this, flow_name, iterations, inputs)
         else:
-            child.run_async()
+            in_flight = running(in_flight)
+            while queue and len(in_flight) < max_in_flight:
+                in_flight.append(start_iteration(this, flow_name, *queue.popleft()))
+            if not queue and len(in_flight) < max_in_flight:
+                in_flight.append(start_iteration(this, flow_name, iterations, inputs))
+            elif overflow == 'queue' and len(queue) < max_queue:
+                queue.append((iterations, inputs))
+            elif overflow == 'cancel_oldest':
+                in_flight.pop(0).cancel()
+                cancelled_children += 1
+                in_flight.append(start_iteration(this, flow_name, iterations, inputs))
+            else:
+                dropped_ticks += 1
+                this.log(f'iteration #{iterations} dropped, {len(in_flight)} children in flight')
         if max_iterations is not None and iterations >= max_iterations:
             break
-        if wait:
-            now = time.time()
-            scheduled = datetime.fromtimestamp(now + interval, timezone.utc)
+        missed = 0
+        if not fixed_rate:
+            due = time.time() + interval
         else:
-            scheduled = datetime.fromtimestamp(start + (iterations * interval), timezone.utc)
+            tick += 1
+            due = start + (tick * interval)
+            now = time.time()
+            if now > due:
+                # ticks due by now, the oldest first
+                overdue = int((now - due) // interval) + 1
+                if catch_up == 'burst' and (burst_limit is None or burst < burst_limit):
+                    burst += 1
+                    continue
+                # skip, also the ticks past the burst limit
+                if catch_up == 'coalesce':
+                    # one iteration right away stands in for all of them
+                    missed = overdue - 1
+                    coalesced_ticks += missed
+                    tick += missed
+                    due = start + (tick * interval)
+                    continue
+                skipped_ticks += overdue
+                tick += overdue
+                due = start + (tick * interval)
+        burst = 0
+        scheduled = datetime.fromtimestamp(due, timezone.utc)
         scheduled_ts = scheduled.isoformat(sep=' ', timespec='minutes')
         this.save(message=scheduled_ts)
-        if wait:
+        if fixed_rate:
+            # queued iterations start as soon as a child ends
+            while queue and time.time() < due:
+                in_flight = running(in_flight)
+                if len(in_flight) < max_in_flight:
+                    in_flight.append(start_iteration(this, flow_name, *queue.popleft()))
+                else:
+                    this.wait_for(*in_flight, return_when=system.return_when.FIRST_ENDED, timeout=due - time.time())
+            this.sleep_until(due)
+        else:
             this.sleep(interval)
+
+    while queue:
+        in_flight = running(in_flight)
+        if len(in_flight) < max_in_flight:
+            in_flight.append(start_iteration(this, flow_name, *queue.popleft()))
         else:
-            this.sleep_until(start + (iterations * interval))
+            this.wait_for(*in_flight, return_when=system.return_when.FIRST_ENDED)
 
+    if max_in_flight:
+        output_value.update({
+            'in_flight': len(running(in_flight)),
+            'queue_depth': 0,
+            'dropped_ticks': dropped_ticks,
+            'cancelled_children': cancelled_children,
+        })
+        this.save(output_value=output_value)
+    if dropped_ticks:
+        return this.success(f'started {iterations - dropped_ticks} of {iterations} iterations')
     return this.success(f'started {iterations} iterations')
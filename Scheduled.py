@@ -1,14 +1,296 @@
+"""
+Start a flow on a schedule: daily at a time, or by a cron expression
+("minute hour day-of-month month day-of-week", e.g. "30 8 * * mon-fri").
+The "Scheduled monthly" flow uses this flow for its schedules, too.
+
+The state of a schedule is checkpointed in the setting
+"Scheduled <flow name> <message id>" after every iteration, so several
+schedules of the same flow each keep their own. Started again with the
+flow_name input, e.g. after the execution was cancelled, the flow resumes
+the checkpointed schedules of that flow which are not running without
+asking for details; with resume_only set as well, it never asks. Started
+with the message_id input, it resumes that schedule. Delete the setting to
+start over.
+"""
+
+import calendar
 import datetime, pytz
+import hashlib
 
 import flow_api
 
+MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+WEEKDAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+CRON_MACROS = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+
+def next_bit(mask, start):
+    """Index of the lowest bit set in `mask` at or above `start`, or None."""
+    rest = mask >> start
+    if not rest:
+        return None
+    return start + (rest & -rest).bit_length() - 1
+
+
+def parse_cron_field(field, low, high, names=None):
+    """Compile one cron field ("*", "1-5", "*/15", "mon,wed", ...) into a bitset."""
+    mask = 0
+    for part in field.lower().split(','):
+        value_range, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if value_range == '*':
+            first, last = low, high
+        else:
+            first, _, last = value_range.partition('-')
+            first = names.index(first) + low if names and first in names else int(first)
+            if last:
+                last = names.index(last) + low if names and last in names else int(last)
+            elif step > 1:
+                last = high
+            else:
+                last = first
+        if not low <= first <= last <= high or step < 1:
+            raise ValueError(f'invalid cron field {field!r}')
+        for value in range(first, last + 1, step):
+            mask |= 1 << value
+    return mask
+
+
+class Cron:
+    """
+    A cron expression ("minute hour day-of-month month day-of-week") in a
+    timezone.
+
+    Every field is compiled into a bitset once. The days of a month which
+    match both day fields are combined into one bitset and cached per month,
+    so each step to the next fire time takes a few bit operations.
+
+    Local times which do not exist because of a DST gap fire shifted forward
+    by the length of the gap, local times which occur twice fire once, at
+    the first occurrence.
+    """
+
+    def __init__(self, expression, timezone='Europe/Vienna', second=0):
+        self.expression = expression
+        fields = CRON_MACROS.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f'cron expression {expression!r} must have 5 fields')
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12, MONTH_NAMES)
+        weekdays = parse_cron_field(fields[4], 0, 7, WEEKDAY_NAMES)
+        # 0 and 7 both mean sunday
+        self.weekdays = (weekdays | weekdays >> 7) & 0x7f
+        # like cron: if both day fields are restricted, a day matching either fires
+        self.days_restricted = not fields[2].startswith('*')
+        self.weekdays_restricted = not fields[4].startswith('*')
+        if isinstance(timezone, str):
+            timezone = pytz.timezone(timezone)
+        self.tz = timezone
+        self.second = second
+        # days of a 31 day month falling on a matching weekday, per weekday of the 1st
+        self._weekday_days = []
+        for first_weekday in range(7):
+            days = 0
+            for day in range(1, 32):
+                if self.weekdays >> ((first_weekday + day - 1) % 7) & 1:
+                    days |= 1 << day
+            self._weekday_days.append(days)
+        self._month_days = {}
+
+    def __repr__(self):
+        return f'<Cron {self.expression!r} {self.tz}>'
+
+    def month_days(self, year, month):
+        """Bitset of the days of `month` on which the expression fires."""
+        key = (year, month)
+        days = self._month_days.get(key)
+        if days is None:
+            first_weekday, length = calendar.monthrange(year, month)
+            valid = (1 << (length + 1)) - 2
+            weekday_days = self._weekday_days[(first_weekday + 1) % 7]
+            if self.days_restricted and self.weekdays_restricted:
+                days = (self.days | weekday_days) & valid
+            elif self.weekdays_restricted:
+                days = weekday_days & valid
+            else:
+                days = self.days & valid
+            days = self._month_days[key] = days
+        return days
+
+    def next_local(self, after):
+        """The first matching naive local time after the naive local time `after`."""
+        year, month, day, hour, minute = after.year, after.month, after.day, after.hour, after.minute
+        if (after.second, after.microsecond) >= (self.second, 0):
+            minute += 1
+        last_year = year + 28
+        while year <= last_year:
+            if not self.months >> month & 1:
+                month = next_bit(self.months, month + 1)
+                if month is None:
+                    year += 1
+                    month = next_bit(self.months, 1)
+                day, hour, minute = 1, 0, 0
+                continue
+            next_day = next_bit(self.month_days(year, month), day)
+            if next_day is None:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                if month > 12:
+                    year, month = year + 1, 1
+                continue
+            if next_day != day:
+                day, hour, minute = next_day, 0, 0
+            next_hour = next_bit(self.hours, hour)
+            if next_hour is None:
+                day, hour, minute = day + 1, 0, 0
+                continue
+            if next_hour != hour:
+                hour, minute = next_hour, 0
+            next_minute = next_bit(self.minutes, minute)
+            if next_minute is None:
+                hour, minute = hour + 1, 0
+                continue
+            return datetime.datetime(year, month, day, hour, next_minute, self.second)
+        raise ValueError(f'cron expression {self.expression!r} never fires')
+
+    def localize(self, local):
+        try:
+            return self.tz.localize(local, is_dst=None)
+        except pytz.exceptions.AmbiguousTimeError:
+            return self.tz.localize(local, is_dst=True)
+        except pytz.exceptions.NonExistentTimeError:
+            return self.tz.normalize(self.tz.localize(local, is_dst=False))
+
+    def next_fires(self, after, count):
+        """The next `count` fire times (timestamps) after the timestamp `after`."""
+        fires = []
+        local = datetime.datetime.fromtimestamp(after, self.tz).replace(tzinfo=None)
+        while len(fires) < count:
+            local = self.next_local(local)
+            fire = self.localize(local).timestamp()
+            # local times in a DST overlap may lie before `after`
+            if fire > after:
+                fires.append(fire)
+                after = fire
+        return fires
+
+    def next_fire(self, after):
+        """The first fire time (a timestamp) after the timestamp `after`."""
+        return self.next_fires(after, 1)[0]
+
+
+def schedule_from_response(response):
+    """
+    Translate a schedule form response into a cron schedule. Accepts a
+    cron expression, a daily time (scheduled_at) or a day of the month and
+    time (scheduled_at_day, scheduled_at_time).
+    """
+    schedule = {
+        'timezone': response.get('timezone', 'Europe/Vienna'),
+        'second': 0,
+        'spread': response.get('spread') or 0,
+    }
+    if response.get('cron'):
+        schedule['cron'] = response['cron']
+        return schedule
+    if 'scheduled_at_day' in response:
+        scheduled_at = response.get('scheduled_at_time') or response['scheduled_at']
+        day = response['scheduled_at_day']
+    else:
+        scheduled_at = response['scheduled_at']
+        day = '*'
+    try:
+        scheduled_at_t = datetime.datetime.strptime(scheduled_at, '%H:%M:%S%z').timetz()
+    except ValueError:
+        scheduled_at_t = datetime.datetime.strptime(scheduled_at, '%H:%M:%S').timetz()
+    if scheduled_at_t.tzinfo is not None:
+        schedule['utc_offset'] = int(scheduled_at_t.utcoffset().total_seconds() // 60)
+    schedule['cron'] = f'{scheduled_at_t.minute} {scheduled_at_t.hour} {day} * *'
+    schedule['second'] = scheduled_at_t.second
+    return schedule
+
+
+def spread_offset(flow_name, spread):
+    """
+    A stable offset of 0 to `spread` seconds for `flow_name`, so schedules
+    which would start at the same instant are spread over the window while
+    each keeps the same start time on every run.
+    """
+    if not spread:
+        return 0
+    digest = hashlib.sha256(flow_name.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % int(spread)
+
+
+def cron_from_schedule(schedule):
+    if schedule.get('utc_offset') is not None:
+        timezone = pytz.FixedOffset(schedule['utc_offset'])
+    else:
+        timezone = schedule.get('timezone', 'Europe/Vienna')
+    return Cron(schedule['cron'], timezone, schedule.get('second', 0))
+
+
+def checkpoint_setting(system, flow_name, message_id):
+    # the message form identifies a schedule
+    return system.setting(f'Scheduled {flow_name} {message_id}')
+
+
+def load_checkpoint(system, flow_name, message_id):
+    setting = checkpoint_setting(system, flow_name, message_id)
+    return setting.get('value') if setting.exists() else None
+
+
+def stopped_checkpoints(system, flow_name):
+    """The checkpoints of the schedules of `flow_name` which are not running."""
+    checkpoints = []
+    for setting in system.settings():
+        if not setting.get('name').startswith(f'Scheduled {flow_name} '):
+            continue
+        checkpoint = setting.get('value')
+        if not isinstance(checkpoint, dict) or checkpoint.get('response', {}).get('flow_name') != flow_name:
+            continue
+        if not execution_alive(system, checkpoint.get('execution_id')):
+            checkpoints.append(checkpoint)
+    return checkpoints
+
+
+def execution_alive(system, execution_id):
+    try:
+        status = system.execution(execution_id).get('status')
+    except Exception:
+        return False
+    return status not in ('ENDED_SUCCESS', 'ENDED_ERROR', 'ENDED_CANCELLED')
+
+
 def handler(system: flow_api.System, this: flow_api.Execution):
     inputs = this.get('input_value') or {}
     message_id = inputs.get('message_id')
+    if message_id is None and inputs.get('flow_name'):
+        checkpoints = stopped_checkpoints(system, inputs['flow_name'])
+        for checkpoint in checkpoints:
+            this.flow(
+                'Scheduled',
+                name='Scheduled execution',
+                message_id=checkpoint['message_id'],
+                wait=False,
+            )
+        if checkpoints or inputs.get('resume_only'):
+            this.save(output_value={'resumed': len(checkpoints)})
+            return this.success(f'resumed {len(checkpoints)} schedules')
 
     if message_id is None:
         defaults = {
             'scheduled_at': '08:30',
+            'spread': 0,
         }
         if 'flow_name' in inputs:
             defaults['flow_name'] = inputs['flow_name']
@@ -35,17 +317,37 @@ def handler(system: flow_api.System, this: flow_api.Execution):
                         'default': defaults['scheduled_at'],
                         'order': 2,
                     },
+                    'cron': {
+                        'label': 'Cron expression, e.g. "30 8 * * mon-fri" (overrides the time)',
+                        'element': 'string',
+                        'type': 'string',
+                        'order': 3,
+                    },
+                    'spread': {
+                        'label': 'Delay the start by a fixed offset of up to this many seconds, chosen per flow name, to spread schedules starting at the same time',
+                        'element': 'number',
+                        'type': 'number',
+                        'default': defaults['spread'],
+                        'order': 4,
+                    },
                     'max_iterations': {
                         'label': 'Maximum number of iterations (unlimited if omitted)',
                         'element': 'number',
                         'type': 'number',
-                        'order': 3,
+                        'order': 5,
+                    },
+                    'shared': {
+                        'label': 'Run in the shared Scheduler flow instead of a separate execution',
+                        'element': 'toggle',
+                        'type': 'boolean',
+                        'default': False,
+                        'order': 6,
                     },
                     'start': {
                         'label': 'Start schedule',
                         'element': 'submit',
                         'type': 'boolean',
-                        'order': 4,
+                        'order': 7,
                     },
                 },
                 'required': [
@@ -70,37 +372,67 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     response = message.wait().get('response')
     this.log(response=response)
     flow_name = response['flow_name']
-    scheduled_at = response['scheduled_at']
+    # a restart of this execution, or of a stopped one, continues the schedule
+    checkpoint = load_checkpoint(system, flow_name, message_id)
+    if checkpoint is not None:
+        this.log(f'resuming from iteration {checkpoint["iterations"]}')
     max_iterations = response.get('max_iterations')
-    local_tz = response.get('timezone', 'Europe/Vienna')
+    schedule = schedule_from_response(response)
+    this.log(schedule=schedule)
+
+    if response.get('shared'):
+        schedule_id = this.flow(
+            'Scheduler',
+            add=dict(
+                schedule,
+                flow_name=flow_name,
+                max_iterations=max_iterations,
+            ),
+        ).get('output_value')['schedule_id']
+        return this.success(f'added schedule {schedule_id} to Scheduler')
+
+    setting = checkpoint_setting(system, flow_name, message_id)
+    if checkpoint is not None and checkpoint['execution_id'] != this.get('id') and execution_alive(system, checkpoint['execution_id']):
+        return this.error(f'this schedule of {flow_name} is running in execution {checkpoint["execution_id"]}')
+    if checkpoint is None:
+        checkpoint = {
+            'message_id': message_id,
+            'response': response,
+            'start': datetime.datetime.now(datetime.timezone.utc).timestamp(),
+            'iterations': 0,
+            'next_fire': None,
+        }
+    checkpoint['execution_id'] = this.get('id')
+
     this.save(name=f'Scheduled {flow_name}')
 
-    try:
-        scheduled_at_t = datetime.datetime.strptime(scheduled_at, '%H:%M:%S%z').timetz()
-    except ValueError:
-        scheduled_at_t = datetime.datetime.strptime(scheduled_at, '%H:%M:%S').timetz()
-    this.log(scheduled_at_t=scheduled_at_t)
-    iterations = 0
-    start = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    # compile the schedule once, every iteration only steps to the next fire time
+    cron = cron_from_schedule(schedule)
+    offset = spread_offset(flow_name, schedule['spread'])
+    iterations = checkpoint['iterations']
+    start = checkpoint['start']
     while max_iterations is None or iterations < max_iterations:
-        now = datetime.datetime.now(datetime.timezone.utc)
-        if scheduled_at_t.tzinfo is None:
-            now = now.astimezone(pytz.timezone(local_tz))
-        this.log(now=now)
-        today = now.date()
-        this.log(today=today)
-        scheduled = datetime.datetime.combine(today, scheduled_at_t)
-        if scheduled.tzinfo is None or scheduled.tzinfo.utcoffset(scheduled) is None:
-            scheduled = pytz.timezone(local_tz).localize(scheduled)
-        if scheduled < now:  # next iteration tomorrow
-            scheduled += datetime.timedelta(days=1)
-        this.log(scheduled=scheduled)
-        scheduled_ts = scheduled.isoformat(sep=' ', timespec='minutes')
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        next_fires = [fire + offset for fire in cron.next_fires(now - offset, 5)]
+        if checkpoint['next_fire'] is not None and checkpoint['next_fire'] < next_fires[0]:
+            # the fire time passed while the schedule was not running,
+            # start the missed iteration right away
+            next_fires = [checkpoint['next_fire']] + next_fires[:4]
+        checkpoint['next_fire'] = next_fires[0]
+        setting.save(value=checkpoint)
+        scheduled_ts = datetime.datetime.fromtimestamp(next_fires[0], cron.tz).isoformat(sep=' ', timespec='minutes')
         this.log(scheduled_ts=scheduled_ts)
-        delta_sec = (scheduled - now).total_seconds()
-        this.log(delta_sec=delta_sec)
-        this.save(message=scheduled_ts)
-        this.sleep(delta_sec)
+        this.save(
+            message=scheduled_ts,
+            output_value={
+                'next_fires': [
+                    datetime.datetime.fromtimestamp(fire, cron.tz).isoformat(sep=' ', timespec='minutes')
+                    for fire
+                    in next_fires
+                ],
+            },
+        )
+        this.sleep_until(next_fires[0])
         iterations += 1
         this.save(message=f'iteration {iterations}/{max_iterations}')
         # Start child execution
@@ -115,7 +447,11 @@ def handler(system: flow_api.System, this: flow_api.Execution):
             name=f'{flow_name} iteration #{iterations}',
             wait=False,
         )
+        checkpoint['iterations'] = iterations
+        checkpoint['next_fire'] = None
+        setting.save(value=checkpoint)
         if max_iterations is not None and iterations >= max_iterations:
             break
 
+    setting.delete()
     return this.success(f'started {iterations} iterations')
@@ -0,0 +1,430 @@
+"""
+inputs:
+    - add:
+        type: dict
+        required: False
+        doc: |
+            A schedule to register, or a list of schedules. Keys:
+            flow_name (required), inputs, max_iterations and either
+            fire_at (timestamp) to start the flow once,
+            interval (seconds) for a recurring schedule,
+            cron (a cron expression) and timezone, or
+            scheduled_at (HH:MM:SS) with an optional scheduled_at_day
+            (day of month) and timezone for a daily or monthly schedule.
+            With spread (seconds), the schedule starts at a fixed offset
+            of up to spread seconds chosen by the flow name.
+            The id of the new schedule is returned in the output, or the
+            ids of the new schedules for a list.
+    - remove:
+        type: str
+        required: False
+        doc: The id of a schedule to remove.
+    - setting_name:
+        type: str
+        required: False
+        doc: The setting holding all schedules, defaults to "scheduler".
+    - poll_interval:
+        type: number
+        required: False
+        doc: |
+            Maximum number of seconds the scheduler sleeps before it checks
+            for new schedules, defaults to 60.
+"""
+
+import calendar
+import datetime
+import hashlib
+import heapq
+import math
+import time
+import uuid
+
+import pytz
+
+import flow_api
+
+DEFAULT_SETTING = 'scheduler'
+DEFAULT_POLL_INTERVAL = 60
+
+
+# Copied from the Scheduled flow, which documents the cron engine and the
+# schedule helpers. Flow scripts cannot import each other, so change both
+# copies together.
+MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+WEEKDAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+CRON_MACROS = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+
+def next_bit(mask, start):
+    rest = mask >> start
+    if not rest:
+        return None
+    return start + (rest & -rest).bit_length() - 1
+
+
+def parse_cron_field(field, low, high, names=None):
+    mask = 0
+    for part in field.lower().split(','):
+        value_range, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if value_range == '*':
+            first, last = low, high
+        else:
+            first, _, last = value_range.partition('-')
+            first = names.index(first) + low if names and first in names else int(first)
+            if last:
+                last = names.index(last) + low if names and last in names else int(last)
+            elif step > 1:
+                last = high
+            else:
+                last = first
+        if not low <= first <= last <= high or step < 1:
+            raise ValueError(f'invalid cron field {field!r}')
+        for value in range(first, last + 1, step):
+            mask |= 1 << value
+    return mask
+
+
+class Cron:
+    def __init__(self, expression, timezone='Europe/Vienna', second=0):
+        self.expression = expression
+        fields = CRON_MACROS.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f'cron expression {expression!r} must have 5 fields')
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12, MONTH_NAMES)
+        weekdays = parse_cron_field(fields[4], 0, 7, WEEKDAY_NAMES)
+        self.weekdays = (weekdays | weekdays >> 7) & 0x7f
+        self.days_restricted = not fields[2].startswith('*')
+        self.weekdays_restricted = not fields[4].startswith('*')
+        if isinstance(timezone, str):
+            timezone = pytz.timezone(timezone)
+        self.tz = timezone
+        self.second = second
+        self._weekday_days = []
+        for first_weekday in range(7):
+            days = 0
+            for day in range(1, 32):
+                if self.weekdays >> ((first_weekday + day - 1) % 7) & 1:
+                    days |= 1 << day
+            self._weekday_days.append(days)
+        self._month_days = {}
+
+    def __repr__(self):
+        return f'<Cron {self.expression!r} {self.tz}>'
+
+    def month_days(self, year, month):
+        key = (year, month)
+        days = self._month_days.get(key)
+        if days is None:
+            first_weekday, length = calendar.monthrange(year, month)
+            valid = (1 << (length + 1)) - 2
+            weekday_days = self._weekday_days[(first_weekday + 1) % 7]
+            if self.days_restricted and self.weekdays_restricted:
+                days = (self.days | weekday_days) & valid
+            elif self.weekdays_restricted:
+                days = weekday_days & valid
+            else:
+                days = self.days & valid
+            days = self._month_days[key] = days
+        return days
+
+    def next_local(self, after):
+        year, month, day, hour, minute = after.year, after.month, after.day, after.hour, after.minute
+        if (after.second, after.microsecond) >= (self.second, 0):
+            minute += 1
+        last_year = year + 28
+        while year <= last_year:
+            if not self.months >> month & 1:
+                month = next_bit(self.months, month + 1)
+                if month is None:
+                    year += 1
+                    month = next_bit(self.months, 1)
+                day, hour, minute = 1, 0, 0
+                continue
+            next_day = next_bit(self.month_days(year, month), day)
+            if next_day is None:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                if month > 12:
+                    year, month = year + 1, 1
+                continue
+            if next_day != day:
+                day, hour, minute = next_day, 0, 0
+            next_hour = next_bit(self.hours, hour)
+            if next_hour is None:
+                day, hour, minute = day + 1, 0, 0
+                continue
+            if next_hour != hour:
+                hour, minute = next_hour, 0
+            next_minute = next_bit(self.minutes, minute)
+            if next_minute is None:
+                hour, minute = hour + 1, 0
+                continue
+            return datetime.datetime(year, month, day, hour, next_minute, self.second)
+        raise ValueError(f'cron expression {self.expression!r} never fires')
+
+    def localize(self, local):
+        try:
+            return self.tz.localize(local, is_dst=None)
+        except pytz.exceptions.AmbiguousTimeError:
+            return self.tz.localize(local, is_dst=True)
+        except pytz.exceptions.NonExistentTimeError:
+            return self.tz.normalize(self.tz.localize(local, is_dst=False))
+
+    def next_fires(self, after, count):
+        fires = []
+        local = datetime.datetime.fromtimestamp(after, self.tz).replace(tzinfo=None)
+        while len(fires) < count:
+            local = self.next_local(local)
+            fire = self.localize(local).timestamp()
+            if fire > after:
+                fires.append(fire)
+                after = fire
+        return fires
+
+    def next_fire(self, after):
+        return self.next_fires(after, 1)[0]
+
+
+def schedule_from_response(response):
+    schedule = {
+        'timezone': response.get('timezone', 'Europe/Vienna'),
+        'second': 0,
+        'spread': response.get('spread') or 0,
+    }
+    if response.get('cron'):
+        schedule['cron'] = response['cron']
+        return schedule
+    if 'scheduled_at_day' in response:
+        scheduled_at = response.get('scheduled_at_time') or response['scheduled_at']
+        day = response['scheduled_at_day']
+    else:
+        scheduled_at = response['scheduled_at']
+        day = '*'
+    try:
+        scheduled_at_t = datetime.datetime.strptime(scheduled_at, '%H:%M:%S%z').timetz()
+    except ValueError:
+        scheduled_at_t = datetime.datetime.strptime(scheduled_at, '%H:%M:%S').timetz()
+    if scheduled_at_t.tzinfo is not None:
+        schedule['utc_offset'] = int(scheduled_at_t.utcoffset().total_seconds() // 60)
+    schedule['cron'] = f'{scheduled_at_t.minute} {scheduled_at_t.hour} {day} * *'
+    schedule['second'] = scheduled_at_t.second
+    return schedule
+
+
+def spread_offset(flow_name, spread):
+    if not spread:
+        return 0
+    digest = hashlib.sha256(flow_name.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % int(spread)
+
+
+def cron_from_schedule(schedule):
+    if schedule.get('utc_offset') is not None:
+        timezone = pytz.FixedOffset(schedule['utc_offset'])
+    else:
+        timezone = schedule.get('timezone', 'Europe/Vienna')
+    return Cron(schedule['cron'], timezone, schedule.get('second', 0))
+
+
+def next_fire(schedule, after, crons):
+    """
+    Return the first fire time of `schedule` after the timestamp `after`.
+    Compiled cron expressions are cached in `crons`.
+    """
+    if 'interval' in schedule:
+        # the start of interval schedules already includes the offset
+        interval = schedule['interval']
+        start = schedule['start']
+        iterations = int((after - start) // interval) + 1
+        return start + max(iterations, 0) * interval
+    key = (schedule['cron'], schedule.get('timezone'), schedule.get('utc_offset'), schedule.get('second'))
+    cron = crons.get(key)
+    if cron is None:
+        cron = crons[key] = cron_from_schedule(schedule)
+    offset = spread_offset(schedule['flow_name'], schedule.get('spread'))
+    return cron.next_fire(after - offset) + offset
+
+
+def load_state(setting):
+    state = setting.get('value') if setting.exists() else None
+    state = state or {}
+    state.setdefault('schedules', {})
+    state.setdefault('heap', [])
+    return state
+
+
+def runner_alive(system, runner_id):
+    if runner_id is None:
+        return False
+    try:
+        status = system.execution(runner_id).get('status')
+    except Exception:
+        return False
+    return status not in ('ENDED_SUCCESS', 'ENDED_ERROR', 'ENDED_CANCELLED')
+
+
+def handler(system: flow_api.System, this: flow_api.Execution):
+    """
+    Start the child executions of many schedules from one execution.
+
+    All schedules live in a single setting together with a min-heap of
+    [next fire time, schedule id] pairs. The scheduler sleeps until the
+    earliest entry is due, starts every due child in one batch and saves the
+    setting once per batch, so it uses one execution regardless of the
+    number of schedules.
+
+    Registrations also write a new revision to the small "<setting>.revision"
+    setting. While nothing is due the scheduler only polls the revision and
+    reloads the schedules when it changed.
+    """
+    inputs = this.get('input_value') or {}
+    setting_name = inputs.get('setting_name', DEFAULT_SETTING)
+    poll_interval = inputs.get('poll_interval', DEFAULT_POLL_INTERVAL)
+    setting = system.setting(setting_name)
+    revision_setting = system.setting(f'{setting_name}.revision')
+
+    if 'add' in inputs or 'remove' in inputs:
+        setting.acquire(timeout=None)
+        try:
+            state = load_state(setting)
+            # the runner sleeps until the earliest entry, or polls earlier
+            wakes_at = min(state['heap'][0][0] if state['heap'] else math.inf, time.time() + poll_interval)
+            earlier = False
+            if 'add' in inputs:
+                # a list adds many schedules with one write of the setting
+                adds = inputs['add'] if isinstance(inputs['add'], list) else [inputs['add']]
+                schedule_ids = []
+                for add in adds:
+                    schedule_id = str(uuid.uuid4())
+                    schedule = dict(add)
+                    schedule.setdefault('iterations', 0)
+                    if 'fire_at' in schedule:
+                        # one-off entries due in the same second start in one batch
+                        schedule['fire_at'] = math.ceil(schedule['fire_at'])
+                        schedule['max_iterations'] = 1
+                    if 'start' not in schedule:
+                        schedule['start'] = time.time()
+                        if 'interval' in schedule and schedule.get('spread'):
+                            # iterations start at the offset of the flow within the interval
+                            phase = spread_offset(schedule['flow_name'], min(schedule['spread'], schedule['interval']))
+                            schedule['start'] += (phase - schedule['start']) % schedule['interval']
+                    if 'interval' not in schedule and 'cron' not in schedule and 'fire_at' not in schedule:
+                        schedule.update(schedule_from_response(schedule))
+                    state['schedules'][schedule_id] = schedule
+                    if 'interval' in schedule:
+                        # like Recurring, the first iteration starts right away
+                        first = schedule['start']
+                    elif 'fire_at' in schedule:
+                        first = schedule['fire_at']
+                    else:
+                        first = next_fire(schedule, time.time(), {})
+                    heapq.heappush(state['heap'], [first, schedule_id])
+                    earlier = earlier or first < wakes_at
+                    schedule_ids.append(schedule_id)
+                if isinstance(inputs['add'], list):
+                    this.save(output_value={'schedule_ids': schedule_ids})
+                else:
+                    this.save(output_value={'schedule_id': schedule_id})
+            else:
+                schedule_id = inputs['remove']
+                state['schedules'].pop(schedule_id, None)
+                # stale heap entries are dropped when they become due
+            # a sleeping runner would start a schedule due before it wakes
+            # late; a new runner takes over and the old one exits
+            if state['schedules'] and (earlier or not runner_alive(system, state.get('runner'))):
+                runner = this.flow(
+                    'Scheduler',
+                    name='Scheduler',
+                    setting_name=setting_name,
+                    poll_interval=poll_interval,
+                    wait=False,
+                )
+                state['runner'] = runner.get('id')
+            setting.save(value=state)
+            revision_setting.save(value=str(uuid.uuid4()))
+        finally:
+            setting.release()
+        if 'add' in inputs:
+            if len(schedule_ids) > 1:
+                return this.success(f'added {len(schedule_ids)} schedules')
+            return this.success(f'added schedule {schedule_id}')
+        return this.success(f'removed schedule {schedule_id}')
+
+    dispatched = 0
+    crons = {}
+    state = None
+    revision = None
+    while True:
+        now = time.time()
+        current_revision = revision_setting.get('value') if revision_setting.exists() else None
+        if state is None or current_revision != revision or (state['heap'] and state['heap'][0][0] <= now):
+            setting.acquire(timeout=None)
+            try:
+                state = load_state(setting)
+                revision = current_revision
+                if state.get('runner') not in (None, this.get('id')):
+                    # superseded by a newer runner
+                    break
+                if not state['schedules']:
+                    state['runner'] = None
+                    setting.save(value=state)
+                    break
+                heap = state['heap']
+                batch = []
+                while heap and heap[0][0] <= now:
+                    fire_at, schedule_id = heapq.heappop(heap)
+                    schedule = state['schedules'].get(schedule_id)
+                    if schedule is not None:
+                        batch.append((schedule_id, schedule))
+                for schedule_id, schedule in batch:
+                    schedule['iterations'] += 1
+                    iterations = schedule['iterations']
+                    max_iterations = schedule.get('max_iterations')
+                    child_inputs = dict(schedule.get('inputs') or {})
+                    child_inputs.update({
+                        'start': schedule['start'],
+                        'iterations': iterations,
+                        'max_iterations': max_iterations,
+                    })
+                    this.flow(
+                        schedule['flow_name'],
+                        inputs=child_inputs,
+                        name=f'{schedule["flow_name"]} iteration #{iterations}',
+                        wait=False,
+                    )
+                    dispatched += 1
+                    if max_iterations is not None and iterations >= max_iterations:
+                        del state['schedules'][schedule_id]
+                    else:
+                        heapq.heappush(heap, [next_fire(schedule, now, crons), schedule_id])
+                if not state['schedules']:
+                    # the last schedule has fired
+                    state['runner'] = None
+                    setting.save(value=state)
+                    break
+                if batch:
+                    setting.save(value=state)
+            finally:
+                setting.release()
+            this.save(output_value={
+                'schedules': len(state['schedules']),
+                'dispatched': dispatched,
+            })
+        wake_at = now + poll_interval
+        if state['heap']:
+            wake_at = min(wake_at, state['heap'][0][0])
+        this.save(message=datetime.datetime.fromtimestamp(wake_at, datetime.timezone.utc).isoformat(sep=' ', timespec='minutes'))
+        this.sleep_until(wake_at)
+
+    return this.success(f'dispatched {dispatched} child executions')
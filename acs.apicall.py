@@ -20,8 +20,54 @@ outputs:
         doc: the result json of the api key as dict
 """
 
+import time
+import urllib.parse
+
 import flow_api
 
+# The shared rate limit of an endpoint, in calls per second and burst
+# size, as in the default API throttling of Cloud Stack. It is stored in the
+# setting 'rate_limit.<host>' and can be changed there.
+RATE_LIMIT = 25
+RATE_BURST = 25
+
+
+# RateLimiter is copied from loop_child, which documents it.
+class RateLimiter:
+    def __init__(self, system, name, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.setting = system.setting(f'rate_limit.{name}')
+        self.rate = rate
+        self.burst = burst
+
+    def take(self, this, tokens=1):
+        self.setting.acquire(timeout=None)
+        try:
+            now = time.time()
+            bucket = self.setting.get('value') if self.setting.exists() else None
+            if bucket is None:
+                bucket = {
+                    'rate': self.rate,
+                    'burst': self.burst,
+                    'tokens': self.burst,
+                    'updated_at': now,
+                }
+            refilled = bucket['tokens'] + (now - bucket['updated_at']) * bucket['rate']
+            bucket['tokens'] = min(bucket['burst'], refilled) - tokens
+            bucket['updated_at'] = now
+            self.setting.save(value=bucket)
+        finally:
+            self.setting.release()
+        if bucket['tokens'] < 0:
+            this.sleep(-bucket['tokens'] / bucket['rate'])
+
+
+def endpoint_host(endpoint):
+    # an endpoint given without a scheme is still parsed as host and path
+    if '//' not in endpoint:
+        endpoint = f'//{endpoint}'
+    return urllib.parse.urlsplit(endpoint).hostname
+
+
 def handler(system: flow_api.System, this: flow_api.Execution):
     # retrieve the necessary inputs and store them in local variables
     inputs = this.get('input_value')
@@ -39,6 +85,9 @@ def handler(system: flow_api.System, this: flow_api.Execution):
         name=f'sign {command.get("command")}',
     ).get('output_value')['query_str']
 
+    # wait until the rate limit of the endpoint allows another call
+    RateLimiter(system, endpoint_host(compute_endpoint)).take(this)
+
     # make the actual call using cloudomation REST task
     result = this.task(
         'REST',
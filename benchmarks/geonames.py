@@ -0,0 +1,119 @@
+"""
+Replay loop_parent, loop_child and acs.apicall against a simulated geonames
+in the local engine. These runs produced the numbers quoted for the
+loop_parent and rate limit changes::
+
+    python benchmarks/geonames.py
+
+Every REST call takes 0.25 to 0.75 virtual seconds; a country named
+'Nowhere' is unknown to geonames.
+"""
+
+import os
+import random
+import sys
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flow_api_local import Engine, RestBackend  # noqa: E402
+
+
+START = 1_800_000_000
+
+
+def geonames(inputs):
+    url = inputs['url']
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    if '/countryInfo' in url:
+        return {'json': {'geonames': [{
+            'capital': 'Capital of ' + query['country'],
+            'continentName': 'Europe',
+            'population': 1,
+            'areaInSqKm': 2,
+        }]}}
+    name = query['name']
+    if query.get('featureCode') == 'PCLI':
+        if name == 'Nowhere':
+            return {'json': {'geonames': [], 'totalResultsCount': 0}}
+        return {'json': {'geonames': [{'countryCode': name}], 'totalResultsCount': 1}}
+    return {'json': {'geonames': [{'lat': '1.5', 'lng': '2.5', 'name': name}]}}
+
+
+def make_engine(countries, latency=0.5, seed=1):
+    rnd = random.Random(seed)
+    rest = RestBackend(latency=lambda inputs: latency * (0.5 + rnd.random()))
+    rest.route(r'api\.geonames\.org', geonames)
+    engine = Engine(start=START, backends={'REST': rest})
+    names = [f'Country{i}' for i in range(countries)] + ['Nowhere']
+    engine.system.setting('geonames_countrynames').save(value=names)
+    return engine, rest
+
+
+def loop_parent(countries, max_workers=10):
+    engine, rest = make_engine(countries)
+    wall_start = time.perf_counter()
+    execution = engine.run('loop_parent', {'max_workers': max_workers})
+    virtual = engine.clock.time() - START
+    print(
+        f'loop_parent {countries} countries:',
+        execution.get('status'),
+        f'virtual {virtual:.1f}s',
+        f'rest calls {rest.calls}',
+        f'calls/s {rest.calls / virtual:.1f}',
+        f'wall {time.perf_counter() - wall_start:.2f}s',
+    )
+    # a second run is answered from the cache
+    calls = rest.calls
+    engine.run('loop_parent', {'max_workers': max_workers})
+    print(f'  second run: rest calls {rest.calls - calls}')
+    engine.close()
+
+
+def resume(countries=3000, cancel_after=120):
+    engine, _ = make_engine(countries)
+    execution = engine.run('loop_parent', until=START + cancel_after)
+    engine.cancel(execution)
+    engine.drive()
+    progress = engine.system.setting('geonames_countrynames.progress').get('value')
+    print(f'resume {countries} countries cancelled after {cancel_after}s: {countries + 1 - len(progress["done"])} left')
+    engine.close()
+
+
+ACS_BURST = '''
+import flow_api
+
+def handler(system: flow_api.System, this: flow_api.Execution):
+    calls = [
+        this.flow(
+            'acs.apicall',
+            inputs={
+                'command': {'command': 'listVirtualMachines', 'apikey': 'key'},
+                'secret': 'secret',
+                'compute_endpoint': 'https://cloud.example.com/client/api',
+            },
+            run=False,
+        ).run_async()
+        for _ in range(100)
+    ]
+    this.wait_for(*calls)
+    return this.success('all done')
+'''
+
+
+def acs_rate():
+    rest = RestBackend(latency=0.1)
+    rest.route(r'cloud\.example\.com', {'ok': True})
+    engine = Engine(start=START, backends={'REST': rest})
+    engine.system.flow('acs burst').save(script=ACS_BURST)
+    execution = engine.run('acs burst')
+    print(f'acs.apicall 100 calls: {execution.get("status")} virtual {engine.clock.time() - START:.1f}s')
+    engine.close()
+
+
+if __name__ == '__main__':
+    for countries in (200, 1000):
+        loop_parent(countries)
+    resume()
+    acs_rate()
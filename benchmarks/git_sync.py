@@ -0,0 +1,196 @@
+"""
+Replay the github sync flows against local git repositories in the local
+engine. These runs produced the numbers quoted for the mirror, webhook and
+multi-repository changes::
+
+    python benchmarks/git_sync.py [mirror] [webhooks] [repositories]
+
+Requires git.
+"""
+
+import base64
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flow_api_local import Engine, Execution, GitBackend, MirrorGitBackend, RestBackend  # noqa: E402
+
+
+def git(repository, *args):
+    return subprocess.run(
+        ['git', '-C', repository, *args],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout.decode().strip()
+
+
+def init(branch='master'):
+    repository = tempfile.mkdtemp()
+    git(repository, 'init', '-q', '-b', branch)
+    git(repository, 'config', 'user.email', 'benchmark@example.com')
+    git(repository, 'config', 'user.name', 'benchmark')
+    return repository
+
+
+def write(repository, path, content):
+    path = os.path.join(repository, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb' if isinstance(content, bytes) else 'w') as f:
+        f.write(content)
+
+
+def commit(repository, message='commit'):
+    git(repository, 'add', '-A')
+    git(repository, 'commit', '-q', '-m', message)
+    return git(repository, 'rev-parse', 'HEAD')
+
+
+class FixedGit(GitBackend):
+    """Serve every GIT task from `repository`, whatever its url."""
+
+    def __init__(self, repository, latency=0.0):
+        super().__init__(latency)
+        self.repository = repository
+
+    def _repository(self, inputs):
+        return self.repository
+
+
+def github_rest(repository, latency=0.0):
+    """Answer the github compare and contents api from `repository`."""
+    rest = RestBackend(latency=latency)
+
+    def compare(inputs):
+        base, head = re.search(r'compare/(\w+)\.\.\.(\w+)', inputs['url']).groups()
+        merge_base = git(repository, 'merge-base', base, head)
+        if base == head:
+            status = 'identical'
+        elif merge_base == base:
+            status = 'ahead'
+        else:
+            status = 'behind' if merge_base == head else 'diverged'
+        files = []
+        for line in git(repository, 'diff', '--name-status', '-M', merge_base, head).splitlines():
+            change, *paths = line.split('\t')
+            if change.startswith('R'):
+                files.append({'filename': paths[1], 'previous_filename': paths[0], 'status': 'renamed'})
+            else:
+                files.append({'filename': paths[0], 'status': {'A': 'added', 'M': 'modified', 'D': 'removed'}[change]})
+        return {'json': {'status': status, 'files': files}}
+
+    def contents(inputs):
+        path, ref = re.search(r'contents/(.+)\?ref=(\w+)', inputs['url']).groups()
+        path = urllib.parse.unquote(path)
+        data = subprocess.run(['git', '-C', repository, 'show', f'{ref}:{path}'], stdout=subprocess.PIPE).stdout
+        return {'json': {'content': base64.encodebytes(data).decode()}}
+
+    rest.route(r'/compare/', compare)
+    rest.route(r'/contents/', contents)
+    return rest
+
+
+def mirror(pushes=6):
+    """Syncs of a repository with a long history, with and without a mirror."""
+    work = init('main')
+    for number in range(150):
+        for i in range(5):
+            k = (number * 7 + i) % 400
+            write(work, f'flows/f{k}.py', f'# {number} {i}\n' * 200)
+            write(work, f'files/b{k}.bin', os.urandom(20000))
+        commit(work, f'commit {number}')
+    origin = os.path.join(tempfile.mkdtemp(), 'origin.git')
+    subprocess.run(['git', 'clone', '-q', '--bare', work, origin], check=True)
+    for budget in (0, 1 << 30):
+        backend = MirrorGitBackend(tempfile.mkdtemp(), budget=budget)
+        with Engine(backends={'GIT': backend}) as engine:
+            engine.system.setting('private git repo').save(value={'repository_url': origin, 'httpCookie': None})
+            seconds = []
+            for push in range(pushes):
+                if push:
+                    write(work, f'flows/f{push}.py', f'# push {push} {budget}\n')
+                    commit(work)
+                    subprocess.run(['git', '-C', work, 'push', '-q', origin, 'main'], check=True)
+                wall_start = time.perf_counter()
+                execution = engine.run('sync flow scripts', {'json': {'commit_sha': 'main'}})
+                seconds.append(round(time.perf_counter() - wall_start, 2))
+                assert execution.get('status') == 'ENDED_SUCCESS', execution.get('message')
+        print(f'mirror budget {budget}: clones {backend.clones} fetches {backend.fetches} seconds per sync {seconds}')
+
+
+def webhooks(burst=20):
+    """A burst of pushes to sync_from_github, then pushes during a running sync."""
+    repository = init()
+    for i in range(30):
+        write(repository, f'flows/f{i}.py', f'# flow {i}\n')
+    commit(repository)
+    with Engine(backends={'GIT': FixedGit(repository, latency=3), 'REST': github_rest(repository, latency=0.5)}) as engine:
+        engine.system.setting('github_info').save(value={
+            'github_username': 'user',
+            'github_repo_name': 'repository',
+            'github_token': 'token',
+        })
+        engine.run('sync_from_github')
+
+        def push(number):
+            write(repository, f'flows/f{number}.py', f'# push {number}\n')
+            sha = commit(repository)
+            hook = Execution(
+                engine, 'FLOW', ('FLOW', 'sync_from_github'), f'webhook {number}',
+                {'json': {'ref': 'refs/heads/master', 'after': sha}},
+            )
+            engine.start(hook)
+
+        for number in range(burst):
+            push(number)
+            engine.drive(until=engine.clock.time() + 1)
+        engine.drive(until=engine.clock.time() + 30)
+        syncs = [e.get('status') for e in engine.executions_by_id.values() if (e.get('name') or '').startswith('sync ')]
+        print(f'webhooks: {burst} pushes one second apart started {len(syncs)} sync(s)')
+        push(burst)
+        engine.drive(until=engine.clock.time() + 12)
+        push(burst + 1)
+        engine.drive()
+        syncs = [e.get('status') for e in engine.executions_by_id.values() if (e.get('name') or '').startswith('sync ')][len(syncs):]
+        print(f'webhooks: a push during a running sync: {syncs}')
+
+
+def repositories(count=6):
+    """Six repositories taking 2 to 7 s per GIT task, synced by one execution."""
+    urls = []
+    for number in range(count):
+        repository = init('main')
+        directory = 'src/flows' if number == 2 else 'flows'
+        for i in range(10):
+            write(repository, f'{directory}/r{number}_f{i}.py', f'# {number} {i}\n')
+        # every repository has a flow called common
+        write(repository, f'{directory}/common.py', f'# from {number}\n')
+        write(repository, f'settings/r{number}.yaml', f'repository: {number}\n')
+        commit(repository)
+        urls.append(repository)
+    latency = {url: 2 + number for number, url in enumerate(urls)}
+    backend = GitBackend(latency=lambda inputs: latency[inputs['repository_url']])
+    with Engine(backends={'GIT': backend}) as engine:
+        value = [{'repository_url': url, 'name': f'repo{number}', 'ref': 'main'} for number, url in enumerate(urls)]
+        value[2]['paths'] = {'flow': 'src/flows'}
+        engine.system.setting('private git repo').save(value=value)
+        execution = engine.run('sync flow scripts')
+        output = execution.get('output_value')
+        print(
+            f'repositories: {execution.get("status")} {execution.get("message")!r}',
+            f'in {output["seconds"]:.0f}s,',
+            f'{sum(r["seconds"] for r in output["repositories"].values()):.0f}s one after another',
+        )
+        for name, result in sorted(output['repositories'].items()):
+            print(f'  {name}: {result["status"]} {result["seconds"]:.0f}s collisions {result.get("collisions")}')
+
+
+if __name__ == '__main__':
+    benchmarks = {'mirror': mirror, 'webhooks': webhooks, 'repositories': repositories}
+    for name in sys.argv[1:] or benchmarks:
+        benchmarks[name]()
@@ -6,7 +6,8 @@
 
 # The Cloudomation webhook is set to trigger a flow script that synchronises
 # flow scripts and settings from a github repo to Cloudomation whenever there
-# is a push to the github repository.
+# is a push to the github repository. A burst of pushes starts only one
+# sync of the newest commit, see "sync_from_github".
 
 # If you have a setting called "github_info", this flow script will assume that
 # it contains three values: your github username, the name of the github repo
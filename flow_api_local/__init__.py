@@ -0,0 +1,47 @@
+"""
+flow_api_local - run the flow scripts of this library in-process.
+
+The package provides the same surface as Cloudomation's ``flow_api``
+(``System``, ``Execution``, ``flow_api.exceptions``) backed by an in-memory
+workspace, pluggable task backends and a virtual clock. A whole flow,
+including its child executions and sleeps, replays in milliseconds, which
+makes it possible to measure and profile the library flows without a live
+workspace.
+
+Example::
+
+    from flow_api_local import Engine, RestBackend
+
+    rest = RestBackend(latency=0.2)
+    rest.route(r'/search\\?name=Austria', {'geonames': [...]})
+    engine = Engine(backends={'REST': rest})
+    execution = engine.run('loop_parent')
+
+Creating an ``Engine`` registers this package as ``flow_api`` in
+``sys.modules``, so flow scripts import it unchanged.
+"""
+
+from . import exceptions
+from .api import (
+    Connection,
+    Execution,
+    File,
+    Flow,
+    Message,
+    ReturnWhen,
+    Setting,
+    System,
+)
+from .backends import (
+    GitBackend,
+    InputBackend,
+    MirrorGitBackend,
+    RestBackend,
+    StubBackend,
+    TaskBackend,
+    VaultBackend,
+    default_backends,
+)
+from .clock import VirtualClock
+from .engine import Engine, install
+from .simulate import Fire, ScheduleReport, simulate
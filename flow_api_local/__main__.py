@@ -0,0 +1,73 @@
+"""
+Run a library flow locally::
+
+    python -m flow_api_local loop_parent --input countryname=Austria
+    python -m flow_api_local Recurring --responses responses.yaml --until 86400 --profile
+
+`--responses` is a yaml file mapping message subjects to form responses,
+`--settings` a yaml file mapping setting names to values.
+"""
+
+import argparse
+import cProfile
+import pstats
+import time
+
+import yaml
+
+from .engine import Engine
+
+
+def _key_value(text):
+    key, _, value = text.partition('=')
+    return key, yaml.safe_load(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m flow_api_local')
+    parser.add_argument('flow_name')
+    parser.add_argument('--input', type=_key_value, action='append', default=[], metavar='KEY=VALUE')
+    parser.add_argument('--library', help='directory containing the flow scripts')
+    parser.add_argument('--responses', help='yaml file: message subject -> response')
+    parser.add_argument('--settings', help='yaml file: setting name -> value')
+    parser.add_argument('--until', type=float, help='stop after this many virtual seconds')
+    parser.add_argument('--echo', action='store_true', help='print log lines')
+    parser.add_argument('--profile', action='store_true', help='print a cProfile summary')
+    args = parser.parse_args(argv)
+
+    responses = {}
+    if args.responses:
+        with open(args.responses) as f:
+            responses = yaml.safe_load(f) or {}
+    engine = Engine(library=args.library, responses=responses, echo=args.echo)
+    if args.settings:
+        with open(args.settings) as f:
+            for name, value in (yaml.safe_load(f) or {}).items():
+                engine.system.setting(name).save(value=value)
+
+    until = None
+    if args.until is not None:
+        until = engine.clock.time() + args.until
+    virtual_start = engine.clock.time()
+    profiler = cProfile.Profile() if args.profile else None
+    wall_start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    execution = engine.run(args.flow_name, input_value=dict(args.input), until=until, strict=False)
+    if profiler:
+        profiler.disable()
+    wall = time.perf_counter() - wall_start
+
+    print(f'status:     {execution.get("status")}')
+    print(f'message:    {execution.get("message")}')
+    print(f'output:     {execution.get("output_value")}')
+    print(f'executions: {len(engine.executions_by_id)}')
+    print(f'virtual:    {engine.clock.time() - virtual_start:.3f}s')
+    print(f'wall:       {wall * 1000:.1f}ms')
+    if profiler:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    engine.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,524 @@
+"""
+The ``System`` and ``Execution`` objects handed to flow script handlers, and
+the workspace objects (settings, files, flows, connections, messages) they
+give access to.
+
+All state lives in the owning :class:`flow_api_local.engine.Engine`; the
+objects here are thin handles, just like the ones of the real flow_api.
+"""
+
+import base64
+import copy
+import datetime
+import uuid
+
+from .exceptions import (
+    DependencyFailedError,
+    LockTimeoutError,
+    NotFoundError,
+)
+
+
+class ReturnWhen:
+    ALL_ENDED = 'ALL_ENDED'
+    ALL_SUCCEEDED = 'ALL_SUCCEEDED'
+    FIRST_ENDED = 'FIRST_ENDED'
+    FIRST_SUCCEEDED = 'FIRST_SUCCEEDED'
+
+
+ENDED_STATUSES = ('ENDED_SUCCESS', 'ENDED_ERROR', 'ENDED_CANCELLED')
+
+
+def _new_id() -> str:
+    return str(uuid.uuid4())
+
+
+def _pick(record: dict, keys: tuple):
+    if not keys:
+        return dict(record)
+    if len(keys) == 1:
+        return record.get(keys[0])
+    return tuple(record.get(key) for key in keys)
+
+
+def _timestamp(value) -> float:
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return float(value)
+
+
+class _Object:
+    """Handle of a named workspace object."""
+
+    _kind = None
+
+    def __init__(self, engine, name, execution=None):
+        self._engine = engine
+        self._name = name
+        self._execution = execution
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self._name!r}>'
+
+    def _store(self) -> dict:
+        return self._engine.store(self._kind)
+
+    def _record(self) -> dict:
+        try:
+            return self._store()[self._name]
+        except KeyError:
+            raise NotFoundError(f'{self._kind} {self._name!r} does not exist') from None
+
+    def exists(self) -> bool:
+        return self._name in self._store()
+
+    def get(self, *keys):
+        return _pick(self._record(), keys)
+
+    load = get
+
+    def save(self, **fields):
+        now = self._engine.clock.time()
+        store = self._store()
+        record = store.get(self._name)
+        if record is None:
+            record = store[self._name] = {
+                'id': _new_id(),
+                'name': self._name,
+                'created_at': now,
+            }
+        record.update(fields)
+        record['modified_at'] = now
+        if record['name'] != self._name:
+            # saving a new name renames the object
+            store[record['name']] = store.pop(self._name)
+            self._name = record['name']
+        return self
+
+    def delete(self) -> None:
+        self._store().pop(self._name, None)
+
+    archive = delete
+
+
+class Setting(_Object):
+    _kind = 'setting'
+
+    # values are copied in and out, like they are serialised by the platform
+
+    def get(self, *keys):
+        record = dict(self._record())
+        record['value'] = copy.deepcopy(record.get('value'))
+        return _pick(record, keys)
+
+    load = get
+
+    def save(self, **fields):
+        if 'value' in fields:
+            fields['value'] = copy.deepcopy(fields['value'])
+        return super().save(**fields)
+
+    def acquire(self, timeout=None):
+        """Lock the setting for the calling execution, waiting up to `timeout` seconds."""
+        if not self._engine.acquire_lock(self._name, self._execution, timeout):
+            raise LockTimeoutError(f'could not lock setting {self._name!r} within {timeout} seconds')
+        return self
+
+    def release(self):
+        self._engine.release_lock(self._name, self._execution)
+        return self
+
+
+class File(_Object):
+    _kind = 'file'
+
+    def save(self, content=None, convert_binary=True, text=None, **fields):
+        if text is not None:
+            fields['data'] = text.encode()
+        elif content is not None:
+            if isinstance(content, str) and not convert_binary:
+                # content is passed base64 encoded
+                content = base64.b64decode(content)
+            elif isinstance(content, str):
+                content = content.encode()
+            fields['data'] = bytes(content)
+        if 'data' in fields:
+            fields['size'] = len(fields['data'])
+        return super().save(**fields)
+
+    def get(self, *keys):
+        record = dict(self._record())
+        data = record.get('data', b'')
+        try:
+            record['content'] = data.decode()
+        except UnicodeDecodeError:
+            record['content'] = base64.b64encode(data).decode()
+        return _pick(record, keys)
+
+    load = get
+
+
+class Flow(_Object):
+    _kind = 'flow'
+
+    def _record(self) -> dict:
+        self._engine.find_flow(self._name)
+        return super()._record()
+
+    def exists(self) -> bool:
+        return self._engine.find_flow(self._name) is not None
+
+
+class Connection(_Object):
+    _kind = 'connection'
+
+
+class Message:
+    """A message form. Answered by the engine's responder or by ``save(response=...)``."""
+
+    def __init__(self, engine, message_id, execution=None):
+        self._engine = engine
+        self._id = message_id
+        self._execution = execution
+
+    def __repr__(self):
+        return f'<Message {self._id}>'
+
+    def _record(self) -> dict:
+        try:
+            return self._engine.store('message')[self._id]
+        except KeyError:
+            raise NotFoundError(f'message {self._id!r} does not exist') from None
+
+    def exists(self) -> bool:
+        return self._id in self._engine.store('message')
+
+    def get(self, *keys):
+        return _pick(self._record(), keys)
+
+    load = get
+
+    def save(self, **fields):
+        record = self._record()
+        record.update(fields)
+        if 'response' in fields:
+            record['status'] = 'RESPONDED'
+            self._engine.notify()
+        return self
+
+    def wait(self, timeout=None):
+        record = self._record()
+        self._engine.wait_until(
+            lambda: record.get('status') == 'RESPONDED',
+            timeout=timeout,
+        )
+        return self
+
+
+class _Principal:
+    def __init__(self, name):
+        self._record = {'id': _new_id(), 'name': name}
+
+    def get(self, *keys):
+        return _pick(self._record, keys)
+
+    load = get
+
+
+class System:
+    """Workspace access for one execution."""
+
+    return_when = ReturnWhen
+
+    def __init__(self, engine, execution=None):
+        self._engine = engine
+        self._execution = execution
+
+    def _object(self, cls, name, by, **fields):
+        if by == 'id':
+            for record in self._engine.store(cls._kind).values():
+                if record['id'] == name:
+                    name = record['name']
+                    break
+            else:
+                raise NotFoundError(f'{cls._kind} with id {name!r} does not exist')
+        obj = cls(self._engine, name, self._execution)
+        if fields:
+            obj.save(**fields)
+        return obj
+
+    def _objects(self, cls):
+        return [cls(self._engine, name, self._execution) for name in list(self._engine.store(cls._kind))]
+
+    def setting(self, name=None, by='name', **fields) -> Setting:
+        return self._object(Setting, name, by, **fields)
+
+    def settings(self):
+        return self._objects(Setting)
+
+    def file(self, name=None, by='name') -> File:
+        return self._object(File, name, by)
+
+    def files(self, dir=None):
+        files = self._objects(File)
+        if dir is None:
+            return files
+        prefix = dir.rstrip('/') + '/'
+        return [f for f in files if f._name.startswith(prefix)]
+
+    def flow(self, name=None, by='name', **fields) -> Flow:
+        if by == 'name':
+            self._engine.find_flow(name)
+        return self._object(Flow, name, by, **fields)
+
+    def flows(self):
+        return self._objects(Flow)
+
+    def connection(self, name=None, by='name', **fields) -> Connection:
+        return self._object(Connection, name, by, **fields)
+
+    def connections(self):
+        return self._objects(Connection)
+
+    def message(self, message_id=None, subject=None, body=None, message_type='MESSAGE', **fields) -> Message:
+        if message_id is None:
+            message_id = self._engine.create_message(
+                subject=subject,
+                body=body or {},
+                message_type=message_type,
+                **fields,
+            )
+        return Message(self._engine, message_id, self._execution)
+
+    def messages(self):
+        return [Message(self._engine, message_id) for message_id in list(self._engine.store('message'))]
+
+    def execution(self, execution_id) -> 'Execution':
+        try:
+            return self._engine.executions_by_id[execution_id]
+        except KeyError:
+            raise NotFoundError(f'execution {execution_id!r} does not exist') from None
+
+    def executions(self):
+        return list(self._engine.executions_by_id.values())
+
+    def get_own_user(self):
+        return self._engine.user
+
+    def get_own_client(self):
+        return self._engine.client
+
+
+class Execution:
+    """
+    A flow or task execution. The instance passed to a handler as `this` is
+    also used to start children, wait, sleep and report results.
+    """
+
+    def __init__(self, engine, type_, target, name, input_value, parent=None):
+        self._engine = engine
+        self._target = target
+        self._parent = parent
+        self._children = []
+        self._process = None
+        self._waiters = set()
+        self._end_seq = None
+        self._scheduled_at = None
+        self.system = System(engine, self)
+        self._record = {
+            'id': _new_id(),
+            'name': name,
+            'type': type_,
+            'status': 'PAUSED',
+            'message': None,
+            'input_value': input_value,
+            'output_value': {},
+            'created_at': engine.clock.time(),
+            'start_time': None,
+            'end_time': None,
+            'duration': None,
+            'parent_id': parent.get('id') if parent is not None else None,
+            'logs': [],
+        }
+
+    def __repr__(self):
+        return f'<Execution {self._record["name"]!r} {self._record["status"]}>'
+
+    # -- inspection --------------------------------------------------------
+
+    def get(self, *keys):
+        return _pick(self._record, keys)
+
+    load = get
+
+    @property
+    def ended(self) -> bool:
+        return self._record['status'] in ENDED_STATUSES
+
+    @property
+    def succeeded(self) -> bool:
+        return self._record['status'] == 'ENDED_SUCCESS'
+
+    # -- reporting ---------------------------------------------------------
+
+    def save(self, **fields):
+        if 'output_value' in fields:
+            fields['output_value'] = dict(fields['output_value'] or {})
+        self._record.update(fields)
+        return self
+
+    def set_output(self, *args, **kwargs):
+        if args:
+            key, value = args
+            kwargs[key] = value
+        self._record['output_value'].update(kwargs)
+        return self
+
+    def log(self, *args, **kwargs):
+        self._engine.log(self, args, kwargs)
+        return self
+
+    def success(self, message=None):
+        self._record['status'] = 'ENDED_SUCCESS'
+        self._record['message'] = message
+        return self
+
+    def error(self, message=None):
+        self._record['status'] = 'ENDED_ERROR'
+        self._record['message'] = message
+        return self
+
+    # -- children ----------------------------------------------------------
+
+    def _start_child(self, child, run, wait):
+        self._children.append(child)
+        if not run:
+            return child
+        if wait is False:
+            return child.run_async()
+        child.run_async()
+        self.wait_for(
+            child,
+            return_when=ReturnWhen.ALL_SUCCEEDED if wait is True else wait,
+        )
+        return child
+
+    def flow(self, flow_name, name=None, inputs=None, input_value=None, run=True, wait=True, **kwargs):
+        input_value = dict(input_value or inputs or {})
+        input_value.update(kwargs)
+        child = Execution(
+            self._engine,
+            'FLOW',
+            ('FLOW', flow_name),
+            name or flow_name,
+            input_value,
+            parent=self,
+        )
+        return self._start_child(child, run, wait)
+
+    def task(self, task_type, name=None, inputs=None, input_value=None, run=True, wait=True, save=True, init=None, **kwargs):
+        input_value = dict(input_value or inputs or {})
+        input_value.update(kwargs)
+        child = Execution(
+            self._engine,
+            'TASK',
+            ('TASK', task_type),
+            name or task_type,
+            input_value,
+            parent=self,
+        )
+        return self._start_child(child, run and save, wait)
+
+    def connect(self, connection_name, name=None, run=True, wait=True, **kwargs):
+        connection = System(self._engine, self).connection(connection_name)
+        input_value = dict(connection.get('value') or {})
+        input_value.update(kwargs)
+        return self.task(
+            connection.get('connection_type'),
+            name=name or connection_name,
+            input_value=input_value,
+            run=run,
+            wait=wait,
+        )
+
+    def clone(self, name=None, run=True, wait=True, inputs=None, input_value=None, **kwargs):
+        """Start a copy of this execution with some inputs replaced."""
+        merged = dict(self._record['input_value'] or {})
+        merged.update(input_value or inputs or {})
+        merged.update(kwargs)
+        parent = self._parent or self
+        child = Execution(
+            self._engine,
+            self._record['type'],
+            self._target,
+            name or self._record['name'],
+            merged,
+            parent=parent,
+        )
+        caller = self._engine.current_execution() or parent
+        return caller._start_child(child, run, wait)
+
+    # -- running -----------------------------------------------------------
+
+    def run_async(self):
+        if self._record['status'] == 'PAUSED':
+            self._engine.start(self)
+        return self
+
+    def run(self):
+        self.run_async()
+        self.wait(return_when=ReturnWhen.ALL_SUCCEEDED)
+        return self
+
+    def wait(self, return_when=ReturnWhen.ALL_ENDED, timeout=None):
+        self.wait_for(self, return_when=return_when, timeout=timeout)
+        return self
+
+    def wait_for(self, *executions, return_when=ReturnWhen.ALL_ENDED, timeout=None):
+        """
+        Block until `executions` satisfy `return_when`. Returns the ended
+        executions in the order in which they ended.
+        """
+        executions = [e for e in executions if e is not None]
+        if return_when == ReturnWhen.ALL_ENDED or return_when == ReturnWhen.ALL_SUCCEEDED:
+            def done():
+                if return_when == ReturnWhen.ALL_SUCCEEDED:
+                    if any(e.ended and not e.succeeded for e in executions):
+                        return True
+                return all(e.ended for e in executions)
+        elif return_when == ReturnWhen.FIRST_SUCCEEDED:
+            def done():
+                return any(e.succeeded for e in executions) or all(e.ended for e in executions)
+        else:
+            def done():
+                return not executions or any(e.ended for e in executions)
+        self._engine.wait_until(done, timeout=timeout, watch=executions)
+        ended = sorted((e for e in executions if e.ended), key=lambda e: e._end_seq)
+        if return_when == ReturnWhen.ALL_SUCCEEDED:
+            for e in ended:
+                if not e.succeeded:
+                    raise DependencyFailedError(
+                        f'{e.get("name")} {e.get("status")}: {e.get("message")}',
+                        execution=e,
+                    )
+        return ended
+
+    def sleep(self, seconds):
+        self._engine.sleep_until(self._engine.clock.time() + float(seconds))
+        return self
+
+    def sleep_until(self, timestamp):
+        self._engine.sleep_until(_timestamp(timestamp))
+        return self
+
+    def cancel(self):
+        self._engine.cancel(self)
+        return self
+
+    def archive(self):
+        self._engine.executions_by_id.pop(self._record['id'], None)
+        return self
+
+    def children(self):
+        return list(self._children)
+
@@ -0,0 +1,346 @@
+"""
+Pluggable task backends of the local engine.
+
+A backend is a callable ``(this, inputs) -> output_value`` where `this` is the
+task execution. Backends never touch the network: REST answers come from
+registered routes, GIT reads local repositories, and the remaining task types
+are stubs which return canned outputs or call a user supplied function. Only
+MirrorGitBackend fetches, from whatever repository url it is given.
+
+Every backend accepts a `latency` (seconds, or a callable of the inputs)
+which is spent on the virtual clock, so fan-out and rate limits can be
+simulated realistically.
+"""
+
+import base64
+import copy
+import fnmatch
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import urllib.parse
+
+from .exceptions import TaskError
+
+
+class TaskBackend:
+    """Base class of task backends. Subclasses implement `execute`."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, this, inputs):
+        self.calls += 1
+        latency = self.latency(inputs) if callable(self.latency) else self.latency
+        if latency:
+            this.sleep(latency)
+        return self.execute(this, inputs)
+
+    def execute(self, this, inputs) -> dict:
+        raise NotImplementedError
+
+
+class StubBackend(TaskBackend):
+    """Return `output`, or the result of `handler(inputs)` if a handler is given."""
+
+    def __init__(self, handler=None, output=None, latency=0.0):
+        super().__init__(latency)
+        self.handler = handler
+        self.output = output or {}
+
+    def execute(self, this, inputs):
+        if self.handler is not None:
+            return self.handler(inputs)
+        return copy.deepcopy(self.output)
+
+
+class RestBackend(TaskBackend):
+    """
+    Answer REST tasks from registered routes.
+
+    A route is a regular expression matched against the url, and either a
+    JSON-serialisable response body or a callable ``inputs -> output_value``.
+    Responses with a status code of 400 or above fail the task, like the
+    REST task does.
+    """
+
+    def __init__(self, routes=None, latency=0.0):
+        super().__init__(latency)
+        self.routes = []
+        self.requests = []
+        for pattern, response in (routes or {}).items():
+            self.route(pattern, response)
+
+    def route(self, pattern, response, method=None, status_code=200):
+        self.routes.append((re.compile(pattern), method, response, status_code))
+        return self
+
+    def execute(self, this, inputs):
+        url = inputs.get('url', '')
+        method = inputs.get('method', 'GET').upper()
+        self.requests.append((method, url))
+        for pattern, route_method, response, status_code in self.routes:
+            if route_method is not None and route_method.upper() != method:
+                continue
+            if not pattern.search(url):
+                continue
+            if callable(response):
+                output = response(inputs)
+            else:
+                output = {
+                    'json': copy.deepcopy(response),
+                    'status_code': status_code,
+                }
+            output.setdefault('status_code', 200)
+            if 'text' not in output and 'json' in output:
+                output['text'] = json.dumps(output['json'])
+            if output['status_code'] >= 400:
+                raise TaskError(f'{method} {url} returned status {output["status_code"]}')
+            return output
+        raise TaskError(f'no route for {method} {url}')
+
+
+class GitBackend(TaskBackend):
+    """
+    Serve the GIT task from local repositories. `repository_url` must be a
+    path (or a ``file://`` url) of a git repository, bare or not.
+
+    ``get`` takes two more inputs for sparse checkouts: `sparse_paths`, a
+    list of directories or glob patterns of the files to return, and
+    `depth`, the number of commits to fetch. Local repositories are read in
+    place, so `depth` changes nothing here.
+    """
+
+    def __init__(self, latency=0.0, git='git'):
+        super().__init__(latency)
+        self.git = git
+
+    def _repository(self, inputs):
+        url = inputs.get('repository_url', '')
+        if url.startswith('file://'):
+            url = url[len('file://'):]
+        if not os.path.exists(url):
+            raise TaskError(f'repository {inputs.get("repository_url")!r} is not a local path')
+        return url
+
+    def _run(self, repository, *args) -> bytes:
+        result = subprocess.run(
+            [self.git, '-C', repository, *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode != 0:
+            raise TaskError(result.stderr.decode(errors='replace').strip())
+        return result.stdout
+
+    def execute(self, this, inputs):
+        command = inputs.get('command', 'get')
+        repository = self._repository(inputs)
+        ref = inputs.get('ref') or 'HEAD'
+        commit_sha = self._run(repository, 'rev-parse', f'{ref}^{{commit}}').decode().strip()
+        if command == 'metadata':
+            return {'commit_sha': commit_sha}
+        if command != 'get':
+            raise TaskError(f'unsupported git command {command!r}')
+        archive = tarfile.open(fileobj=io.BytesIO(self._run(repository, 'archive', '--format=tar', commit_sha)))
+        files_path = inputs.get('files_path')
+        sparse_paths = inputs.get('sparse_paths')
+        files = []
+        for member in archive.getmembers():
+            if not member.isfile():
+                continue
+            if sparse_paths and not _sparse_match(member.name, sparse_paths):
+                continue
+            data = archive.extractfile(member).read()
+            if files_path:
+                this.system.file(f'{files_path}/{member.name}').save(content=data)
+            else:
+                files.append({
+                    'name': member.name,
+                    'content': base64.b64encode(data).decode(),
+                })
+        output = {'commit_sha': commit_sha}
+        if not files_path:
+            output['files'] = files
+        return output
+
+
+class MirrorGitBackend(GitBackend):
+    """
+    Serve the GIT task from bare mirrors of the repositories, kept in
+    `mirror_dir` from task to task. The first task for a repository fetches
+    all of it, later tasks ``git fetch`` only what is new, and a task for a
+    commit sha which is in the mirror already does not fetch at all.
+
+    A mirror is keyed by the repository url and a hash of the credentials,
+    so tasks with different credentials never share one. When the mirrors
+    take more than `budget` bytes on disk, the least recently used ones are
+    removed. With a budget of 0 every task fetches the whole repository,
+    which is how a GIT task without a mirror behaves.
+
+    `repository_url` can be anything ``git fetch`` accepts, e.g. the path
+    of a local bare repository standing in for github.
+    """
+
+    def __init__(self, mirror_dir, budget=1 << 30, latency=0.0, git='git'):
+        super().__init__(latency, git)
+        os.makedirs(mirror_dir, exist_ok=True)
+        self.mirror_dir = mirror_dir
+        self.budget = budget
+        self.clones = 0
+        self.fetches = 0
+
+    def mirror_path(self, inputs) -> str:
+        credentials = json.dumps([inputs.get(key) for key in ('username', 'password', 'httpCookie')])
+        key = hashlib.sha256(f'{inputs.get("repository_url", "")}\0{credentials}'.encode()).hexdigest()
+        return os.path.join(self.mirror_dir, f'{key[:32]}.git')
+
+    def _remote(self, inputs):
+        """The url and git options to fetch with the credentials of `inputs`."""
+        url = inputs.get('repository_url', '')
+        options = []
+        parts = urllib.parse.urlsplit(url)
+        if inputs.get('username') and parts.scheme in ('http', 'https') and not parts.username:
+            userinfo = ':'.join(
+                urllib.parse.quote(value or '', safe='')
+                for value in (inputs['username'], inputs.get('password'))
+            )
+            url = parts._replace(netloc=f'{userinfo}@{parts.netloc}').geturl()
+        if inputs.get('httpCookie'):
+            options = ['-c', f'http.extraHeader=Cookie: {inputs["httpCookie"]}']
+        return url, options
+
+    def _repository(self, inputs):
+        path = self.mirror_path(inputs)
+        ref = inputs.get('ref') or 'HEAD'
+        url, options = self._remote(inputs)
+        if not os.path.isdir(path):
+            self._run(self.mirror_dir, 'init', '--quiet', '--bare', path)
+            # point HEAD of the mirror at the default branch of the remote
+            for line in self._run(path, *options, 'ls-remote', '--symref', url, 'HEAD').decode().splitlines():
+                if line.startswith('ref: '):
+                    self._run(path, 'symbolic-ref', 'HEAD', line[len('ref: '):].split('\t')[0])
+            self.clones += 1
+        elif re.fullmatch(r'[0-9a-f]{40}', ref) and self._has_commit(path, ref):
+            os.utime(path)
+            return path
+        else:
+            self.fetches += 1
+        # the url is passed on every fetch instead of being stored in the
+        # mirror, so credentials never end up on disk
+        self._run(path, *options, 'fetch', '--quiet', '--prune', url, '+refs/*:refs/*')
+        os.utime(path)
+        return path
+
+    def _has_commit(self, path, sha) -> bool:
+        try:
+            self._run(path, 'cat-file', '-e', f'{sha}^{{commit}}')
+        except TaskError:
+            return False
+        return True
+
+    def execute(self, this, inputs):
+        try:
+            return super().execute(this, inputs)
+        finally:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used mirrors until they fit into the budget."""
+        mirrors = []
+        for name in os.listdir(self.mirror_dir):
+            path = os.path.join(self.mirror_dir, name)
+            if os.path.isdir(path):
+                mirrors.append((os.stat(path).st_mtime, _disk_usage(path), path))
+        mirrors.sort()
+        total = sum(size for _, size, _ in mirrors)
+        for _, size, path in mirrors:
+            if total <= self.budget:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def _disk_usage(path) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def _sparse_match(path, sparse_paths) -> bool:
+    for pattern in sparse_paths:
+        directory = pattern.rstrip('/') + '/'
+        if path.startswith(directory) or fnmatch.fnmatchcase(path, pattern):
+            return True
+    return False
+
+
+class VaultBackend(TaskBackend):
+    """An in-memory, versioned key-value secret store behaving like the VAULT task."""
+
+    def __init__(self, secrets=None, latency=0.0):
+        super().__init__(latency)
+        self.secrets = {path: [data] for path, data in (secrets or {}).items()}
+
+    def execute(self, this, inputs):
+        path = inputs['secret_path']
+        mode = inputs.get('mode')
+        if mode == 'delete_metadata':
+            self.secrets.pop(path, None)
+            return {'result': None}
+        if mode is None and inputs.get('data') is not None:
+            mode = 'write'
+        if mode == 'write':
+            self.secrets.setdefault(path, []).append(dict(inputs['data']))
+            return {'result': {'version': len(self.secrets[path])}}
+        versions = self.secrets.get(path)
+        if not versions:
+            raise TaskError(f'secret {path!r} does not exist')
+        version = inputs.get('version') or len(versions)
+        return {
+            'result': {
+                'data': {
+                    'data': dict(versions[version - 1]),
+                    'metadata': {'version': version},
+                },
+            },
+        }
+
+
+class InputBackend(TaskBackend):
+    """Answer INPUT tasks from a dict keyed by request text, or a callable."""
+
+    def __init__(self, answers=None, latency=0.0):
+        super().__init__(latency)
+        self.answers = answers if answers is not None else {}
+
+    def execute(self, this, inputs):
+        request = inputs.get('request')
+        if callable(self.answers):
+            response = self.answers(request)
+        else:
+            response = self.answers.get(request)
+        if response is None:
+            raise TaskError(f'no answer for input request {request!r}')
+        return {'response': response}
+
+
+def default_backends() -> dict:
+    return {
+        'REST': RestBackend(),
+        'GIT': GitBackend(),
+        'SSH': StubBackend(output={'var': {}, 'report': ''}),
+        'SCP': StubBackend(),
+        'AWS': StubBackend(output={'result': {}}),
+        'GOOGLE': StubBackend(output={'result': {}}),
+        'VAULT': VaultBackend(),
+        'INPUT': InputBackend(),
+    }
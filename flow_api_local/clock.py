@@ -0,0 +1,119 @@
+"""
+Virtual clock of the local flow_api engine.
+
+Time only moves when the engine advances it, i.e. when every execution is
+blocked in ``sleep``, ``sleep_until``, ``wait_for`` or a lock and the next
+timer is due. A flow which sleeps for a month therefore finishes in
+microseconds of wall-clock time.
+
+Flow scripts which read the time themselves (``time.time()``,
+``datetime.datetime.now()``) are pointed at the virtual clock by
+:func:`patch_namespace` when the engine loads them.
+"""
+
+import datetime
+import time
+import types
+
+
+class VirtualClock:
+    """A monotonic clock counting seconds since the epoch, like ``time.time()``."""
+
+    def __init__(self, start=None):
+        if start is None:
+            start = time.time()
+        elif isinstance(start, datetime.datetime):
+            start = start.timestamp()
+        self._now = float(start)
+
+    def time(self) -> float:
+        return self._now
+
+    def datetime(self, tz=datetime.timezone.utc) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self._now, tz)
+
+    def advance_to(self, timestamp: float) -> None:
+        # the clock never runs backwards
+        if timestamp > self._now:
+            self._now = float(timestamp)
+
+    def advance(self, seconds: float) -> None:
+        self.advance_to(self._now + seconds)
+
+
+class _ModuleProxy(types.ModuleType):
+    """A stand-in for a module with some attributes replaced."""
+
+    def __init__(self, module, **overrides):
+        super().__init__(module.__name__, module.__doc__)
+        self.__dict__.update(overrides)
+        self._module = module
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+def virtual_datetime_class(clock):
+    """A ``datetime.datetime`` subclass whose ``now``/``utcnow``/``today`` read `clock`."""
+
+    class datetime_(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls.fromtimestamp(clock.time(), tz)
+
+        @classmethod
+        def utcnow(cls):
+            return cls.fromtimestamp(clock.time(), datetime.timezone.utc).replace(tzinfo=None)
+
+        @classmethod
+        def today(cls):
+            return cls.now()
+
+    datetime_.__name__ = datetime_.__qualname__ = 'datetime'
+    return datetime_
+
+
+def virtual_date_class(clock):
+    class date_(datetime.date):
+        @classmethod
+        def today(cls):
+            return cls.fromtimestamp(clock.time())
+
+    date_.__name__ = date_.__qualname__ = 'date'
+    return date_
+
+
+def virtual_time_module(clock):
+    return _ModuleProxy(
+        time,
+        time=clock.time,
+        time_ns=lambda: int(clock.time() * 1e9),
+    )
+
+
+def virtual_datetime_module(clock):
+    return _ModuleProxy(
+        datetime,
+        datetime=virtual_datetime_class(clock),
+        date=virtual_date_class(clock),
+    )
+
+
+def patch_namespace(namespace: dict, clock) -> None:
+    """
+    Point the ``time`` and ``datetime`` names a flow script imported at
+    `clock`, so code like ``time.time()`` or ``datetime.now(timezone.utc)``
+    follows virtual time. Both ``import datetime`` and
+    ``from datetime import datetime`` forms are handled.
+    """
+    replacements = {}
+    for name, value in namespace.items():
+        if value is time:
+            replacements[name] = virtual_time_module(clock)
+        elif value is datetime:
+            replacements[name] = virtual_datetime_module(clock)
+        elif value is datetime.datetime:
+            replacements[name] = virtual_datetime_class(clock)
+        elif value is datetime.date:
+            replacements[name] = virtual_date_class(clock)
+    namespace.update(replacements)
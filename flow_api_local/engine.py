@@ -0,0 +1,425 @@
+"""
+The in-process engine which runs flow scripts against the local flow_api.
+
+Every execution (flow or task) runs in its own thread, but only one thread
+runs at any time: the engine hands a baton from execution to execution, so a
+run is deterministic and needs no locking in the handlers. When every
+execution is blocked the engine advances the virtual clock to the next timer.
+
+Usage::
+
+    engine = Engine(responses={'Recurring execution': {'flow_name': 'ping'}})
+    execution = engine.run('loop_parent')
+    execution.get('status'), execution.get('output_value')
+"""
+
+import collections
+import heapq
+import itertools
+import os
+import threading
+import traceback
+
+from . import api
+from .api import Execution, System, _Principal
+from .backends import default_backends
+from .clock import VirtualClock, patch_namespace
+from .exceptions import DeadlockError, ExecutionCancelled, NotFoundError, TaskError
+
+
+LIBRARY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _Process:
+    """The thread which runs one execution."""
+
+    def __init__(self, engine, execution):
+        self.engine = engine
+        self.execution = execution
+        self.resume = threading.Semaphore(0)
+        self.queued = False
+        self.finished = False
+        self.cancelled = False
+        self.cancel_raised = False
+        # the time the last sleep of this execution was due
+        self.deadline = None
+        self.thread = threading.Thread(
+            target=self._main,
+            name=f'execution {execution.get("name")}',
+            daemon=True,
+        )
+
+    def _main(self):
+        engine = self.engine
+        execution = self.execution
+        engine._tls.process = self
+        self.resume.acquire()
+        try:
+            if self.cancelled:
+                self.cancel_raised = True
+                raise ExecutionCancelled()
+            engine._run_target(execution)
+            if execution.get('status') == 'RUNNING':
+                execution.success()
+        except ExecutionCancelled:
+            execution.save(status='ENDED_CANCELLED', message='cancelled')
+        except Exception as err:
+            execution.save(status='ENDED_ERROR', message=f'{type(err).__name__}: {err}')
+            engine.log(execution, (traceback.format_exc(),), {})
+        finally:
+            self.finished = True
+            engine._finish(execution)
+            engine._driver.release()
+
+
+class Engine:
+    """
+    Holds the workspace (settings, files, flows, connections, messages), the
+    virtual clock and all executions.
+
+    :param library: directory from which flow scripts are loaded by name,
+        defaults to the root of this repository
+    :param start: start time of the virtual clock (timestamp or datetime)
+    :param backends: task type -> backend, merged over the default backends
+    :param responses: answers for message forms, either a dict keyed by
+        subject or a callable ``(subject, body) -> response or None``
+    :param echo: print every ``this.log`` line
+    """
+
+    def __init__(self, library=None, start=None, backends=None, responses=None, echo=False, user='local', client='local'):
+        install()
+        self.library = library or LIBRARY_PATH
+        self.clock = VirtualClock(start)
+        self.backends = default_backends()
+        self.backends.update(backends or {})
+        self.responses = responses if responses is not None else {}
+        self.echo = echo
+        self.user = _Principal(user)
+        self.client = _Principal(client)
+        self.system = System(self)
+        self.executions_by_id = {}
+        self._stores = collections.defaultdict(dict)
+        self._handlers = {}
+        self._locks = {}
+        self._ready = collections.deque()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._end_seq = itertools.count()
+        self._polling = set()
+        self._live = set()
+        self._driver = threading.Semaphore(0)
+        self._tls = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # -- workspace ---------------------------------------------------------
+
+    def store(self, kind) -> dict:
+        return self._stores[kind]
+
+    def find_flow(self, name):
+        """Return the flow record of `name`, registering a library script on first use."""
+        flows = self._stores['flow']
+        record = flows.get(name)
+        if record is None and name:
+            path = os.path.join(self.library, f'{name}.py')
+            if os.path.isfile(path):
+                with open(path, encoding='utf-8') as f:
+                    script = f.read()
+                api.Flow(self, name).save(script=script, path=path)
+                record = flows[name]
+        return record
+
+    def load_handler(self, name):
+        record = self.find_flow(name)
+        if record is None:
+            raise NotFoundError(f'flow {name!r} does not exist')
+        script = record['script']
+        key = (name, script)
+        handler = self._handlers.get(key)
+        if handler is None:
+            namespace = {
+                '__name__': f'flow:{name}',
+                '__file__': record.get('path', f'<flow {name}>'),
+            }
+            exec(compile(script, namespace['__file__'], 'exec'), namespace)
+            handler = self._handlers[key] = self.prepare_handler(namespace)
+        return handler
+
+    def prepare_handler(self, namespace):
+        """Hook to adapt a freshly loaded flow script namespace; returns the handler."""
+        patch_namespace(namespace, self.clock)
+        return namespace['handler']
+
+    def create_message(self, subject, body, message_type, **fields) -> str:
+        record = {
+            'id': api._new_id(),
+            'subject': subject,
+            'body': body,
+            'message_type': message_type,
+            'status': 'PENDING',
+            'response': None,
+            'created_at': self.clock.time(),
+            **fields,
+        }
+        self._stores['message'][record['id']] = record
+        response = self._respond(subject, body)
+        if response is not None:
+            record['response'] = response
+            record['status'] = 'RESPONDED'
+        return record['id']
+
+    def _respond(self, subject, body):
+        if callable(self.responses):
+            answer = self.responses(subject, body)
+        else:
+            answer = self.responses.get(subject)
+        if answer is None:
+            return None
+        response = {
+            key: prop['default']
+            for key, prop
+            in (body or {}).get('properties', {}).items()
+            if 'default' in prop
+        }
+        response.update(answer)
+        return response
+
+    def respond(self, message_id, response):
+        """Answer a message form from outside the engine."""
+        api.Message(self, message_id).save(response=response)
+
+    def log(self, execution, args, kwargs):
+        parts = [str(arg) for arg in args]
+        parts.extend(f'{key}={value!r}' for key, value in kwargs.items())
+        line = ' '.join(parts)
+        execution.get('logs').append((self.clock.time(), line))
+        if self.echo:
+            print(f'[{self.clock.datetime().isoformat(sep=" ", timespec="seconds")}] {execution.get("name")}: {line}')
+
+    # -- locks -------------------------------------------------------------
+
+    def acquire_lock(self, name, execution, timeout=None) -> bool:
+        def free():
+            owner = self._locks.get(name)
+            return owner is None or owner is execution or owner.ended
+        if not self.wait_until(free, timeout=timeout):
+            return False
+        self._locks[name] = execution
+        return True
+
+    def release_lock(self, name, execution) -> None:
+        if self._locks.get(name) is execution:
+            del self._locks[name]
+            self.notify()
+
+    # -- executions --------------------------------------------------------
+
+    def run(self, flow_name, input_value=None, name=None, until=None, strict=True) -> Execution:
+        """
+        Start `flow_name` and drive the engine until nothing is left to do,
+        or until the virtual clock reaches `until`.
+        """
+        execution = Execution(self, 'FLOW', ('FLOW', flow_name), name or flow_name, dict(input_value or {}))
+        self.start(execution)
+        self.drive(until=until, strict=strict)
+        return execution
+
+    def start(self, execution) -> None:
+        now = self.clock.time()
+        execution.save(status='RUNNING', start_time=now)
+        # remember when the starting execution meant to start this one, so
+        # schedules can be checked for drift
+        starter = self.current_process()
+        if starter is not None and starter.deadline is not None:
+            execution._scheduled_at = starter.deadline
+        else:
+            execution._scheduled_at = now
+        self.executions_by_id[execution.get('id')] = execution
+        process = execution._process = _Process(self, execution)
+        self._live.add(process)
+        process.thread.start()
+        self._wake(process)
+
+    def _run_target(self, execution):
+        kind, name = execution._target
+        if kind == 'FLOW':
+            handler = self.load_handler(name)
+            handler(execution.system, execution)
+            return
+        try:
+            backend = self.backends[name]
+        except KeyError:
+            raise TaskError(f'no backend for task type {name!r}') from None
+        output_value = backend(execution, dict(execution.get('input_value') or {}))
+        execution.save(output_value=output_value)
+
+    def _finish(self, execution):
+        now = self.clock.time()
+        execution.save(
+            end_time=now,
+            duration=now - (execution.get('start_time') or now),
+        )
+        execution._end_seq = next(self._end_seq)
+        for name, owner in list(self._locks.items()):
+            if owner is execution:
+                del self._locks[name]
+        if execution._process is not None:
+            self._live.discard(execution._process)
+        for process in execution._waiters:
+            self._wake(process)
+        self.notify()
+
+    def cancel(self, execution) -> None:
+        for child in execution.children():
+            if not child.ended:
+                self.cancel(child)
+        if execution.ended:
+            return
+        process = execution._process
+        if process is None:
+            execution.save(status='ENDED_CANCELLED', message='cancelled')
+            self._finish(execution)
+            return
+        process.cancelled = True
+        if process is self.current_process():
+            process.cancel_raised = True
+            raise ExecutionCancelled()
+        self._wake(process)
+
+    def current_process(self):
+        return getattr(self._tls, 'process', None)
+
+    def current_execution(self):
+        process = self.current_process()
+        return process.execution if process is not None else None
+
+    def close(self) -> None:
+        """Cancel everything which is still running."""
+        for process in list(self._live):
+            self.cancel(process.execution)
+        self.drive()
+
+    # -- scheduling --------------------------------------------------------
+
+    def _wake(self, process):
+        if not process.queued and not process.finished:
+            process.queued = True
+            self._ready.append(process)
+
+    def notify(self) -> None:
+        """Re-check the conditions of executions waiting for a state change."""
+        for process in list(self._polling):
+            self._wake(process)
+
+    def _add_timer(self, at, process):
+        timer = [at, next(self._timer_seq), process, True]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def _block(self, process):
+        self._driver.release()
+        process.resume.acquire()
+        if process.cancelled and not process.cancel_raised:
+            process.cancel_raised = True
+            raise ExecutionCancelled()
+
+    def wait_until(self, condition, timeout=None, watch=(), deadline=None) -> bool:
+        """
+        Block the calling execution until `condition()` is true. Returns False
+        if `timeout` seconds pass or the clock reaches `deadline` first.
+        """
+        if timeout is not None:
+            at = self.clock.time() + timeout
+            deadline = at if deadline is None else min(deadline, at)
+        if condition():
+            return True
+        process = self.current_process()
+        if process is None:
+            # called from outside the engine: drive until the condition holds
+            self.drive(until=deadline, stop=condition)
+            if deadline is not None:
+                self.clock.advance_to(deadline)
+            return condition()
+        timer = self._add_timer(deadline, process) if deadline is not None else None
+        if watch:
+            for execution in watch:
+                execution._waiters.add(process)
+        else:
+            self._polling.add(process)
+        try:
+            while not condition():
+                if deadline is not None and self.clock.time() >= deadline:
+                    return False
+                self._block(process)
+            return True
+        finally:
+            if timer is not None:
+                timer[3] = False
+            for execution in watch:
+                execution._waiters.discard(process)
+            self._polling.discard(process)
+
+    def sleep_until(self, timestamp) -> None:
+        process = self.current_process()
+        if process is not None:
+            process.deadline = timestamp
+        self.wait_until(lambda: False, deadline=timestamp)
+
+    def _advance(self, until) -> bool:
+        timers = self._timers
+        while timers and not timers[0][3]:
+            heapq.heappop(timers)
+        if not timers:
+            return False
+        at = timers[0][0]
+        if until is not None and at > until:
+            self.clock.advance_to(until)
+            return False
+        self.clock.advance_to(at)
+        while timers and timers[0][0] <= at:
+            timer = heapq.heappop(timers)
+            if timer[3]:
+                timer[3] = False
+                self._wake(timer[2])
+        return True
+
+    def drive(self, until=None, stop=None, strict=False) -> None:
+        """
+        Run executions until none is runnable and no timer is due before
+        `until`, or until `stop()` is true. With `strict`, raise
+        DeadlockError if executions are left waiting for something which can
+        never happen (e.g. an unanswered message).
+        """
+        if self.current_process() is not None:
+            raise RuntimeError('drive() must not be called from within an execution')
+        while stop is None or not stop():
+            if not self._ready:
+                if not self._advance(until):
+                    break
+                continue
+            process = self._ready.popleft()
+            process.queued = False
+            if process.finished:
+                continue
+            process.resume.release()
+            self._driver.acquire()
+        if strict and self._live and not self._timers_pending() and (stop is None or not stop()):
+            waiting = ', '.join(sorted(repr(p.execution) for p in self._live))
+            raise DeadlockError(f'executions are waiting for something that will never happen: {waiting}')
+
+    def _timers_pending(self) -> bool:
+        return any(timer[3] for timer in self._timers)
+
+
+def install():
+    """Make ``import flow_api`` resolve to the local engine."""
+    import sys
+    from . import exceptions
+    package = sys.modules[__package__]
+    sys.modules['flow_api'] = package
+    sys.modules['flow_api.exceptions'] = exceptions
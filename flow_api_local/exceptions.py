@@ -0,0 +1,44 @@
+"""
+Exceptions raised by the local flow_api engine.
+
+The names mirror ``flow_api.exceptions`` so flow scripts which catch
+e.g. ``flow_api.exceptions.DependencyFailedError`` behave the same when run
+locally.
+"""
+
+
+class FlowApiError(Exception):
+    """Base class of all errors raised by the local engine."""
+
+
+class DependencyFailedError(FlowApiError):
+    """A child execution which was waited for did not end successfully."""
+
+    def __init__(self, message, execution=None):
+        super().__init__(message)
+        self.execution = execution
+
+
+class TaskError(FlowApiError):
+    """A task backend could not fulfil a request."""
+
+
+class NotFoundError(FlowApiError):
+    """An object (flow, setting, file, ...) does not exist."""
+
+
+class LockTimeoutError(FlowApiError):
+    """A setting lock could not be acquired within the timeout."""
+
+
+class DeadlockError(FlowApiError):
+    """The engine ran out of runnable executions while some were still waiting."""
+
+
+class ExecutionCancelled(BaseException):
+    """
+    Raised inside a handler when its execution is cancelled.
+
+    Derived from BaseException so the ``except Exception`` blocks found in
+    many flow scripts do not swallow the cancellation.
+    """
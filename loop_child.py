@@ -26,10 +26,285 @@
 # runs automatically, the input list is the only thing that will change from
 # run to run so it is the most likely source of errors.
 
-# (1) Define handler function which receives the Cloudomation System
-# object (system) and an Execution object of this execution (this)
+# (1) Define a cache for the REST responses, a rate limiter for the REST
+# calls, the three steps of the lookup of a country, a pipeline which runs the
+# steps for many countries at once, and the handler function which receives
+# the Cloudomation System object (system) and an Execution object of this
+# execution (this)
+import collections
+import time
+import urllib.parse
+
 import flow_api
 
+# The geonames data hardly ever changes. REST responses are therefore cached
+# in the setting CACHE_SETTING for CACHE_TTL seconds, and shared by all
+# executions which use it. When there are more than CACHE_MAX_ENTRIES, the
+# least recently used responses are dropped.
+CACHE_SETTING = 'geonames_cache'
+CACHE_TTL = 7 * 24 * 3600
+CACHE_MAX_ENTRIES = 5000
+# Each step of the lookup runs at most STAGE_LIMITS[step] REST calls at the
+# same time.
+STAGE_LIMITS = {
+    'countrycode': 5,
+    'capital': 5,
+    'coordinates': 5,
+}
+# All executions which call the same host share one rate limit of RATE_LIMIT
+# calls per second, with bursts of up to RATE_BURST calls. The limit is
+# stored in the setting 'rate_limit.<host>' when it is first used, and can
+# be changed there.
+RATE_LIMIT = 20
+RATE_BURST = 40
+
+
+class RestCache:
+    """
+    A TTL and LRU cache of the json of REST responses, persisted in a
+    setting and keyed by the normalised url. Entries which were fetched or
+    used are written back by `save`.
+    """
+
+    def __init__(self, system, setting_name=CACHE_SETTING, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.setting = system.setting(setting_name)
+        self.entries = (self.setting.get('value') if self.setting.exists() else None) or {}
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.updated = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url):
+        # the order of the query parameters does not change the response
+        parts = urllib.parse.urlsplit(url.strip())
+        query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+        return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+
+    def lookup(self, url):
+        """The cached json of `url`, or None."""
+        key = self.key(url)
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None or now - entry['stored_at'] >= self.ttl:
+            return None
+        self.hits += 1
+        entry['used_at'] = now
+        self.updated[key] = entry
+        return entry['json']
+
+    def store(self, url, json):
+        key = self.key(url)
+        now = time.time()
+        self.misses += 1
+        self.entries[key] = self.updated[key] = {
+            'stored_at': now,
+            'used_at': now,
+            'json': json,
+        }
+
+    def counters(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def save(self):
+        if not self.updated:
+            return
+        # other executions update the cache at the same time, so the
+        # changes are merged into the latest value under the lock
+        self.setting.acquire(timeout=None)
+        try:
+            entries = (self.setting.get('value') if self.setting.exists() else None) or {}
+            entries.update(self.updated)
+            if len(entries) > self.max_entries:
+                recent = sorted(entries, key=lambda key: entries[key]['used_at'], reverse=True)
+                entries = {key: entries[key] for key in recent[:self.max_entries]}
+            self.setting.save(value=entries)
+        finally:
+            self.setting.release()
+        self.updated = {}
+
+
+class RateLimiter:
+    """
+    A token bucket shared by all executions which use the same `name`, e.g.
+    the host of an API. The bucket is kept in a setting and refills with
+    `rate` tokens per second up to `burst` tokens.
+    """
+
+    def __init__(self, system, name, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.setting = system.setting(f'rate_limit.{name}')
+        self.rate = rate
+        self.burst = burst
+
+    def take(self, this, tokens=1):
+        """Take `tokens` tokens, and sleep until the bucket had them."""
+        self.setting.acquire(timeout=None)
+        try:
+            now = time.time()
+            bucket = self.setting.get('value') if self.setting.exists() else None
+            if bucket is None:
+                # the bucket is created under the lock, so no caller can
+                # reset a bucket which another one is using
+                bucket = {
+                    'rate': self.rate,
+                    'burst': self.burst,
+                    'tokens': self.burst,
+                    'updated_at': now,
+                }
+            refilled = bucket['tokens'] + (now - bucket['updated_at']) * bucket['rate']
+            # The tokens are taken even if the bucket does not hold them
+            # yet. The bucket goes into debt and the caller sleeps until it
+            # is refilled, so whoever comes next waits behind it and the
+            # setting is locked only once per call.
+            bucket['tokens'] = min(bucket['burst'], refilled) - tokens
+            bucket['updated_at'] = now
+            self.setting.save(value=bucket)
+        finally:
+            self.setting.release()
+        if bucket['tokens'] < 0:
+            this.sleep(-bucket['tokens'] / bucket['rate'])
+
+
+# Each step takes the state of a country, and returns the url of its REST
+# call and a function which reads the response. The function updates the
+# state for the next step, or returns the result of the country.
+
+def countrycode_step(country):
+    def read(json):
+        # Check if the result contains something
+        if not json['geonames']:
+            # If it doesn't, we return an error and send back the invalid
+            # country name
+            return {'error': country['countryname']}
+        country['countrycode'] = json['geonames'][0]['countryCode']
+
+    return (
+        f'http://api.geonames.org/search?'
+        f'name={country["countryname"]}&'
+        f'featureCode=PCLI'
+        f'&type=JSON'
+        f'&username={country["username"]}'
+    ), read
+
+
+def capital_step(country):
+    def read(json):
+        country['capitalname'] = json['geonames'][0]['capital']
+
+    return (
+        f'http://api.geonames.org/countryInfo?'
+        f'country={country["countrycode"]}'
+        f'&type=JSON'
+        f'&username={country["username"]}'
+    ), read
+
+
+def coordinates_step(country):
+    def read(json):
+        # The coordinates are two values. To access them by key in the json
+        # which is returned by the geonames API, we need to loop through
+        # the result.
+        capitalcoordinates = {
+            k: float(v)
+            for k, v
+            in json['geonames'][0].items()
+            if k
+            in ('lat', 'lng')
+        }
+        return {country['capitalname']: capitalcoordinates}
+
+    return (
+        f'http://api.geonames.org/search?'
+        f'name={country["capitalname"]}&'
+        f'featureCode=PPLC'
+        f'&type=JSON'
+        f'&username={country["username"]}'
+    ), read
+
+
+class Pipeline:
+    """
+    Run items through a sequence of REST steps. Every step has a queue and
+    a limit of REST calls running at the same time, so the second step of
+    one item overlaps with the first step of the next one, and the
+    throughput is bound by the slowest step instead of the sum of all.
+    Responses found in `cache` skip the REST call, all other calls take a
+    token from `limiter` first.
+
+    `stages` is a list of (name, limit, step) tuples, see countrycode_step.
+    """
+
+    def __init__(self, system, this, cache, limiter, stages):
+        self.system = system
+        self.this = this
+        self.cache = cache
+        self.limiter = limiter
+        self.stages = stages
+
+    def run(self, items):
+        """Return {key: result} for the (key, state) pairs in `items`."""
+        queues = [collections.deque() for _ in self.stages]
+        queues[0].extend(items)
+        # REST task id -> (stage index, key, state, url, read)
+        running = {}
+        active = [0] * len(self.stages)
+        results = {}
+
+        def advance(index, key, state, read, json):
+            try:
+                result = read(json)
+            except Exception as err:
+                results[key] = {'failed': repr(err)}
+                return
+            if result is not None:
+                results[key] = result
+            elif index + 1 < len(self.stages):
+                queues[index + 1].append((key, state))
+
+        while running or any(queues):
+            # later steps go first, so items leave the pipeline early
+            calls = []
+            for index in reversed(range(len(self.stages))):
+                _, limit, step = self.stages[index]
+                while queues[index] and active[index] < limit:
+                    key, state = queues[index].popleft()
+                    url, read = step(state)
+                    json = self.cache.lookup(url)
+                    if json is not None:
+                        advance(index, key, state, read, json)
+                        continue
+                    calls.append((index, key, state, url, read))
+                    active[index] += 1
+            if calls:
+                # one token per call, taken for all calls of this round at once
+                self.limiter.take(self.this, len(calls))
+            for index, key, state, url, read in calls:
+                task = self.this.task('REST', url=url, run=False).run_async()
+                running[task.get('id')] = (index, key, state, url, read, task)
+            if not running:
+                continue
+            self.this.wait_for(
+                *(entry[-1] for entry in running.values()),
+                return_when=self.system.return_when.FIRST_ENDED,
+            )
+            for task_id, (index, key, state, url, read, task) in list(running.items()):
+                status = task.load('status')
+                if status not in ('ENDED_SUCCESS', 'ENDED_ERROR', 'ENDED_CANCELLED'):
+                    continue
+                del running[task_id]
+                active[index] -= 1
+                if status != 'ENDED_SUCCESS':
+                    # A failed lookup does not fail the whole batch: the
+                    # parent looks up only the failed countries again.
+                    results[key] = {'failed': task.load('message')}
+                    continue
+                json = task.load('output_value')['json']
+                self.cache.store(url, json)
+                advance(index, key, state, read, json)
+        return results
+
+
 def handler(system: flow_api.System, this: flow_api.Execution):
 
 # (2) Set username for geonames API
@@ -44,61 +319,58 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     # The parent execution passed inputs to this execution, therefore we
     # don't need to specify an execution ID from which to get the inputs.
     # c.get_inputs() will capture the inputs given by the parent execution.
-    countryname = this.get('input_value')['countryname']
+    # The parent either passes a single countryname, or a batch of
+    # countrynames. Looking up a batch in one execution saves the startup of
+    # an execution and the setting read above for every country.
+    inputs = this.get('input_value')
 
 # (4) call the geonames API
 
-    countrycode_response = this.task(
-        'REST',
-        url=(f'http://api.geonames.org/search?'
-             f'name={countryname}&'
-             f'featureCode=PCLI'
-             f'&type=JSON'
-             f'&username={username}')
-    ).run(
-    ).get('output_value')['json']['geonames']
-
-    # Check if the result contains something
-    if not countrycode_response:
-        # If it doesn't, we set the output to error and send back the
-        # invalid country name
-        this.save(output_value={'error': countryname})
-
-    else:
-        # If there is a valid response, we continue with the API calls
-        countrycode = countrycode_response[0]['countryCode']
-        capitalname = this.task(
-            'REST',
-            url=(f'http://api.geonames.org/countryInfo?'
-                 f'country={countrycode}'
-                 f'&type=JSON'
-                 f'&username={username}')
-        ).run(
-        ).get('output_value')['json']['geonames'][0]['capital']
-
-        capitalcoordinates_response = this.task(
-            'REST',
-            url=(f'http://api.geonames.org/search?'
-                 f'name={capitalname}&'
-                 f'featureCode=PPLC'
-                 f'&type=JSON'
-                 f'&username={username}')
-        ).run(
-        ).get('output_value')['json']['geonames'][0]
+    # Responses which are in the cache are not requested again.
+    cache = RestCache(system)
+    # The countries go through the three steps of the lookup in a pipeline:
+    # while the capital of one country is looked up, the country code of the
+    # next one is requested already.
+    # The REST calls of all loop_child executions together stay below the
+    # rate limit of the geonames API.
+    limiter = RateLimiter(system, 'api.geonames.org')
+    pipeline = Pipeline(
+        system,
+        this,
+        cache,
+        limiter,
+        [
+            ('countrycode', STAGE_LIMITS['countrycode'], countrycode_step),
+            ('capital', STAGE_LIMITS['capital'], capital_step),
+            ('coordinates', STAGE_LIMITS['coordinates'], coordinates_step),
+        ],
+    )
+    countrynames = inputs.get('countrynames', [inputs.get('countryname')])
 
-        # The coordinates are two values. To access them by key in the json
-        # which is returned by the geonames API, we need to loop through
-        # the result.
-        capitalcoordinates = {
-            k: float(v)
-            for k, v
-            in capitalcoordinates_response.items()
-            if k
-            in ('lat', 'lng')
-        }
+    start = time.time()
+    results = pipeline.run(
+        (countryname, {'countryname': countryname, 'username': username})
+        for countryname in countrynames
+    )
+    cache.save()
+
+    if 'countrynames' not in inputs:
+        result = results[inputs['countryname']]
+        if 'failed' in result:
+            return this.error(result['failed'])
+        this.save(output_value=result)
+        this.log(cache=cache.counters())
+        return this.success(message='all done')
 
 # (5) Set outputs
-        this.save(output_value={capitalname: capitalcoordinates})
+    # The results are keyed by country name. We also return how long the
+    # batch took, so that the parent can size the next batches, and how
+    # many responses came from the cache.
+    this.save(output_value={
+        'results': results,
+        'seconds': time.time() - start,
+        'cache': cache.counters(),
+    })
 
 # (6) Once we're done we end the execution.
     return this.success(message='all done')
@@ -26,8 +26,168 @@
 
 # (1) Define handler function which receives the Cloudomation System
 # object (system) and an Execution object of this execution (this)
+import collections
+import heapq
+import itertools
+import math
+import random
+import time
+
 import flow_api
 
+# The number of child executions which run at the same time, unless the
+# max_workers input says otherwise. The geonames API limits the number of
+# requests per user, and every running execution occupies the platform, so
+# we don't start all children at once.
+MAX_WORKERS = 10
+# Each child looks up a batch of countries. The batches are sized so that a
+# child runs for about TARGET_BATCH_SECONDS, based on how long the children
+# which already ended took per country.
+TARGET_BATCH_SECONDS = 60
+MAX_BATCH_SIZE = 200
+# The summary of the results so far is saved to the output every
+# SAVE_INTERVAL seconds.
+SAVE_INTERVAL = 10
+# The setting in which the progress of the loop is checkpointed.
+CHECKPOINT_SETTING = 'geonames_countrynames.progress'
+# Countries whose lookup failed are retried, at most MAX_ATTEMPTS times
+# each, after an exponentially growing delay with jitter. Retries stop when
+# ERROR_BUDGET (a share of all countries) is used up: then something else
+# is wrong, and retrying only adds load.
+MAX_ATTEMPTS = 3
+ERROR_BUDGET = 0.1
+BACKOFF_BASE = 2
+BACKOFF_MAX = 60
+# Once HEDGE_SAMPLES children ended, a child which runs longer than the 95th
+# percentile of the time per country gets a duplicate.
+HEDGE_SAMPLES = 20
+
+
+class FanOut:
+    """
+    Start `flow_name` once for every input dictionary taken from `source`,
+    with at most `max_workers` child executions running at the same time.
+    Whenever a child ends the next one is started.
+
+    Inputs can be queued again with `retry`, to start after a delay. With
+    `hedge_after`, a duplicate of a child which runs longer than expected
+    is started; the first of the two to succeed wins and the other one is
+    cancelled.
+    """
+
+    def __init__(self, system, this, flow_name, source, max_workers):
+        self.system = system
+        self.this = this
+        self.flow_name = flow_name
+        self.source = iter(source)
+        self.max_workers = max_workers
+        # [start after, sequence number, inputs]
+        self.retries = []
+        self.sequence = itertools.count()
+        self.running = {}
+        self.hedged = 0
+
+    def retry(self, inputs, delay):
+        heapq.heappush(self.retries, [time.time() + delay, next(self.sequence), inputs])
+
+    def start(self, inputs):
+        child = self.this.flow(self.flow_name, inputs=inputs, run=False).run_async()
+        child_id = child.get('id')
+        self.running[child_id] = {
+            'inputs': inputs,
+            'child': child,
+            'started_at': time.time(),
+            'twin': None,
+        }
+        return child_id
+
+    def fill(self):
+        # retries which are due go first
+        while len(self.running) < self.max_workers:
+            if self.retries and self.retries[0][0] <= time.time():
+                self.start(heapq.heappop(self.retries)[2])
+                continue
+            inputs = next(self.source, None)
+            if inputs is None:
+                break
+            self.start(inputs)
+
+    def hedge(self, hedge_after):
+        """Start duplicates of stragglers; returns when the next child becomes one."""
+        now = time.time()
+        next_check = None
+        for run in list(self.running.values()):
+            if run['twin'] is not None:
+                continue
+            limit = hedge_after(run['inputs'])
+            if limit is None:
+                continue
+            due = run['started_at'] + limit
+            if due > now:
+                next_check = due if next_check is None else min(next_check, due)
+            elif len(self.running) < self.max_workers:
+                twin_id = self.start(run['inputs'])
+                run['twin'] = twin_id
+                self.running[twin_id]['twin'] = run['child'].get('id')
+                self.hedged += 1
+        return next_check
+
+    def as_completed(self, hedge_after=None):
+        """
+        Yield (inputs, child, seconds) in the order in which the children
+        end, until all inputs and retries are done.
+        """
+        while True:
+            self.fill()
+            next_check = self.hedge(hedge_after) if hedge_after else None
+            if not self.running:
+                if not self.retries:
+                    return
+                self.this.sleep_until(self.retries[0][0])
+                continue
+            # wait until any of the running children ends, or until there is
+            # a retry or a straggler to start
+            wake_at = [at for at in (next_check, self.retries[0][0] if self.retries else None) if at is not None]
+            self.this.wait_for(
+                *(run['child'] for run in self.running.values()),
+                return_when=self.system.return_when.FIRST_ENDED,
+                timeout=max(1, math.ceil(min(wake_at) - time.time())) if wake_at else None,
+            )
+            for child_id, run in list(self.running.items()):
+                if child_id not in self.running:
+                    continue
+                status = run['child'].load('status')
+                if status not in ('ENDED_SUCCESS', 'ENDED_ERROR', 'ENDED_CANCELLED'):
+                    continue
+                del self.running[child_id]
+                twin = self.running.get(run['twin'])
+                if twin is not None:
+                    if status != 'ENDED_SUCCESS':
+                        # the duplicate may still succeed
+                        continue
+                    twin['child'].cancel()
+                    del self.running[run['twin']]
+                yield run['inputs'], run['child'], time.time() - run['started_at']
+
+
+def batches(items, max_workers, latency):
+    """
+    Split `items` into lists sized for TARGET_BATCH_SECONDS of work, using
+    the seconds per item in `latency['per_item']`, which the caller updates
+    while batches are taken. Until there is a measurement, batches hold one
+    item. A batch never holds more than its share of the remaining items,
+    so all workers stay busy until the end.
+    """
+    position = 0
+    while position < len(items):
+        per_item = latency.get('per_item')
+        size = int(TARGET_BATCH_SECONDS / per_item) if per_item else 1
+        remaining = len(items) - position
+        size = max(1, min(size, MAX_BATCH_SIZE, math.ceil(remaining / max_workers)))
+        yield items[position:position + size]
+        position += size
+
+
 def handler(system: flow_api.System, this: flow_api.Execution):
 
 # (2) Create a setting with country names
@@ -48,74 +208,164 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     # In order to get the information we want, we need to do several API calls.
     # To speed this up, we parallelise the API calls by executing them in a
     # separate flow script, which we start as child executions.
+    # We don't start one child per country at once though: the FanOut class
+    # above keeps at most max_workers children running, and starts the next
+    # child as soon as one ends. A long list of countries therefore neither
+    # floods the platform with executions, nor exceeds the request limit of
+    # the geonames API.
+
+    max_workers = (this.get('input_value') or {}).get('max_workers', MAX_WORKERS)
+
+    # A loop over thousands of countries takes a while. Its progress is
+    # checkpointed in a setting: if this execution ends before the loop is
+    # done, e.g. because it was cancelled, the next execution continues with
+    # the countries which are not done yet.
+    checkpoint = system.setting(CHECKPOINT_SETTING)
+    progress = (checkpoint.get('value') if checkpoint.exists() else None) or {}
+    done = set(progress.get('done', []))
+    remaining = [countryname for countryname in countrynames if countryname not in done]
+    if done:
+        this.log(f'resuming, {len(remaining)} of {len(countrynames)} countries left')
+
+    # FanOut returns the children in the order in which they end, so we can
+    # look at the result of each child right away, instead of waiting for the
+    # slowest one first.
+    # Starting an execution takes time, too. Instead of one country, each
+    # child gets a batch of countries. The batches grow with the measured
+    # time per country, so thousands of countries need tens of children.
+    # The inputs are passed as a dictionary: the child execution will be
+    # passed a key-value pair with countrynames as the key, and the batch
+    # of country names as the value.
+    latency = {}
+    fan_out = FanOut(
+        system,
+        this,
+        'loop_child',
+        (
+            {'countrynames': batch}
+            for batch
+            in batches(remaining, max_workers, latency)
+        ),
+        max_workers,
+    )
+
+    # A child which takes much longer than the others usually waits for a
+    # slow geonames server. Rather than waiting for it, we start the same
+    # batch a second time and use whichever child is done first.
+    def hedge_after(inputs):
+        if latency.get('p95') is None:
+            return None
+        return latency['p95'] * len(inputs['countrynames'])
+
+# (4) Get outputs of child executions, and set outputs of parent execution
+
+    # The output of this execution is a summary which grows with every child
+    # that ends: the capitals which were found, the countries which were not
+    # found, and how many geonames responses the children took from their
+    # cache. It is saved every SAVE_INTERVAL seconds, so the results so far
+    # can be looked at while the loop is still running. A resumed loop
+    # continues with the summary of the checkpoint; countries whose lookup
+    # failed are looked up again.
+    summary = progress.get('summary') or {
+        'capitals': {},
+        'invalid_countries': [],
+        'retries': 0,
+        'hedged': 0,
+        'cache': {'hits': 0, 'misses': 0},
+    }
+    summary.update({
+        'done': len(done),
+        'total': len(countrynames),
+        'failed_countries': [],
+    })
+    hedged = summary['hedged']
+    saved_at = time.time()
+    attempts = collections.Counter()
+    retry_budget = summary['retries'] + max(1, int(ERROR_BUDGET * len(remaining)))
+    # the time per country of the last children, for the hedging threshold
+    durations = collections.deque(maxlen=1000)
 
-    # We create an empty list to which we will append our child execution
-    # objects in the for loop.
-    calls = []
-
-    # We create a separate empty list to which we will append inputs that are
-    # not valid countries.
-    invalids = []
-
-    for countryname in countrynames:
-        # We call the flow script that contains the REST calls with the c.flow
-        # function. We store the execution object returned by the c.flow
-        # function in the call variable.
-        call = this.flow(
-            'loop_child',
-            # I can add any number of parameters here. As long as they are not
-            # called the same as the defined parameters for the flow function,
-            # the are appended to the input dictionary that is passed to the
-            # child execution.
-            # In this example, the child execution will be passed a key-value
-            # pair with countryname as the key, and the first value in the
-            # countryname setting as the value.
-            # If I added another argument weather = nice, a second key-value
-            # pair would be added to the input dictionary for the child
-            # execution, with the key weather and the value nice.
-            # Note that I can also pass the same input as a dictionary with the
-            # inputs parameter. The below line is equivalent to
-            # input_value = { 'countryname': countryname }
-            countryname = countryname,
-            run=False,
-        # run_async() starts the child execution and then immediately returns.
-        # This means that the for loop continues and the next child execution
-        # is started right away - the REST calls will be executed in parallel.
-        ).run_async()
-        # All execution objects are appended to the calls list.
-        calls.append(call)
-
-# (4) Wait for all child executions to finish
-
-    # Here, I tell the flow script to wait for all elements in the calls list
-    # to finish before it continues. Remember that the calls list contains all
-    # execution objects that we started in the for loop.
-    this.wait_for(*calls)
-
-# (5) Get outputs of child executions, and set outputs of parent execution
-
-    # Now, we take all the execution objects and get their outputs. Depending
-    # on whether or not there was an error, we treat the results differently.
-    for call in calls:
-        # Get all outputs from all child executions
-        result = call.load('output_value')
-        # If there was an error, append the output of the erroneous execution
-        # to our list of invalid country names.
-        if 'error' in result:
-            invalids.append(result['error'])
-        # If there was no error, we directly set the output of the flow script
-        # to the output of the child executions.
-        else:
-            this.log(result)
-
-    # The errors need a bit more processing: here, we set an output that
-    # contains the key "warning", information about the number of failed calls,
-    # and the country names for which there was an error.
+    # Now, we take the execution objects one by one and get their outputs.
+    # Depending on whether or not there was an error, we treat the results
+    # differently.
+    for inputs, call, seconds in fan_out.as_completed(hedge_after):
+        # Get the outputs of the child execution, keyed by country name
+        output = call.load('output_value') or {}
+        for counter, value in output.get('cache', {}).items():
+            summary['cache'][counter] += value
+        if output.get('results'):
+            # a moving average of the time per country sizes the next batches
+            per_item = output['seconds'] / len(output['results'])
+            latency['per_item'] = 0.7 * latency.get('per_item', per_item) + 0.3 * per_item
+            durations.append(seconds / len(inputs['countrynames']))
+            if len(durations) >= HEDGE_SAMPLES:
+                latency['p95'] = sorted(durations)[int(0.95 * (len(durations) - 1))]
+        retry = []
+        for countryname in inputs['countrynames']:
+            # A country is missing from the results if the whole child
+            # failed.
+            result = output.get('results', {}).get(countryname, {'failed': call.load('message')})
+            # If there was an error, append the erroneous country name to our
+            # list of invalid country names. Geonames does not know the
+            # country, asking again would not change that.
+            if 'error' in result:
+                summary['invalid_countries'].append(result['error'])
+                done.add(countryname)
+            # If the lookup failed, e.g. because geonames was not reachable,
+            # only this country is looked up again, as long as there are
+            # attempts and error budget left.
+            elif 'failed' in result:
+                attempts[countryname] += 1
+                if attempts[countryname] < MAX_ATTEMPTS and summary['retries'] < retry_budget:
+                    summary['retries'] += 1
+                    retry.append(countryname)
+                    continue
+                summary['failed_countries'].append(countryname)
+            # If there was no error, we add the capital to the summary.
+            else:
+                summary['capitals'].update(result)
+                done.add(countryname)
+            summary['done'] += 1
+        if retry:
+            attempt = max(attempts[countryname] for countryname in retry)
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            fan_out.retry({'countrynames': retry}, delay)
+        summary['hedged'] = hedged + fan_out.hedged
+
+        # We have everything we need from the child, so we archive it. This
+        # keeps the workspace small on big loops. Failed children are kept,
+        # so we can look into what went wrong.
+        if call.load('status') == 'ENDED_SUCCESS':
+            call.archive()
+
+        # The checkpoint is saved together with the output, so it is
+        # written in batches of many countries.
+        if time.time() - saved_at >= SAVE_INTERVAL:
+            this.save(
+                message=f'{summary["done"]}/{summary["total"]} countries',
+                output_value=summary,
+            )
+            checkpoint.save(value={'done': list(done), 'summary': summary})
+            saved_at = time.time()
+
+    this.save(output_value=summary)
+    # The loop is complete, the next execution starts from the beginning.
+    checkpoint.delete()
+
+    # The errors need a bit more processing: here, we log a warning with
+    # information about the number of failed calls, and the country names
+    # for which there was an error.
+    invalids = summary['invalid_countries']
     if len(invalids) > 0:
         this.log(
             f'warning: no information was found for {len(invalids)} countries'
         )
         this.log(invalid_countries=invalids)
+    if summary['failed_countries']:
+        this.log(
+            f'warning: the lookup failed for {len(summary["failed_countries"])} countries'
+        )
+        this.log(failed_countries=summary['failed_countries'])
 
-# (6) Once we're done we end the execution.
+# (5) Once we're done we end the execution.
     return this.success(message='all done')
@@ -4,63 +4,489 @@ inputs:
         type: str
         required: False
         doc: The commit_sha to fetch. If missing `origin/master` will be fetched.
+    - json.after:
+        type: str
+        required: False
+        doc: The commit_sha of a push event, used if json.commit_sha is missing.
+    - json.before:
+        type: str
+        required: False
+        doc: The commit_sha before the push event.
+    - json.commits:
+        type: list
+        required: False
+        doc: The commits of the push event, each with the lists of `added`,
+            `modified` and `removed` paths. If json.before is the last synced
+            commit, only these paths are synced.
+    - repository:
+        type: str
+        required: False
+        doc: The name of the repository to sync, if the "private git repo"
+            setting lists several. Passed by the execution which syncs all of
+            them.
 """
 
 import os
+import time
 import yaml
 import base64
+import hashlib
 
 import flow_api
 
+# The setting with the connection information of the repository, or a list
+# of them. Its name is also the prefix of the settings in which the state of
+# a sync is kept: "<prefix>.synced_commit" stores the sha of the last synced
+# commit, and "<prefix>.manifest" stores the content hash of every synced
+# file, by path. Files whose content did not change are not saved again.
+# With a list of repositories, the prefix is "private git repo.<name>".
+REPO_SETTING = 'private git repo'
+# The directory of each kind of object in the repository, unless the
+# repository has its own `paths`.
+PATHS = {
+    'flow': 'flows',
+    'setting': 'settings',
+    'file': 'files',
+}
+# Up to MAX_PARALLEL_SYNCS repositories of a list are synced at the same
+# time. Every object belongs to the repository which synced it first, as
+# recorded in OWNERS_SETTING, and is not overwritten by another repository.
+# A sync which fails gives up the objects it claimed, and the commit of a
+# sync with collisions is not recorded as synced, so that the collisions are
+# reported by every sync until they are resolved.
+MAX_PARALLEL_SYNCS = 4
+OWNERS_SETTING = 'private git repo.owners'
+# Push events list at most this many commits. Larger pushes are synced by
+# saving all files.
+MAX_PUSH_COMMITS = 20
+# Objects are decoded and saved by up to SAVE_WORKERS child executions of
+# this flow script at the same time, each with at least SAVE_BATCH objects.
+# Objects are deleted first, then settings are saved before the flows which
+# read them.
+SAVE_WORKERS = 8
+SAVE_BATCH = 10
+SAVE_STAGES = ('delete', 'setting', 'file', 'flow')
+# If a repository has `stream_files: true`, a sync of all files lets the
+# GIT task write them straight into the directory "<prefix>.checkout" of
+# the workspace files, instead of returning them base64 encoded in its
+# output. The files in files/ are then moved into place without passing
+# through this execution, so large binaries do not have to fit into its
+# memory. The directory is emptied before and after every such sync.
+# If a repository has `sparse_checkout: true`, only the directories of its
+# paths are fetched at the synced commit, without history. The
+# `sparse_paths` and `depth` inputs of the GIT task are only known to be
+# honoured by the GitBackend of flow_api_local, check that the GIT task of
+# your workspace supports them before turning this on.
+
+
+def object_for(path, paths=PATHS):
+    """The kind and name of the object which is synced from `path`, or None."""
+    # split the path and filename
+    path, filename = os.path.split(path)
+    # split the filename and file extension
+    name, ext = os.path.splitext(filename)
+    if path == paths['flow'] and ext == '.py':
+        return 'flow', name
+    if path == paths['setting'] and ext == '.yaml':
+        return 'setting', name
+    if path == paths['file']:
+        # we use the name with the extension
+        return 'file', filename
+    return None
+
+
+def save_object(system, kind, name, content):
+    """Create or update an object from the base64 `content`."""
+    if kind == 'flow':
+        # decode the base64 file content to text
+        text_content = base64.b64decode(content).decode()
+        # create or update Flow object
+        system.flow(name).save(script=text_content)
+    elif kind == 'setting':
+        # decode the base64 file content to text
+        text_content = base64.b64decode(content).decode()
+        # load the yaml string in the file content
+        value = yaml.safe_load(text_content)
+        # create or update Setting object
+        system.setting(name).save(value=value)
+    else:
+        # create or update File object
+        # pass the base64 encoded binary file content directly
+        system.file(name).save(content=content, convert_binary=False)
+
+
+def content_hash(content):
+    # the base64 encoding of a content is unique, so its hash identifies the
+    # content without decoding it
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def read_checkout(system, checkout_dir, path):
+    """The base64 content of the text file `path` of the checkout."""
+    text_content = system.file(f'{checkout_dir}/{path}').get('content')
+    return base64.b64encode(text_content.encode()).decode()
+
+
+def move_file(system, checkout_dir, path, name):
+    """Replace the File object `name` by the file `path` of the checkout."""
+    if system.file(name).exists():
+        system.file(name).delete()
+    # renaming the file does not load its content
+    system.file(f'{checkout_dir}/{path}').save(name=name)
+
+
+def delete_object(system, kind, name):
+    if kind == 'flow':
+        system.flow(name).delete()
+    elif kind == 'setting':
+        system.setting(name).delete()
+    else:
+        system.file(name).delete()
+
+
+def return_claims(owners_setting, repository, claimed, released):
+    """Undo the changes of a failed sync of `repository` to the owners."""
+    owners_setting.acquire(timeout=None)
+    try:
+        owners = owners_setting.get('value') if owners_setting.exists() else {}
+        for key in claimed:
+            if owners.get(key) == repository:
+                del owners[key]
+        for key in released:
+            owners.setdefault(key, repository)
+        owners_setting.save(value=owners)
+    finally:
+        owners_setting.release()
+
+
+def delete_checkout(system, checkout_dir):
+    for file_ in system.files(dir=checkout_dir):
+        file_.delete()
+
+
+# the functions which run_actions calls, by name
+OPERATIONS = {
+    'save': save_object,
+    'move': move_file,
+    'delete': delete_object,
+}
+
+
+def run_actions(system, actions):
+    """Run the [stage, operation, args] `actions` one after another."""
+    for _, operation, args in actions:
+        OPERATIONS[operation](system, *args)
+
+
+def run_stages(system, this, actions):
+    """
+    Run the [stage, operation, args] `actions` in up to SAVE_WORKERS child
+    executions of this flow script at the same time. All actions of a stage
+    end before the next stage in SAVE_STAGES starts. A stage with a single
+    batch of actions runs in this execution.
+    """
+    for stage in SAVE_STAGES:
+        batch = [action for action in actions if action[0] == stage]
+        workers = min(SAVE_WORKERS, -(-len(batch) // SAVE_BATCH))
+        if workers <= 1:
+            run_actions(system, batch)
+            continue
+        children = [
+            this.flow(
+                'sync flow scripts',
+                name=f'{stage} {worker + 1}/{workers}',
+                inputs={'actions': batch[worker::workers]},
+                run=False,
+            ).run_async()
+            for worker in range(workers)
+        ]
+        # raises if any of the children failed
+        this.wait_for(*children, return_when=system.return_when.ALL_SUCCEEDED)
+
+
+def changed_paths(push, synced_sha, commit_sha):
+    """
+    Return {path: True if added or modified, False if removed} of a push
+    event from the commit `synced_sha` to `commit_sha`, or None if the push
+    does not tell which paths changed between them.
+    """
+    if not isinstance(push, dict) or synced_sha is None or push.get('before') != synced_sha:
+        return None
+    # a forced push does not list the changes of the commits it dropped
+    if push.get('forced'):
+        return None
+    if (push.get('commit_sha') or push.get('after')) != commit_sha:
+        return None
+    commits = push.get('commits')
+    if not commits or len(commits) >= MAX_PUSH_COMMITS:
+        return None
+    if push.get('total_commits_count', len(commits)) > len(commits):
+        return None
+    changes = {}
+    # later commits win over earlier ones
+    for commit in commits:
+        for path in commit.get('added', []) + commit.get('modified', []):
+            changes[path] = True
+        for path in commit.get('removed', []):
+            changes[path] = False
+    return changes
+
+
+def repository_name(repo_info):
+    url = repo_info['repository_url'].rstrip('/')
+    return repo_info.get('name') or os.path.splitext(os.path.basename(url))[0]
+
+
+def sync_all(system, this, repositories, push):
+    """
+    Sync every repository of the list in a child execution of this flow
+    script, up to MAX_PARALLEL_SYNCS at the same time.
+    """
+    names = [repository_name(repo_info) for repo_info in repositories]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        return this.error(f'repository names are not unique: {duplicates}')
+    start = time.time()
+    pending = list(names)
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < MAX_PARALLEL_SYNCS:
+            name = pending.pop(0)
+            child = this.flow(
+                'sync flow scripts',
+                name=f'sync {name}',
+                inputs={'repository': name, 'json': push},
+                run=False,
+            ).run_async()
+            running[name] = (child, time.time())
+        this.wait_for(
+            *(child for child, _ in running.values()),
+            return_when=system.return_when.FIRST_ENDED,
+        )
+        for name, (child, started_at) in list(running.items()):
+            status = child.load('status')
+            if status not in ('ENDED_SUCCESS', 'ENDED_ERROR', 'ENDED_CANCELLED'):
+                continue
+            del running[name]
+            results[name] = {
+                'status': status,
+                'seconds': time.time() - started_at,
+                **(child.load('output_value') or {}),
+            }
+            if status != 'ENDED_SUCCESS':
+                results[name]['message'] = child.load('message')
+    this.save(output_value={
+        'repositories': results,
+        'seconds': time.time() - start,
+    })
+    failed = sorted(name for name, result in results.items() if result['status'] != 'ENDED_SUCCESS')
+    collisions = sorted(name for name, result in results.items() if result.get('collisions'))
+    if failed:
+        return this.error(f'failed to sync {failed}')
+    if collisions:
+        return this.error(f'objects of {collisions} collide with objects of other repositories')
+    return this.success('all done')
+
+
 def handler(system: flow_api.System, this: flow_api.Execution):
     """
     Clone a git repository, create Cloudomation objects from the files.
     All .py files in the flows/ subdirectory will be stored as Flows.
     All .yaml files in the settings/ subdirectory will be stored as Settings.
     All files in the files/ subdirectory will be stored as Files.
+    Objects are only saved or deleted if their files changed since the last
+    synced commit, if the push event lists the changes. Objects whose
+    content is the same as when they were last synced are skipped.
+
+    The "private git repo" setting can also be a list of repositories,
+    each with a `name`, a `ref` to sync and the `paths` of the flows,
+    settings and files directories, e.g.
+    {'flow': 'src/flows', 'setting': 'settings', 'file': 'files'}.
+    They are synced at the same time.
     """
     inputs = this.get('input_value')
+    # a child execution started by run_stages
+    if 'actions' in inputs:
+        run_actions(system, inputs['actions'])
+        return this.success(f'ran {len(inputs["actions"])} actions')
     # this flow is registered as webhook, triggered by a commit to the
     # repository. The commit sha is passed in .json.commit_sha
     # when started manually, it will sync from master
+    push = inputs.get('json')
     try:
-        ref = inputs['json']['commit_sha']
-    except (KeyError, TypeError):
+        ref = push.get('commit_sha') or push['after']
+    except (AttributeError, KeyError):
         ref = 'master'
     # read the connection information of the private repository
-    repo_info = system.setting('private git repo').get('value')
-    # the git 'get' command fetches the content of the repository.
-    # since no files_path is passed, the files will be returned in the
-    # output_value of the task
-    files = this.task(
+    repo_info = system.setting(REPO_SETTING).get('value')
+    prefix = REPO_SETTING
+    repository = None
+    if isinstance(repo_info, list):
+        repository = inputs.get('repository')
+        if repository is None:
+            return sync_all(system, this, repo_info, push)
+        for repo_info in repo_info:
+            if repository_name(repo_info) == repository:
+                break
+        else:
+            return this.error(f'repository {repository} is not in the setting {REPO_SETTING}')
+        # a push is for one of the repositories, which all sync their ref
+        ref = repo_info.get('ref', 'master')
+        prefix = f'{REPO_SETTING}.{repository}'
+    paths = {**PATHS, **repo_info.get('paths', {})}
+    checkout_dir = f'{prefix}.checkout'
+    # the git 'metadata' command resolves the ref to a commit sha
+    commit_sha = this.task(
         'GIT',
-        command='get',
+        command='metadata',
         repository_url=repo_info['repository_url'],
-        httpCookie=repo_info['httpCookie'],
+        httpCookie=repo_info.get('httpCookie'),
         ref=ref,
-    ).get('output_value')['files']
-    # iterate over all files
-    for file_ in files:
-        # split the path and filename
-        path, filename = os.path.split(file_['name'])
-        # split the filename and file extension
-        name, ext = os.path.splitext(filename)
-        if path == 'flows' and ext == '.py':
-            # decode the base64 file content to text
-            text_content = base64.b64decode(file_['content']).decode()
-            # create or update Flow object
-            system.flow(name).save(script=text_content)
-        elif path == 'settings' and ext == '.yaml':
-            # decode the base64 file content to text
-            text_content = base64.b64decode(file_['content']).decode()
-            # load the yaml string in the file content
-            value = yaml.safe_load(text_content)
-            # create or update Setting object
-            system.setting(name).save(value=value)
-        elif path == 'files':
-            # create or update File object
-            # we use the name with the extension
-            # pass the base64 encoded binary file content directly
-            system.file(filename).save(content=file_['content'], convert_binary=False)
-
+    ).get('output_value')['commit_sha']
+    # check which commit was synced last time
+    synced_commit = system.setting(f'{prefix}.synced_commit')
+    synced_sha = synced_commit.get('value') if synced_commit.exists() else None
+    if synced_sha == commit_sha:
+        this.save(output_value={'commit_sha': commit_sha})
+        return this.success(f'already in sync with {commit_sha}')
+    changes = changed_paths(push, synced_sha, commit_sha)
+    # Streaming writes the whole repository into workspace files, which
+    # only pays off when all files are synced. A sync of the changes of a
+    # push gets the files in the output and skips the unchanged ones.
+    stream_files = repo_info.get('stream_files', False) and changes is None
+    if repo_info.get('sparse_checkout', False):
+        sparse = {'sparse_paths': sorted(set(paths.values())), 'depth': 1}
+    else:
+        sparse = {}
+    if stream_files:
+        # a checkout left behind by a failed sync would be synced, too
+        delete_checkout(system, checkout_dir)
+    try:
+        if stream_files:
+            # the git 'get' command saves the files of the repository in
+            # checkout_dir, and returns no files in the output_value of the task
+            this.task(
+                'GIT',
+                command='get',
+                repository_url=repo_info['repository_url'],
+                httpCookie=repo_info.get('httpCookie'),
+                ref=commit_sha,
+                files_path=checkout_dir,
+                **sparse,
+            )
+            checkout = [
+                file_.get('name')[len(checkout_dir) + 1:]
+                for file_
+                in system.files(dir=checkout_dir)
+            ]
+            # only the flows and settings are read, the files are moved
+            contents = {
+                path: read_checkout(system, checkout_dir, path)
+                for path
+                in checkout
+                if object_for(path, paths) is not None and object_for(path, paths)[0] != 'file'
+            }
+        else:
+            # the git 'get' command fetches the content of the repository.
+            # since no files_path is passed, the files will be returned in the
+            # output_value of the task
+            files = this.task(
+                'GIT',
+                command='get',
+                repository_url=repo_info['repository_url'],
+                httpCookie=repo_info.get('httpCookie'),
+                ref=commit_sha,
+                **sparse,
+            ).get('output_value')['files']
+            checkout = [file_['name'] for file_ in files]
+            contents = {file_['name']: file_['content'] for file_ in files}
+        # read the content hashes of the files synced so far
+        manifest_setting = system.setting(f'{prefix}.manifest')
+        manifest = manifest_setting.get('value') if manifest_setting.exists() else {}
+        # with several repositories, read which repository owns which object
+        owners_setting = owners = None
+        if repository is not None:
+            owners_setting = system.setting(OWNERS_SETTING)
+            owners_setting.acquire(timeout=None)
+            owners = owners_setting.get('value') if owners_setting.exists() else {}
+        # the objects to save or delete, see run_stages
+        actions = []
+        skipped = 0
+        collisions = []
+        claimed = []
+        released = []
+        if changes is None:
+            # without a list of changes, all files are synced, and the files
+            # which were synced before but are gone now are removed
+            changes = {path: False for path in manifest}
+            changes.update((path, True) for path in checkout)
+        else:
+            # the files which were synced but are gone, or which are there
+            # but were not synced, are synced, too, whatever the push lists
+            present = set(checkout)
+            changes.update((path, False) for path in manifest if path not in present)
+            changes.update((path, True) for path in checkout if path not in manifest and path not in changes)
+        try:
+            # iterate over the changed files only
+            for path, exists in changes.items():
+                if object_for(path, paths) is None:
+                    continue
+                kind, name = object_for(path, paths)
+                if owners is not None:
+                    key = f'{kind}:{name}'
+                    owner = owners.get(key)
+                    if owner not in (None, repository):
+                        # the object was synced from another repository first
+                        collisions.append({'path': path, 'object': f'{kind} {name}', 'owner': owner})
+                        continue
+                    if exists and owner is None:
+                        owners[key] = repository
+                        claimed.append(key)
+                    elif not exists and owner is not None:
+                        del owners[key]
+                        released.append(key)
+                if exists and stream_files and kind == 'file' and path in checkout:
+                    # moving a file is cheap, so streamed files are not hashed
+                    actions.append(['file', 'move', [checkout_dir, path, name]])
+                    manifest[path] = None
+                elif exists and path in contents:
+                    digest = content_hash(contents[path])
+                    if manifest.get(path) == digest:
+                        skipped += 1
+                        continue
+                    actions.append([kind, 'save', [kind, name, contents[path]]])
+                    manifest[path] = digest
+                elif not exists:
+                    actions.append(['delete', 'delete', [kind, name]])
+                    manifest.pop(path, None)
+            # the objects are claimed before they are saved, so that no
+            # other repository saves them at the same time
+            if owners_setting is not None:
+                owners_setting.save(value=owners)
+        finally:
+            if owners_setting is not None:
+                owners_setting.release()
+        try:
+            run_stages(system, this, actions)
+        except Exception:
+            if owners_setting is not None:
+                return_claims(owners_setting, repository, claimed, released)
+            raise
+    finally:
+        if stream_files:
+            # remove what is left of the checkout, also if the sync failed
+            delete_checkout(system, checkout_dir)
+    deleted = sum(1 for stage, _, _ in actions if stage == 'delete')
+    # remember the synced commit and content for the next sync
+    manifest_setting.save(value=manifest)
+    if not collisions:
+        synced_commit.save(value=commit_sha)
+    this.save(output_value={
+        'commit_sha': commit_sha,
+        'saved': len(actions) - deleted,
+        'skipped': skipped,
+        'deleted': deleted,
+        'collisions': collisions,
+    })
     return this.success('all done')
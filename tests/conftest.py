@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flow_api_local import Engine  # noqa: E402
+
+
+START = 1_800_000_000
+
+
+@pytest.fixture
+def engine():
+    with Engine(start=START) as engine:
+        yield engine
+
+
+@pytest.fixture
+def add_flow(engine):
+    """Save a flow whose handler body is `body`, with `system` and `this` in scope."""
+
+    def add_flow(name, body):
+        script = 'import time\nimport flow_api\n\ndef handler(system, this):\n' + textwrap.indent(textwrap.dedent(body), '    ')
+        engine.system.flow(name).save(script=script)
+
+    return add_flow
+
+
+def git(repository, *args):
+    return subprocess.run(
+        ['git', '-C', repository, *args],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout.decode().strip()
+
+
+def commit(repository, files):
+    """Write `files` (path: content, or None to remove) and commit them."""
+    for name, content in files.items():
+        path = os.path.join(repository, name)
+        if content is None:
+            os.remove(path)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+    git(repository, 'add', '-A')
+    git(repository, '-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'commit')
+    return git(repository, 'rev-parse', 'HEAD')
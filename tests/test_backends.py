@@ -0,0 +1,87 @@
+import os
+import shutil
+
+import pytest
+
+from flow_api_local import Engine, GitBackend, MirrorGitBackend, RestBackend
+
+from conftest import commit, git
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+
+
+@pytest.fixture
+def repository(tmp_path):
+    path = str(tmp_path / 'origin')
+    os.makedirs(path)
+    git(path, 'init', '-q')
+    commit(path, {
+        'flows/a.py': 'a',
+        'flows/sub/b.py': 'b',
+        'settings/c.yaml': 'c',
+        'README.md': 'readme',
+    })
+    return path
+
+
+def get_files(backend, inputs):
+    with Engine(backends={'GIT': backend}) as engine:
+        engine.system.flow('get').save(script=(
+            'def handler(system, this):\n'
+            '    this.save(output_value=this.task("GIT", **this.get("input_value")).get("output_value"))\n'
+            '    return this.success()\n'
+        ))
+        output = engine.run('get', inputs).get('output_value')
+    return sorted(f['name'] for f in output['files'])
+
+
+def test_git_get_returns_all_files(repository):
+    assert get_files(GitBackend(), {'command': 'get', 'repository_url': repository}) == [
+        'README.md', 'flows/a.py', 'flows/sub/b.py', 'settings/c.yaml',
+    ]
+
+
+@pytest.mark.parametrize('sparse_paths, expected', [
+    (['flows'], ['flows/a.py', 'flows/sub/b.py']),
+    (['flows/'], ['flows/a.py', 'flows/sub/b.py']),
+    (['settings', '*.md'], ['README.md', 'settings/c.yaml']),
+])
+def test_git_get_sparse_paths(repository, sparse_paths, expected):
+    inputs = {'command': 'get', 'repository_url': repository, 'sparse_paths': sparse_paths}
+    assert get_files(GitBackend(), inputs) == expected
+
+
+def test_mirror_fetches_only_when_needed(repository, tmp_path):
+    mirror = MirrorGitBackend(str(tmp_path / 'mirrors'))
+    first = git(repository, 'rev-parse', 'HEAD')
+    get_files(mirror, {'command': 'get', 'repository_url': repository})
+    assert (mirror.clones, mirror.fetches) == (1, 0)
+    # a commit sha which is in the mirror already needs no fetch
+    get_files(mirror, {'command': 'get', 'repository_url': repository, 'ref': first})
+    assert (mirror.clones, mirror.fetches) == (1, 0)
+    second = commit(repository, {'flows/new.py': 'new'})
+    names = get_files(mirror, {'command': 'get', 'repository_url': repository, 'ref': second})
+    assert 'flows/new.py' in names
+    assert (mirror.clones, mirror.fetches) == (1, 1)
+
+
+def test_mirror_budget_evicts(repository, tmp_path):
+    mirror = MirrorGitBackend(str(tmp_path / 'mirrors'), budget=0)
+    for _ in range(2):
+        get_files(mirror, {'command': 'get', 'repository_url': repository})
+    assert (mirror.clones, mirror.fetches) == (2, 0)
+    assert os.listdir(mirror.mirror_dir) == []
+
+
+def test_rest_routes_and_records_requests():
+    rest = RestBackend()
+    rest.route(r'/items/(\d+)', lambda inputs: {'json': {'url': inputs['url']}})
+    with Engine(backends={'REST': rest}) as engine:
+        engine.system.flow('get').save(script=(
+            'def handler(system, this):\n'
+            '    this.save(output_value=this.task("REST", url="http://x/items/1").get("output_value"))\n'
+            '    return this.success()\n'
+        ))
+        output = engine.run('get').get('output_value')
+    assert output['json'] == {'url': 'http://x/items/1'}
+    assert rest.calls == 1
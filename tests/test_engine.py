@@ -0,0 +1,255 @@
+import time
+
+import pytest
+
+from flow_api_local.exceptions import DeadlockError
+
+from conftest import START
+
+
+DAY = 24 * 3600
+
+
+def test_sleep_advances_the_virtual_clock(engine, add_flow):
+    add_flow('sleeper', '''
+        before = time.time()
+        this.sleep(30 * 86400)
+        this.save(output_value={'slept': time.time() - before})
+        return this.success()
+    ''')
+    wall_start = time.perf_counter()
+    execution = engine.run('sleeper')
+    assert time.perf_counter() - wall_start < 5
+    assert execution.get('status') == 'ENDED_SUCCESS'
+    assert execution.get('output_value') == {'slept': 30 * DAY}
+    assert execution.get('end_time') - execution.get('start_time') == 30 * DAY
+    assert engine.clock.time() == START + 30 * DAY
+
+
+def test_run_until_stops_the_clock(engine, add_flow):
+    add_flow('sleeper', '''
+        this.sleep(100)
+        return this.success()
+    ''')
+    execution = engine.run('sleeper', until=START + 40)
+    assert execution.get('status') == 'RUNNING'
+    assert engine.clock.time() == START + 40
+    engine.drive()
+    assert execution.get('status') == 'ENDED_SUCCESS'
+    assert engine.clock.time() == START + 100
+
+
+def test_wait_for_first_ended(engine, add_flow):
+    add_flow('child', '''
+        this.sleep(this.get('input_value')['seconds'])
+        return this.success()
+    ''')
+    add_flow('parent', '''
+        children = [
+            this.flow('child', name=f'child {seconds}', inputs={'seconds': seconds}, run=False).run_async()
+            for seconds in (30, 10, 20)
+        ]
+        ended = this.wait_for(*children, return_when=system.return_when.FIRST_ENDED)
+        this.save(output_value={'ended': [e.get('name') for e in ended], 'at': time.time()})
+        return this.success()
+    ''')
+    execution = engine.run('parent')
+    assert execution.get('output_value') == {'ended': ['child 10'], 'at': START + 10}
+
+
+def test_wait_for_all_ended_and_timeout(engine, add_flow):
+    add_flow('child', '''
+        this.sleep(this.get('input_value')['seconds'])
+        return this.success()
+    ''')
+    add_flow('parent', '''
+        children = [
+            this.flow('child', inputs={'seconds': seconds}, run=False).run_async()
+            for seconds in (30, 10)
+        ]
+        ended = this.wait_for(*children, timeout=15)
+        first = (len(ended), time.time())
+        ended = this.wait_for(*children)
+        this.save(output_value={'first': first, 'all': (len(ended), time.time())})
+        return this.success()
+    ''')
+    execution = engine.run('parent')
+    assert execution.get('output_value') == {
+        'first': (1, START + 15),
+        'all': (2, START + 30),
+    }
+
+
+def test_wait_for_all_succeeded_raises_on_failed_child(engine, add_flow):
+    add_flow('failing', '''
+        return this.error('broken')
+    ''')
+    add_flow('parent', '''
+        try:
+            this.flow('failing')
+        except flow_api.exceptions.DependencyFailedError as err:
+            return this.success(str(err))
+        return this.error('no exception')
+    ''')
+    execution = engine.run('parent')
+    assert execution.get('status') == 'ENDED_SUCCESS'
+    assert 'broken' in execution.get('message')
+
+
+def test_setting_lock_serialises_executions(engine, add_flow):
+    add_flow('locker', '''
+        setting = system.setting('counter')
+        setting.acquire(timeout=None)
+        try:
+            value = setting.get('value')
+            this.sleep(10)
+            setting.save(value=value + 1)
+        finally:
+            setting.release()
+        return this.success()
+    ''')
+    add_flow('parent', '''
+        lockers = [this.flow('locker', run=False).run_async() for _ in range(3)]
+        this.wait_for(*lockers)
+        return this.success()
+    ''')
+    engine.system.setting('counter').save(value=0)
+    engine.run('parent')
+    # without the lock all three would read 0 and write 1
+    assert engine.system.setting('counter').get('value') == 3
+    assert engine.clock.time() == START + 30
+
+
+def test_setting_lock_timeout(engine, add_flow):
+    add_flow('holder', '''
+        system.setting('lock').acquire(timeout=None)
+        this.sleep(60)
+        return this.success()
+    ''')
+    add_flow('waiter', '''
+        try:
+            system.setting('lock').acquire(timeout=5)
+        except flow_api.exceptions.LockTimeoutError:
+            return this.success(f'timed out at {time.time()}')
+        return this.error('got the lock')
+    ''')
+    add_flow('parent', '''
+        holder = this.flow('holder', run=False).run_async()
+        waiter = this.flow('waiter', run=False).run_async()
+        this.wait_for(holder, waiter)
+        this.save(output_value={'waiter': waiter.get('message')})
+        return this.success()
+    ''')
+    engine.system.setting('lock').save(value=None)
+    execution = engine.run('parent')
+    assert execution.get('output_value') == {'waiter': f'timed out at {float(START + 5)}'}
+
+
+def test_setting_lock_is_released_when_the_owner_ends(engine, add_flow):
+    add_flow('forgetful', '''
+        system.setting('lock').acquire(timeout=None)
+        return this.success()
+    ''')
+    add_flow('parent', '''
+        this.flow('forgetful')
+        system.setting('lock').acquire(timeout=1)
+        return this.success()
+    ''')
+    engine.system.setting('lock').save(value=None)
+    assert engine.run('parent').get('status') == 'ENDED_SUCCESS'
+
+
+def test_cancel_ends_the_child_and_its_children(engine, add_flow):
+    add_flow('grandchild', '''
+        this.sleep(1000)
+        return this.success()
+    ''')
+    add_flow('child', '''
+        this.flow('grandchild')
+        return this.success()
+    ''')
+    add_flow('parent', '''
+        child = this.flow('child', run=False).run_async()
+        this.sleep(10)
+        child.cancel()
+        this.wait_for(child)
+        return this.success()
+    ''')
+    execution = engine.run('parent')
+    statuses = {
+        e.get('name'): e.get('status')
+        for e in engine.executions_by_id.values()
+    }
+    assert statuses == {
+        'parent': 'ENDED_SUCCESS',
+        'child': 'ENDED_CANCELLED',
+        'grandchild': 'ENDED_CANCELLED',
+    }
+    assert execution.get('end_time') == START + 10
+
+
+def test_cancel_is_not_swallowed_by_except_exception(engine, add_flow):
+    add_flow('stubborn', '''
+        try:
+            this.sleep(1000)
+        except Exception:
+            return this.success('swallowed')
+        return this.success()
+    ''')
+    add_flow('parent', '''
+        child = this.flow('stubborn', run=False).run_async()
+        this.sleep(1)
+        child.cancel()
+        this.wait_for(child)
+        return this.success(child.get('status'))
+    ''')
+    assert engine.run('parent').get('message') == 'ENDED_CANCELLED'
+
+
+def test_message_is_answered_with_defaults(engine, add_flow):
+    add_flow('asker', '''
+        response = system.message(
+            subject='question',
+            body={
+                'type': 'object',
+                'properties': {
+                    'name': {'element': 'string', 'type': 'string', 'order': 1},
+                    'count': {'element': 'number', 'type': 'number', 'default': 3, 'order': 2},
+                },
+            },
+        ).wait().get('response')
+        this.save(output_value=response)
+        return this.success()
+    ''')
+    engine.responses = {'question': {'name': 'x'}}
+    assert engine.run('asker').get('output_value') == {'name': 'x', 'count': 3}
+
+
+def test_unanswered_message_is_a_deadlock(engine, add_flow):
+    add_flow('asker', '''
+        system.message(subject='nobody answers', body={}).wait()
+        return this.success()
+    ''')
+    with pytest.raises(DeadlockError):
+        engine.run('asker')
+
+
+def test_message_answered_from_outside(engine, add_flow):
+    add_flow('asker', '''
+        message = system.message(subject='later', body={})
+        this.save(output_value={'message_id': message.get('id')})
+        response = message.wait().get('response')
+        return this.success(response['answer'])
+    ''')
+    execution = engine.run('asker', strict=False)
+    assert execution.get('status') == 'RUNNING'
+    engine.respond(execution.get('output_value')['message_id'], {'answer': 42})
+    engine.drive()
+    assert execution.get('message') == 42
+
+
+def test_save_with_a_new_name_renames(engine):
+    engine.system.file('old').save(content=b'data')
+    engine.system.file('old').save(name='new')
+    assert not engine.system.file('old').exists()
+    assert engine.system.file('new').get('size') == 4
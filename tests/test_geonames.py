@@ -0,0 +1,39 @@
+import urllib.parse
+
+from flow_api_local import Engine, InputBackend, RestBackend
+
+from conftest import START
+
+
+def geonames(inputs):
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(inputs['url']).query))
+    if 'countryInfo' in inputs['url']:
+        return {'json': {'geonames': [{
+            'capital': 'Vienna',
+            'continentName': 'Europe',
+            'population': 8_900_000,
+            'areaInSqKm': 83_871,
+        }]}}
+    if query['name'] == 'Austria':
+        return {'json': {'geonames': [{'countryCode': 'AT'}], 'totalResultsCount': 1}}
+    return {'json': {'geonames': [], 'totalResultsCount': 0}}
+
+
+def run_example(countryname):
+    rest = RestBackend()
+    rest.route(r'api\.geonames\.org', geonames)
+    answers = InputBackend(lambda request: countryname if 'country' in request else 'yes')
+    with Engine(start=START, backends={'REST': rest, 'INPUT': answers}) as engine:
+        statuses = [engine.run('Example settings input REST', strict=False).get('status') for _ in range(2)]
+        bucket = engine.system.setting('rate_limit.api.geonames.org').get('value')
+    # every REST call took a token from the bucket shared with loop_child
+    assert bucket['tokens'] == bucket['burst'] - rest.calls
+    return statuses, rest.calls
+
+
+def test_example_caches_found_countries():
+    assert run_example('Austria') == (['ENDED_SUCCESS', 'ENDED_SUCCESS'], 2)
+
+
+def test_example_caches_unknown_countries():
+    assert run_example('Nowhere') == (['ENDED_ERROR', 'ENDED_ERROR'], 1)
@@ -0,0 +1,298 @@
+import os
+import textwrap
+import urllib.parse
+
+import pytest
+
+from flow_api_local import Engine, RestBackend, install
+
+from conftest import START
+
+install()
+
+import loop_parent  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def geonames(inputs):
+    """Answer the three geonames calls of loop_child; 'Nowhere' is unknown."""
+    url = inputs['url']
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    if '/countryInfo' in url:
+        return {'json': {'geonames': [{'capital': 'Capital of ' + query['country']}]}}
+    if query.get('featureCode') == 'PCLI':
+        if query['name'] == 'Nowhere':
+            return {'json': {'geonames': []}}
+        return {'json': {'geonames': [{'countryCode': query['name']}]}}
+    return {'json': {'geonames': [{'lat': '1.5', 'lng': '2.5'}]}}
+
+
+def add_library_flow(engine, name, library, body):
+    """
+    Save a flow with the script of the flow `library` and a handler whose
+    body is `body`, so the handler can use the classes of the library.
+    """
+    with open(os.path.join(ROOT, f'{library}.py')) as f:
+        script = f.read()
+    script += '\n\ndef handler(system, this):\n' + textwrap.indent(textwrap.dedent(body), '    ')
+    engine.system.flow(name).save(script=script)
+
+
+def test_fan_out_bounds_the_children_and_yields_them_as_they_end(engine, add_flow):
+    add_flow('work', '''
+        this.sleep(this.get('input_value')['seconds'])
+        return this.success()
+    ''')
+    add_library_flow(engine, 'fan out', 'loop_parent', '''
+        fan_out = FanOut(
+            system,
+            this,
+            'work',
+            ({'number': number, 'seconds': seconds} for number, seconds in enumerate([10, 1, 3, 2, 1, 1])),
+            2,
+        )
+        ended = [inputs['number'] for inputs, child, seconds in fan_out.as_completed()]
+        this.save(output_value={'ended': ended})
+        return this.success()
+    ''')
+    assert engine.run('fan out').get('output_value') == {'ended': [1, 2, 3, 4, 5, 0]}
+    started = [
+        execution.get('start_time') - START for execution in engine.executions_by_id.values()
+        if execution._target == ('FLOW', 'work')
+    ]
+    # two children at a time, the next one starts when one ends
+    assert started == [0, 0, 1, 4, 6, 7]
+
+
+def test_loop_child_looks_up_a_batch():
+    rest = RestBackend().route(r'api\.geonames\.org', geonames)
+    with Engine(start=START, backends={'REST': rest}) as engine:
+        execution = engine.run('loop_child', {'countrynames': ['Austria', 'Nowhere', 'Latvia']})
+        assert execution.get('output_value')['results'] == {
+            'Austria': {'Capital of Austria': {'lat': 1.5, 'lng': 2.5}},
+            'Nowhere': {'error': 'Nowhere'},
+            'Latvia': {'Capital of Latvia': {'lat': 1.5, 'lng': 2.5}},
+        }
+        assert rest.calls == 7
+
+
+@pytest.mark.parametrize('count, per_item, sizes', [
+    # without a measurement, every batch holds one item
+    (5, None, [1, 1, 1, 1, 1]),
+    # 60 s of work at 6 s per item, until the batches get smaller than the
+    # share of each worker in the rest
+    (100, 6, [10] * 9 + [5, 3, 1, 1]),
+    (1000, 0.01, [200, 200, 200, 200, 100, 50, 25, 13, 6, 3, 2, 1]),
+])
+def test_batches_are_sized_by_the_time_per_item(count, per_item, sizes):
+    latency = {} if per_item is None else {'per_item': per_item}
+    batches = list(loop_parent.batches(list(range(count)), 2, latency))
+    assert [len(batch) for batch in batches] == sizes
+    assert sum(batches, []) == list(range(count))
+
+
+def test_batches_grow_with_the_measured_time_per_item():
+    latency = {}
+    batches = loop_parent.batches(list(range(100)), 2, latency)
+    assert next(batches) == [0]
+    latency['per_item'] = 20
+    assert next(batches) == [1, 2, 3]
+
+
+def test_rest_cache_expires_and_evicts_entries(engine):
+    add_library_flow(engine, 'cache', 'loop_child', '''
+        inputs = this.get('input_value')
+        this.sleep(inputs['after'])
+        cache = RestCache(system, 'cache', ttl=60, max_entries=2)
+        found = [cache.lookup(url) is not None for url in inputs.get('lookup', [])]
+        for url in inputs.get('store', []):
+            cache.store(url, {'url': url})
+        cache.save()
+        this.save(output_value={'found': found, 'cached': sorted(system.setting('cache').get('value'))})
+        return this.success()
+    ''')
+
+    def run(after, **inputs):
+        return engine.run('cache', {'after': after, **inputs}).get('output_value')
+
+    a, b, c = (f'http://api.example.com/{name}?x=1&y=2' for name in 'abc')
+    run(0, store=[a, b])
+    # the order of the query parameters and the case of the host do not matter
+    assert run(30, lookup=['http://API.example.com/a?y=2&x=1'])['found'] == [True]
+    # b is the least recently used entry
+    assert run(20, store=[c])['cached'] == [a, c]
+    # 70 s after a was stored, it expired
+    assert run(20, lookup=[a, b, c])['found'] == [False, False, True]
+
+
+def failing(countries, times=None):
+    """Geonames, where the country code lookup of `countries` fails `times` times each."""
+    failures = {}
+
+    def respond(inputs):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(inputs['url']).query))
+        name = query.get('name')
+        if query.get('featureCode') == 'PCLI' and name in countries:
+            failures[name] = failures.get(name, 0) + 1
+            if times is None or failures[name] <= times:
+                return {'status_code': 503}
+        return geonames(inputs)
+
+    return respond
+
+
+def geonames_engine(countrynames, respond, latency=0.5):
+    rest = RestBackend(latency=latency).route(r'api\.geonames\.org', respond)
+    engine = Engine(start=START, backends={'REST': rest})
+    engine.system.setting('geonames_countrynames').save(value=countrynames)
+    # no waiting for the rate limit, which would make children take longer
+    engine.system.setting('rate_limit.api.geonames.org').save(value={
+        'rate': 1000,
+        'burst': 1000,
+        'tokens': 1000,
+        'updated_at': START,
+    })
+    return engine
+
+
+def test_loop_parent_retries_failed_countries():
+    started = []
+
+    def respond(inputs):
+        if 'name=Flaky' in inputs['url']:
+            started.append(engine.clock.time())
+        return flaky(inputs)
+
+    flaky = failing(['Flaky'], times=2)
+    # the error budget of 20 countries allows for two retries
+    engine = geonames_engine([f'Country{i}' for i in range(19)] + ['Flaky'], respond)
+    execution = engine.run('loop_parent')
+    summary = execution.get('output_value')
+    assert execution.get('status') == 'ENDED_SUCCESS'
+    assert summary['retries'] == 2
+    assert summary['failed_countries'] == []
+    assert 'Capital of Flaky' in summary['capitals']
+    # only the failed country is looked up again, after a delay which
+    # doubles with every attempt, give or take half of it
+    assert len(started) == 3
+    assert started[1] - started[0] >= 0.5 * loop_parent.BACKOFF_BASE
+    assert started[2] - started[1] >= 0.5 * loop_parent.BACKOFF_BASE * 2
+    engine.close()
+
+
+def test_loop_parent_stops_retrying_when_the_error_budget_is_used_up():
+    broken = [f'Broken{i}' for i in range(30)]
+    engine = geonames_engine(broken, failing(broken))
+    execution = engine.run('loop_parent')
+    summary = execution.get('output_value')
+    # 10 % of 30 countries
+    assert summary['retries'] == 3
+    assert sorted(summary['failed_countries']) == sorted(broken)
+    assert summary['done'] == 30
+    engine.close()
+
+
+def test_loop_parent_hedges_stragglers():
+    countrynames = [f'Country{i}' for i in range(60)]
+    slow = []
+
+    def latency(inputs):
+        # the first lookup of Country50 hangs
+        if 'name=Country50&featureCode=PCLI' in inputs['url'] and not slow:
+            slow.append(inputs['url'])
+            return 3600
+        return 0.5
+
+    engine = geonames_engine(countrynames, geonames, latency)
+    execution = engine.run('loop_parent')
+    summary = execution.get('output_value')
+    assert execution.get('status') == 'ENDED_SUCCESS'
+    assert summary['hedged'] == 1
+    assert len(summary['capitals']) == 60
+    assert execution.get('end_time') < START + 600
+    # the duplicate won, the straggler was cancelled
+    cancelled = [
+        child.get('input_value')['countrynames'] for child in engine.executions_by_id.values()
+        if child._target == ('FLOW', 'loop_child') and child.get('status') == 'ENDED_CANCELLED'
+    ]
+    assert len(cancelled) == 1 and 'Country50' in cancelled[0]
+    engine.close()
+
+
+def test_loop_parent_resumes_from_its_checkpoint():
+    countrynames = [f'Country{i}' for i in range(1000)]
+    looked_up = []
+
+    def respond(inputs):
+        if 'featureCode=PCLI' in inputs['url']:
+            looked_up.append(dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(inputs['url']).query))['name'])
+        return geonames(inputs)
+
+    engine = geonames_engine(countrynames, respond)
+    execution = engine.run('loop_parent', until=START + loop_parent.SAVE_INTERVAL + 2)
+    engine.cancel(execution)
+    engine.drive()
+    progress = engine.system.setting(loop_parent.CHECKPOINT_SETTING).get('value')
+    done = set(progress['done'])
+    assert 0 < len(done) < len(countrynames)
+    assert len(progress['summary']['capitals']) == len(done)
+
+    # without the cache, every country which is looked up again shows up
+    engine.system.setting('geonames_cache').delete()
+    looked_up.clear()
+    execution = engine.run('loop_parent')
+    assert execution.get('status') == 'ENDED_SUCCESS'
+    assert not done & set(looked_up)
+    assert sorted(looked_up) == sorted(set(countrynames) - done)
+    summary = execution.get('output_value')
+    assert (summary['done'], summary['total']) == (1000, 1000)
+    assert len(summary['capitals']) == 1000
+    assert not engine.system.setting(loop_parent.CHECKPOINT_SETTING).exists()
+    engine.close()
+
+
+def test_pipeline_limits_each_stage_and_overlaps_them():
+    requests = []
+
+    def respond(inputs):
+        requests.append((engine.clock.time() - START, inputs['url'].rsplit('/', 2)[-2:]))
+        return {'status_code': 503} if inputs['url'].endswith('/bad') else {'json': {}}
+
+    rest = RestBackend(latency=1).route(r'api\.example\.com', respond)
+    with Engine(start=START, backends={'REST': rest}) as engine:
+        add_library_flow(engine, 'pipeline', 'loop_child', '''
+            def step(stage, last):
+                def call(state):
+                    def read(json):
+                        state['stages'].append(stage)
+                        if last:
+                            return state['stages']
+                    return f'http://api.example.com/{stage}/{state["key"]}', read
+                return call
+
+            pipeline = Pipeline(
+                system,
+                this,
+                RestCache(system, 'pipeline cache'),
+                RateLimiter(system, 'api.example.com', rate=1000, burst=1000),
+                [('first', 2, step('first', False)), ('second', 1, step('second', True))],
+            )
+            results = pipeline.run((key, {'key': key, 'stages': []}) for key in ['a', 'b', 'c', 'd', 'bad'])
+            this.save(output_value=results)
+            return this.success()
+        ''')
+        results = engine.run('pipeline').get('output_value')
+    assert {key: result for key, result in results.items() if key != 'bad'} == {
+        key: ['first', 'second'] for key in 'abcd'
+    }
+    assert 'failed' in results['bad']
+    # two calls of the first stage and one of the second at a time; the
+    # second stage of an item runs while the next items are in the first
+    assert requests == [
+        (1, ['first', 'a']), (1, ['first', 'b']),
+        (2, ['second', 'a']), (2, ['first', 'c']), (2, ['first', 'd']),
+        (3, ['second', 'b']), (3, ['first', 'bad']),
+        (4, ['second', 'c']),
+        (5, ['second', 'd']),
+    ]
@@ -0,0 +1,49 @@
+from flow_api_local import Engine, RestBackend
+
+from conftest import START
+
+
+CALLS = '''
+import flow_api
+
+def handler(system, this):
+    calls = [
+        this.flow(
+            'acs.apicall',
+            inputs={
+                'command': {'command': 'listVirtualMachines', 'apikey': 'key'},
+                'secret': 'secret',
+                'compute_endpoint': this.get('input_value')['endpoint'],
+            },
+            run=False,
+        ).run_async()
+        for _ in range(75)
+    ]
+    this.wait_for(*calls)
+    return this.success()
+'''
+
+
+def run_calls(endpoint):
+    rest = RestBackend()
+    started = []
+    rest.route(r'cloud\.example\.com', lambda inputs: started.append(engine.clock.time()) or {'json': {}})
+    with Engine(start=START, backends={'REST': rest}) as engine:
+        engine.system.flow('calls').save(script=CALLS)
+        assert engine.run('calls', {'endpoint': endpoint}).get('status') == 'ENDED_SUCCESS'
+        bucket = engine.system.setting('rate_limit.cloud.example.com').get('value')
+    return started, bucket
+
+
+def test_calls_share_one_bucket_per_host():
+    started, bucket = run_calls('https://cloud.example.com/client/api')
+    assert (bucket['rate'], bucket['burst']) == (25, 25)
+    # a burst of 25, then 25 calls per second
+    assert sum(1 for at in started if at < START + 1) <= 25 + 25
+    assert max(started) - START >= (75 - 25) / 25 - 0.01
+
+
+def test_endpoint_without_scheme():
+    started, bucket = run_calls('cloud.example.com/client/api')
+    assert len(started) == 75
+    assert max(started) - START >= (75 - 25) / 25 - 0.01
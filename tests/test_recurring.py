@@ -0,0 +1,136 @@
+import pytest
+
+from flow_api_local import Engine, simulate
+
+from conftest import START
+
+
+SLOW_FIRST = '''
+import flow_api
+
+def handler(system: flow_api.System, this: flow_api.Execution):
+    if this.get('input_value')['iterations'] == 1:
+        this.sleep(35)
+    return this.success()
+'''
+
+
+def recurring(report):
+    """The execution of Recurring which started the children."""
+    [execution] = [
+        execution for execution in report.engine.executions_by_id.values()
+        if execution._target == ('FLOW', 'Recurring') and 'message_id' in execution.get('input_value')
+    ]
+    return execution
+
+
+def fire_times(report):
+    return [fire.at - START for fire in report.fires]
+
+
+@pytest.mark.parametrize('catch_up, burst_limit, fires, skipped, coalesced', [
+    # the three ticks missed while the first child ran start right away
+    ('burst', None, [0, 35, 35, 35, 40, 50], 0, 0),
+    # one of them starts, the other two are skipped
+    ('burst', 1, [0, 35, 40, 50, 60, 70], 2, 0),
+    ('skip', None, [0, 40, 50, 60, 70, 80], 3, 0),
+    # one iteration stands in for all three
+    ('coalesce', None, [0, 35, 40, 50, 60, 70], 0, 2),
+])
+def test_fixed_rate_catch_up(catch_up, burst_limit, fires, skipped, coalesced):
+    engine = Engine(start=START)
+    engine.system.flow('slow first').save(script=SLOW_FIRST)
+    report = simulate(
+        'Recurring',
+        {
+            'flow_name': 'slow first',
+            'interval': 10,
+            'wait': True,
+            'fixed_rate': True,
+            'catch_up': catch_up,
+            'burst_limit': burst_limit,
+            'max_iterations': 6,
+        },
+        engine=engine,
+    )
+    assert fire_times(report) == fires
+    output = recurring(report).get('output_value')
+    assert (output['skipped_ticks'], output['coalesced_ticks']) == (skipped, coalesced)
+    if catch_up == 'coalesce':
+        coalesced_ticks = [
+            execution.get('input_value').get('coalesced_ticks')
+            for execution in report.engine.executions_by_id.values()
+            if execution._target == ('FLOW', 'slow first')
+        ]
+        assert coalesced_ticks == [None, 2, None, None, None, None]
+    engine.close()
+
+
+def run_overflow(overflow):
+    report = simulate(
+        'Recurring',
+        {
+            'interval': 10,
+            'wait': False,
+            'max_in_flight': 2,
+            'overflow': overflow,
+            'max_queue': 10,
+            'max_iterations': 6,
+        },
+        start=START,
+        child_duration=23,
+    )
+    return report, recurring(report)
+
+
+def test_overflow_skip_drops_iterations():
+    report, execution = run_overflow('skip')
+    # the third and the sixth tick find two children running
+    assert fire_times(report) == [0, 10, 30, 40]
+    assert execution.get('output_value')['dropped_ticks'] == 2
+    assert execution.get('message') == 'started 4 of 6 iterations'
+    report.engine.close()
+
+
+def test_overflow_queue_starts_iterations_when_a_child_ends():
+    report, execution = run_overflow('queue')
+    # the children end 23 s after they started
+    assert fire_times(report) == [0, 10, 23, 33, 46, 56]
+    output = execution.get('output_value')
+    assert (output['dropped_ticks'], output['queue_depth']) == (0, 0)
+    assert execution.get('message') == 'started 6 iterations'
+    report.engine.close()
+
+
+def test_overflow_queue_drops_iterations_beyond_max_queue():
+    report = simulate(
+        'Recurring',
+        {
+            'interval': 10,
+            'wait': False,
+            'max_in_flight': 1,
+            'overflow': 'queue',
+            'max_queue': 1,
+            'max_iterations': 4,
+        },
+        start=START,
+        child_duration=35,
+    )
+    # the second tick is queued until the first child ends, the third and
+    # fourth find the queue full
+    assert fire_times(report) == [0, 35]
+    output = recurring(report).get('output_value')
+    assert output['dropped_ticks'] == 2
+    report.engine.close()
+
+
+def test_overflow_cancel_oldest_cancels_children():
+    report, execution = run_overflow('cancel_oldest')
+    assert fire_times(report) == [0, 10, 20, 30, 40, 50]
+    assert execution.get('output_value')['cancelled_children'] == 4
+    statuses = [
+        child.get('status') for child in report.engine.executions_by_id.values()
+        if child._target == ('FLOW', 'simulated child')
+    ]
+    assert statuses == ['ENDED_CANCELLED'] * 4 + ['ENDED_SUCCESS'] * 2
+    report.engine.close()
@@ -0,0 +1,123 @@
+import datetime
+
+import pytest
+import pytz
+
+from flow_api_local import install
+
+from conftest import START
+
+install()
+
+import Scheduled  # noqa: E402
+
+
+DAY = 24 * 3600
+
+
+def timestamp(local, timezone='UTC'):
+    return pytz.timezone(timezone).localize(datetime.datetime.fromisoformat(local)).timestamp()
+
+
+def utc(at):
+    return datetime.datetime.fromtimestamp(at, pytz.utc).strftime('%Y-%m-%d %H:%M')
+
+
+@pytest.mark.parametrize('expression, after, expected', [
+    ('*/15 * * * *', '2027-01-01 10:07', ['2027-01-01 10:15', '2027-01-01 10:30']),
+    ('0 9-17/4 * * *', '2027-01-01 10:00', ['2027-01-01 13:00', '2027-01-01 17:00', '2027-01-02 09:00']),
+    ('5,10 0 * * *', '2027-01-01 00:05', ['2027-01-01 00:10', '2027-01-02 00:05']),
+    # 2027-01-02 is a saturday
+    ('30 8 * * mon-fri', '2027-01-02 12:00', ['2027-01-04 08:30', '2027-01-05 08:30']),
+    ('0 0 1 jan,jul *', '2027-03-01 00:00', ['2027-07-01 00:00', '2028-01-01 00:00']),
+    # either the 13th or a friday
+    ('0 12 13 * fri', '2027-01-01 12:00', ['2027-01-08 12:00', '2027-01-13 12:00', '2027-01-15 12:00']),
+    ('0 0 29 2 *', '2027-01-01 00:00', ['2028-02-29 00:00', '2032-02-29 00:00']),
+    ('0 0 31 * *', '2027-01-31 00:00', ['2027-03-31 00:00', '2027-05-31 00:00']),
+    ('@weekly', '2027-01-01 00:00', ['2027-01-03 00:00', '2027-01-10 00:00']),
+    ('0 0 * * 7', '2027-01-01 00:00', ['2027-01-03 00:00', '2027-01-10 00:00']),
+])
+def test_cron_next_fires(expression, after, expected):
+    cron = Scheduled.Cron(expression, 'UTC')
+    assert [utc(at) for at in cron.next_fires(timestamp(after), len(expected))] == expected
+
+
+def test_cron_shifts_times_in_a_dst_gap():
+    # at 02:00 on 2027-03-28 the clocks in Vienna jump to 03:00
+    cron = Scheduled.Cron('30 2 * * *', 'Europe/Vienna')
+    fires = cron.next_fires(timestamp('2027-03-27 12:00', 'Europe/Vienna'), 2)
+    # 03:30 CEST, then 02:30 CEST
+    assert [utc(at) for at in fires] == ['2027-03-28 01:30', '2027-03-29 00:30']
+
+
+def test_cron_fires_once_in_a_dst_overlap():
+    # at 03:00 on 2027-10-31 the clocks in Vienna go back to 02:00
+    cron = Scheduled.Cron('30 2 * * *', 'Europe/Vienna')
+    fires = cron.next_fires(timestamp('2027-10-30 12:00', 'Europe/Vienna'), 2)
+    # 02:30 CEST, then 02:30 CET of the next day
+    assert [utc(at) for at in fires] == ['2027-10-31 00:30', '2027-11-01 01:30']
+
+
+@pytest.mark.parametrize('expression', ['61 * * * *', '* * *', '0 0 * * moon', '5-1 * * * *', '0 0 30 2 *'])
+def test_cron_rejects_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        Scheduled.Cron(expression, 'UTC').next_fire(START)
+
+
+@pytest.mark.parametrize('response, cron, second, utc_offset', [
+    ({'cron': '*/5 * * * *'}, '*/5 * * * *', 0, None),
+    ({'scheduled_at': '06:30:15'}, '30 6 * * *', 15, None),
+    ({'scheduled_at': '06:30:00+0200'}, '30 6 * * *', 0, 120),
+    ({'scheduled_at_day': 1, 'scheduled_at_time': '06:00:00'}, '0 6 1 * *', 0, None),
+])
+def test_schedule_from_response(response, cron, second, utc_offset):
+    schedule = Scheduled.schedule_from_response(response)
+    assert (schedule['cron'], schedule['second'], schedule.get('utc_offset')) == (cron, second, utc_offset)
+
+
+def schedules(engine):
+    return [
+        execution for execution in engine.executions_by_id.values()
+        if execution._target == ('FLOW', 'Scheduled') and execution.get('status') == 'RUNNING'
+    ]
+
+
+def test_two_schedules_of_one_flow_are_checkpointed_and_resumed(engine, add_flow):
+    add_flow('report', '''
+        return this.success()
+    ''')
+    engine.responses = {
+        'Scheduled execution': {'flow_name': 'report', 'scheduled_at': '06:00:00'},
+        'Monthly scheduled execution': {
+            'flow_name': 'report',
+            'scheduled_at_day': 1,
+            'scheduled_at_time': '06:00:00',
+            'spread': 0,
+        },
+    }
+    engine.run('Scheduled', until=START + 60)
+    engine.run('Scheduled monthly', until=START + 120)
+    running = schedules(engine)
+    assert len(running) == 2
+    checkpoints = [
+        setting.get('name') for setting in engine.system.settings()
+        if setting.get('name').startswith('Scheduled report ')
+    ]
+    assert len(checkpoints) == 2
+
+    engine.drive(until=START + 3 * DAY)
+    for execution in running:
+        engine.cancel(execution)
+    engine.drive(until=START + 3 * DAY + 60)
+    assert schedules(engine) == []
+
+    engine.run('Scheduled monthly', {'flow_name': 'report'}, until=START + 3 * DAY + 120)
+    resumed = schedules(engine)
+    assert len(resumed) == 2
+    engine.drive(until=START + 4 * DAY + 60)
+    iterations = [
+        execution.get('name') for execution in engine.executions_by_id.values()
+        if execution._target == ('FLOW', 'report')
+    ]
+    # the daily schedule continues counting from its checkpoint
+    assert sorted(iterations) == [f'report iteration #{i}' for i in range(1, 5)]
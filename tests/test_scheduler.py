@@ -0,0 +1,42 @@
+from flow_api_local import simulate
+
+from conftest import START
+
+
+def runners(engine):
+    # the executions of Scheduler which registered a schedule are not runners
+    return [
+        execution for execution in engine.executions_by_id.values()
+        if execution._target == ('FLOW', 'Scheduler')
+        and not {'add', 'remove'} & set(execution.get('input_value') or {})
+    ]
+
+
+def test_runner_ends_after_the_last_schedule_fired():
+    report = simulate(
+        'Recurring',
+        {'interval': 60, 'wait': False, 'max_iterations': 3, 'shared': True},
+        duration=3600,
+        start=START,
+    )
+    assert len(report.fires) == 3
+    [runner] = runners(report.engine)
+    assert runner.get('status') == 'ENDED_SUCCESS'
+    assert runner.get('message') == 'dispatched 3 child executions'
+    state = report.engine.system.setting('scheduler').get('value')
+    assert state['runner'] is None
+    report.engine.close()
+
+
+def test_delays_queued_one_after_another(engine, add_flow):
+    add_flow('ping', '''
+        return this.success('pong')
+    ''')
+    for _ in range(2):
+        engine.run('Delayed', {'flow_name': 'ping', 'delay': 30})
+    assert [runner.get('status') for runner in runners(engine)] == ['ENDED_SUCCESS', 'ENDED_SUCCESS']
+    pings = [
+        execution.get('start_time') for execution in engine.executions_by_id.values()
+        if execution._target == ('FLOW', 'ping')
+    ]
+    assert pings == [START + 30, START + 60]
@@ -0,0 +1,332 @@
+import base64
+import os
+import re
+import shutil
+import subprocess
+import urllib.parse
+
+import pytest
+
+from flow_api_local import Engine, Execution, GitBackend, RestBackend
+
+from conftest import START, commit, git
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+
+
+class FixedGit(GitBackend):
+    """Serve every GIT task from one local repository, whatever its url."""
+
+    def __init__(self, repository):
+        super().__init__()
+        self.repository = repository
+
+    def _repository(self, inputs):
+        return self.repository
+
+
+def github_rest(repository):
+    """Answer the github compare and contents api from `repository`."""
+    rest = RestBackend()
+
+    def compare(inputs):
+        base, head = re.search(r'compare/(\w+)\.\.\.(\w+)', inputs['url']).groups()
+        merge_base = git(repository, 'merge-base', base, head)
+        if base == head:
+            status = 'identical'
+        elif merge_base == base:
+            status = 'ahead'
+        else:
+            status = 'behind' if merge_base == head else 'diverged'
+        files = []
+        for line in git(repository, 'diff', '--name-status', '--no-renames', merge_base, head).splitlines():
+            change, path = line.split('\t')
+            files.append({'filename': path, 'status': {'A': 'added', 'M': 'modified', 'D': 'removed'}[change]})
+        return {'json': {'status': status, 'files': files}}
+
+    def contents(inputs):
+        path, ref = re.fullmatch(r'.*/contents/([^?#]+)\?ref=(\w+)', inputs['url']).groups()
+        data = subprocess.run(
+            ['git', '-C', repository, 'show', f'{ref}:{urllib.parse.unquote(path)}'],
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        return {'json': {'content': base64.b64encode(data).decode()}}
+
+    rest.route(r'/compare/', compare)
+    rest.route(r'/contents/', contents)
+    return rest
+
+
+@pytest.fixture
+def repository(tmp_path):
+    path = str(tmp_path / 'origin')
+    os.makedirs(path)
+    git(path, 'init', '-q', '-b', 'master')
+    files = {}
+    for i in range(30):
+        files[f'flows/flow{i}.py'] = f'# flow {i}\n'
+        files[f'settings/setting{i}.yaml'] = f'value: {i}\n'
+        files[f'files/file{i}.bin'] = bytes([i]) * 10
+    commit(path, files)
+    return path
+
+
+def saver_children(engine, flow_name):
+    return [
+        execution for execution in engine.executions_by_id.values()
+        if execution._target == ('FLOW', flow_name) and 'actions' in (execution.get('input_value') or {})
+    ]
+
+
+def assert_synced(engine, count=30):
+    for i in range(count):
+        assert engine.system.flow(f'flow{i}').get('script') == f'# flow {i}\n'
+        assert engine.system.setting(f'setting{i}').get('value') == {'value': i}
+
+
+def test_sync_flow_scripts_saves_in_child_executions(repository):
+    with Engine(start=START) as engine:
+        engine.system.setting('private git repo').save(value={'repository_url': repository})
+        execution = engine.run('sync flow scripts')
+        assert execution.get('status') == 'ENDED_SUCCESS'
+        assert execution.get('output_value')['saved'] == 90
+        assert_synced(engine)
+        assert engine.system.file('file7.bin').get('size') == 10
+        # 30 objects of each kind are saved by 3 children per stage
+        children = saver_children(engine, 'sync flow scripts')
+        assert len(children) == 9
+        assert {child.get('status') for child in children} == {'ENDED_SUCCESS'}
+
+        # a small change is saved by this execution itself
+        sha = commit(repository, {'flows/flow3.py': '# changed\n'})
+        execution = engine.run('sync flow scripts', {'json': {'commit_sha': sha}})
+        assert execution.get('output_value')['saved'] == 1
+        assert engine.system.flow('flow3').get('script') == '# changed\n'
+        assert len(saver_children(engine, 'sync flow scripts')) == 9
+
+
+def test_sync_flow_scripts_skips_unchanged_objects(repository):
+    with Engine(start=START) as engine:
+        engine.system.setting('private git repo').save(value={'repository_url': repository})
+        engine.run('sync flow scripts')
+        modified_at = {
+            name: engine.system.flow(name).get('modified_at') for name in ('flow0', 'flow1')
+        }
+        # a change outside of the synced directories, at a later time
+        engine.clock.advance(60)
+        commit(repository, {'README.md': 'readme'})
+        execution = engine.run('sync flow scripts')
+        output = execution.get('output_value')
+        assert (output['saved'], output['skipped'], output['deleted']) == (0, 90, 0)
+        assert {
+            name: engine.system.flow(name).get('modified_at') for name in ('flow0', 'flow1')
+        } == modified_at
+        # only the first sync started children to save objects
+        assert len(saver_children(engine, 'sync flow scripts')) == 9
+
+
+def test_sync_flow_scripts_fails_when_a_save_fails(repository):
+    commit(repository, {f'settings/broken{i}.yaml': 'a: [' for i in range(20)})
+    with Engine(start=START) as engine:
+        engine.system.setting('private git repo').save(value={'repository_url': repository})
+        execution = engine.run('sync flow scripts', strict=False)
+        assert execution.get('status') == 'ENDED_ERROR'
+        # the flows are saved after the settings, so none of them is
+        assert not engine.system.flow('flow0').exists()
+        assert not engine.system.setting('private git repo.synced_commit').exists()
+
+
+def test_sync_from_github_saves_in_child_executions(repository):
+    with Engine(start=START, backends={'GIT': FixedGit(repository)}) as engine:
+        engine.system.setting('github_info').save(value={
+            'github_username': 'user',
+            'github_repo_name': 'repository',
+            'github_token': 'token',
+        })
+        execution = engine.run('sync_from_github')
+        assert execution.get('status') == 'ENDED_SUCCESS'
+        assert execution.get('output_value')['saved'] == 60
+        assert_synced(engine)
+        assert len(saver_children(engine, 'sync_from_github')) == 6
+
+
+@pytest.mark.parametrize('sparse_checkout', [False, True])
+def test_git_clone_example_saves_in_child_executions(repository, sparse_checkout):
+    # only the top-level directories are synced, with and without a sparse checkout
+    commit(repository, {'flows/sub/nested.py': '# nested\n', 'docs/flows/example.py': '# example\n'})
+    with Engine(start=START) as engine:
+        engine.responses = {'Input Git repository information to connect': {
+            'username': 'user',
+            'password': 'password',
+            'repository url': repository,
+            'reference': 'master',
+            'sparse checkout': sparse_checkout,
+        }}
+        execution = engine.run('Git clone example')
+        assert execution.get('status') == 'ENDED_SUCCESS'
+        assert_synced(engine)
+        assert engine.system.file('file7.bin').get('size') == 10
+        assert engine.system.flow('nested').get('script') == '# nested\n'
+        assert not engine.system.flow('example').exists()
+        children = [
+            execution for execution in engine.executions_by_id.values()
+            if execution._target == ('FLOW', 'Git clone example') and execution.get('input_value')
+        ]
+        # 31 flows are saved by 4 children
+        assert len(children) == 10
+
+
+def checkout_files(engine):
+    return [file_.get('name') for file_ in engine.system.files(dir='private git repo.checkout')]
+
+
+def test_streamed_sync_clears_the_checkout(repository):
+    with Engine(start=START) as engine:
+        engine.system.setting('private git repo').save(value={'repository_url': repository, 'stream_files': True})
+        # a file left behind by an earlier sync is not synced
+        engine.system.file('private git repo.checkout/files/stale.bin').save(content='stale')
+        broken = commit(repository, {'settings/broken.yaml': 'a: ['})
+        execution = engine.run('sync flow scripts', {'json': {'commit_sha': broken}}, strict=False)
+        assert execution.get('status') == 'ENDED_ERROR'
+        assert checkout_files(engine) == []
+
+        synced = commit(repository, {'settings/broken.yaml': None})
+        execution = engine.run('sync flow scripts')
+        assert execution.get('status') == 'ENDED_SUCCESS'
+        assert_synced(engine)
+        assert engine.system.file('file7.bin').get('size') == 10
+        assert not engine.system.file('stale.bin').exists()
+        assert checkout_files(engine) == []
+
+        # the changes of a push are not streamed
+        sha = commit(repository, {'files/file3.bin': b'changed'})
+        push = {'before': synced, 'after': sha, 'commits': [{'modified': ['files/file3.bin']}]}
+        execution = engine.run('sync flow scripts', {'json': push})
+        assert execution.get('output_value')['saved'] == 1
+        assert engine.system.file('file3.bin').get('size') == 7
+        assert checkout_files(engine) == []
+
+
+def make_repository(path, files):
+    os.makedirs(path)
+    git(path, 'init', '-q', '-b', 'master')
+    commit(path, files)
+    return path
+
+
+def sync_repositories(engine):
+    execution = engine.run('sync flow scripts', strict=False)
+    return execution.get('status'), execution.get('output_value')['repositories']
+
+
+def test_collisions_are_reported_until_resolved(tmp_path):
+    first = make_repository(str(tmp_path / 'first'), {'flows/shared.py': '# first\n', 'flows/first.py': ''})
+    second = make_repository(str(tmp_path / 'second'), {'flows/shared.py': '# second\n', 'flows/second.py': ''})
+    with Engine(start=START) as engine:
+        engine.system.setting('private git repo').save(value=[
+            {'name': 'first', 'repository_url': first},
+            {'name': 'second', 'repository_url': second},
+        ])
+        for _ in range(2):
+            status, results = sync_repositories(engine)
+            assert status == 'ENDED_ERROR'
+            collisions = [c for result in results.values() for c in result.get('collisions', [])]
+            assert [c['object'] for c in collisions] == ['flow shared']
+        owner = collisions[0]['owner']
+        collided = 'second' if owner == 'first' else 'first'
+        assert engine.system.flow('shared').get('script') == f'# {owner}\n'
+
+        commit(first if collided == 'first' else second, {'flows/shared.py': None})
+        status, results = sync_repositories(engine)
+        assert status == 'ENDED_SUCCESS'
+        assert results[collided].get('collisions') == []
+
+
+def test_failed_sync_gives_up_its_objects(tmp_path):
+    first = make_repository(str(tmp_path / 'first'), {'flows/first.py': '', 'settings/broken.yaml': 'a: ['})
+    with Engine(start=START) as engine:
+        engine.system.setting('private git repo').save(value=[{'name': 'first', 'repository_url': first}])
+        status, results = sync_repositories(engine)
+        assert status == 'ENDED_ERROR'
+        assert results['first']['status'] == 'ENDED_ERROR'
+        assert engine.system.setting('private git repo.owners').get('value') == {}
+
+
+def test_sync_from_github_removes_objects_of_force_pushed_commits(repository):
+    base = git(repository, 'rev-parse', 'HEAD')
+    with Engine(start=START, backends={'GIT': FixedGit(repository), 'REST': github_rest(repository)}) as engine:
+        engine.system.setting('github_info').save(value={
+            'github_username': 'user',
+            'github_repo_name': 'repository',
+            'github_token': 'token',
+        })
+        engine.run('sync_from_github')
+        commit(repository, {'flows/extra.py': '# extra\n', 'flows/my flow #1.py': '# hash\n'})
+        execution = engine.run('sync_from_github')
+        assert execution.get('output_value')['saved'] == 2
+        assert engine.system.flow('my flow #1').get('script') == '# hash\n'
+
+        # the commit which added the flows is dropped by a force push
+        git(repository, 'reset', '-q', '--hard', base)
+        commit(repository, {'flows/flow1.py': '# rewritten\n'})
+        execution = engine.run('sync_from_github')
+        assert execution.get('status') == 'ENDED_SUCCESS'
+        assert engine.system.flow('flow1').get('script') == '# rewritten\n'
+        assert not engine.system.flow('extra').exists()
+        assert not engine.system.flow('my flow #1').exists()
+        assert execution.get('output_value')['deleted'] == 2
+
+
+@pytest.mark.parametrize('forced', [True, False])
+def test_sync_flow_scripts_removes_objects_of_force_pushed_commits(repository, forced):
+    base = git(repository, 'rev-parse', 'HEAD')
+    with Engine(start=START) as engine:
+        engine.system.setting('private git repo').save(value={'repository_url': repository})
+        engine.run('sync flow scripts')
+        added = commit(repository, {'flows/extra.py': '# extra\n'})
+        push = {'before': base, 'after': added, 'commits': [{'added': ['flows/extra.py']}]}
+        execution = engine.run('sync flow scripts', {'json': push})
+        assert execution.get('output_value')['saved'] == 1
+        assert engine.system.flow('extra').exists()
+
+        # the push only lists the changes of its new commit
+        git(repository, 'reset', '-q', '--hard', base)
+        rewritten = commit(repository, {'flows/flow1.py': '# rewritten\n'})
+        push = {'before': added, 'after': rewritten, 'forced': forced, 'commits': [{'modified': ['flows/flow1.py']}]}
+        execution = engine.run('sync flow scripts', {'json': push})
+        assert execution.get('output_value')['deleted'] == 1
+        assert not engine.system.flow('extra').exists()
+        assert engine.system.flow('flow1').get('script') == '# rewritten\n'
+
+
+def test_sync_from_github_coalesces_a_burst_of_pushes(repository):
+    with Engine(start=START, backends={'GIT': FixedGit(repository), 'REST': github_rest(repository)}) as engine:
+        engine.system.setting('github_info').save(value={
+            'github_username': 'user',
+            'github_repo_name': 'repository',
+            'github_token': 'token',
+        })
+        engine.run('sync_from_github')
+        hooks = []
+        for number in range(10):
+            sha = commit(repository, {f'flows/flow{number}.py': f'# push {number}\n'})
+            hook = Execution(
+                engine, 'FLOW', ('FLOW', 'sync_from_github'), f'webhook {number}',
+                {'json': {'ref': 'refs/heads/master', 'after': sha}},
+            )
+            hooks.append(hook)
+            engine.start(hook)
+            # the first pushes come in at the same time
+            if number >= 3:
+                engine.drive(until=engine.clock.time() + 1)
+        engine.drive()
+        assert {hook.get('status') for hook in hooks} == {'ENDED_SUCCESS'}
+        syncs = [
+            execution for execution in engine.executions_by_id.values()
+            if (execution.get('name') or '').startswith('sync ')
+        ]
+        assert [execution.get('name') for execution in syncs] == [f'sync {sha}']
+        assert syncs[0].get('status') == 'ENDED_SUCCESS'
+        assert syncs[0].get('output_value')['saved'] == 10
+        assert engine.system.flow('flow9').get('script') == '# push 9\n'
@@ -26,6 +26,42 @@ Inputs:
     gcloud_connection: <string> name of the connection stored in the cloudomation workspace
 '''
 
+# The shared rate limit of the webpagetest server, in calls per second and
+# burst size. It is stored in the setting 'rate_limit.<host>' and can be
+# changed there.
+RATE_LIMIT = 2
+RATE_BURST = 5
+
+
+# RateLimiter is copied from loop_child, which documents it.
+class RateLimiter:
+    def __init__(self, system, name, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.setting = system.setting(f'rate_limit.{name}')
+        self.rate = rate
+        self.burst = burst
+
+    def take(self, this, tokens=1):
+        self.setting.acquire(timeout=None)
+        try:
+            now = time.time()
+            bucket = self.setting.get('value') if self.setting.exists() else None
+            if bucket is None:
+                bucket = {
+                    'rate': self.rate,
+                    'burst': self.burst,
+                    'tokens': self.burst,
+                    'updated_at': now,
+                }
+            refilled = bucket['tokens'] + (now - bucket['updated_at']) * bucket['rate']
+            bucket['tokens'] = min(bucket['burst'], refilled) - tokens
+            bucket['updated_at'] = now
+            self.setting.save(value=bucket)
+        finally:
+            self.setting.release()
+        if bucket['tokens'] < 0:
+            this.sleep(-bucket['tokens'] / bucket['rate'])
+
+
 def handler(system: flow_api.System, this: flow_api.Execution):
     start_time = time.time()
     inputs = this.get('input_value')
@@ -42,11 +78,13 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     url_list = options.get('url_list', [])
     test_params = options.get('test_params', {})
     host = webpagetest_server.get('hostname')
+    limiter = RateLimiter(system, host)
 
     test_ids = {}
     for url in url_list:
         test_params['url'] = url.get('url')
         this.log(f'building test_params {url}')
+        limiter.take(this)
         result = this.task(
             'REST',
             url=f'http://{host}:4000/runtest.php',
@@ -63,6 +101,7 @@ def handler(system: flow_api.System, this: flow_api.Execution):
     while not tests_completed:
         this.sleep(240)
         for i in test_ids.keys():
+            limiter.take(this)
             check_running = this.task(
                 'REST',
                 url=f'http://{host}:4000/testStatus.php',
@@ -85,6 +124,7 @@ def handler(system: flow_api.System, this: flow_api.Execution):
             'firstView':{}, 
             'repeatView':{},
         }
+        limiter.take(this)
         test_result = this.task(
             'REST',
             url=f'http://{host}:4000/jsonResult.php',